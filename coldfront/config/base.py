@@ -89,6 +89,28 @@ MIDDLEWARE = [
     'simple_history.middleware.HistoryRequestMiddleware',
 ]
 
+# Cache allocation and resource attribute lookups for the duration of a request
+ATTRIBUTE_CACHE_ENABLED = ENV.bool('ATTRIBUTE_CACHE_ENABLED', default=False)
+if ATTRIBUTE_CACHE_ENABLED:
+    MIDDLEWARE += [
+        'coldfront.core.attribute_cache.AttributeCacheMiddleware',
+    ]
+
+# Number of compiled attriblist programs kept for attribute expansion
+ATTRIBUTE_EXPANSION_CACHE_SIZE = ENV.int('ATTRIBUTE_EXPANSION_CACHE_SIZE', default=256)
+
+# Store expanded attribute values until the attributes they read change
+EXPANDED_VALUE_CACHE_ENABLED = ENV.bool('EXPANDED_VALUE_CACHE_ENABLED', default=False)
+
+# Seconds to cache the row count of paginated lists
+LIST_COUNT_CACHE_TIMEOUT = ENV.int('LIST_COUNT_CACHE_TIMEOUT', default=60)
+
+# Rows read per query by the CSV and JSON Lines exports
+EXPORT_CHUNK_SIZE = ENV.int('EXPORT_CHUNK_SIZE', default=2000)
+
+# Minutes between scheduled refreshes of the portal summary pages
+PORTAL_SUMMARY_REFRESH_MINUTES = ENV.int('PORTAL_SUMMARY_REFRESH_MINUTES', default=15)
+
 #------------------------------------------------------------------------------
 # Django authentication backend. See auth.py
 #------------------------------------------------------------------------------
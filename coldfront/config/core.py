@@ -17,6 +17,7 @@ CENTER_BASE_URL = ENV.str('CENTER_BASE_URL', default='')
 # Enable Project Review
 #------------------------------------------------------------------------------
 PROJECT_ENABLE_PROJECT_REVIEW = ENV.bool('PROJECT_ENABLE_PROJECT_REVIEW', default=True)
+PROJECT_ACCESS_INDEX_ENABLED = ENV.bool('PROJECT_ACCESS_INDEX_ENABLED', default=False)
 
 #------------------------------------------------------------------------------
 # Allocation related
@@ -25,6 +26,7 @@ ALLOCATION_ENABLE_CHANGE_REQUESTS_BY_DEFAULT = ENV.bool('ALLOCATION_ENABLE_CHANG
 ALLOCATION_CHANGE_REQUEST_EXTENSION_DAYS = ENV.list('ALLOCATION_CHANGE_REQUEST_EXTENSION_DAYS', cast=int, default=[30, 60, 90])
 ALLOCATION_ENABLE_ALLOCATION_RENEWAL = ENV.bool('ALLOCATION_ENABLE_ALLOCATION_RENEWAL', default=True)
 ALLOCATION_FUNCS_ON_EXPIRE = ['coldfront.core.allocation.utils.test_allocation_function', ]
+ALLOCATION_EXPIRE_BATCH_SIZE = ENV.int('ALLOCATION_EXPIRE_BATCH_SIZE', default=500)
 
 # This is in days
 ALLOCATION_DEFAULT_ALLOCATION_LENGTH = ENV.int('ALLOCATION_DEFAULT_ALLOCATION_LENGTH', default=365)
@@ -60,6 +62,11 @@ INVOICE_DEFAULT_STATUS = ENV.str('INVOICE_DEFAULT_STATUS', default='New')
 #------------------------------------------------------------------------------
 ONDEMAND_URL = ENV.str('ONDEMAND_URL', default=None)
 
+#------------------------------------------------------------------------------
+# User search
+#------------------------------------------------------------------------------
+USER_SEARCH_TIMEOUT = ENV.int('USER_SEARCH_TIMEOUT', default=10)
+
 #------------------------------------------------------------------------------
 # Default Strings. Override these in local_settings.py
 #------------------------------------------------------------------------------
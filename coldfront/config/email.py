@@ -4,7 +4,7 @@ from coldfront.config.env import ENV
 # Email/Notification settings
 #------------------------------------------------------------------------------
 EMAIL_ENABLED = ENV.bool('EMAIL_ENABLED', default=False)
-EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+EMAIL_BACKEND = ENV.str('EMAIL_BACKEND', default='django.core.mail.backends.smtp.EmailBackend')
 EMAIL_HOST = ENV.str('EMAIL_HOST', default='localhost')
 EMAIL_PORT = ENV.int('EMAIL_PORT', default=25)
 EMAIL_HOST_USER = ENV.str('EMAIL_HOST_USER', default='')
@@ -22,3 +22,9 @@ EMAIL_OPT_OUT_INSTRUCTION_URL = ENV.str('EMAIL_OPT_OUT_INSTRUCTION_URL', default
 EMAIL_ALLOCATION_EXPIRING_NOTIFICATION_DAYS = ENV.list('EMAIL_ALLOCATION_EXPIRING_NOTIFICATION_DAYS', cast=int, default=[7, 14, 30])
 EMAIL_SIGNATURE = ENV.str('EMAIL_SIGNATURE', default='', multiline=True)
 EMAIL_ADMINS_ON_ALLOCATION_EXPIRE = ENV.bool('EMAIL_ADMINS_ON_ALLOCATION_EXPIRE', default=False)
+EMAIL_OUTBOX_ENABLED = ENV.bool('EMAIL_OUTBOX_ENABLED', default=False)
+EMAIL_OUTBOX_DELAY = ENV.int('EMAIL_OUTBOX_DELAY', default=10)
+EMAIL_OUTBOX_BATCH_SIZE = ENV.int('EMAIL_OUTBOX_BATCH_SIZE', default=100)
+EMAIL_OUTBOX_RATE_LIMIT = ENV.float('EMAIL_OUTBOX_RATE_LIMIT', default=0)
+EMAIL_OUTBOX_MAX_ATTEMPTS = ENV.int('EMAIL_OUTBOX_MAX_ATTEMPTS', default=5)
+EMAIL_OUTBOX_RETRY_DELAY = ENV.int('EMAIL_OUTBOX_RETRY_DELAY', default=60)
@@ -9,4 +9,7 @@ FREEIPA_KTNAME = ENV.str('FREEIPA_KTNAME')
 FREEIPA_SERVER = ENV.str('FREEIPA_SERVER')
 FREEIPA_USER_SEARCH_BASE = ENV.str('FREEIPA_USER_SEARCH_BASE')
 FREEIPA_ENABLE_SIGNALS = False
+FREEIPA_GROUP_MEMBER_BATCH_SIZE = ENV.int('FREEIPA_GROUP_MEMBER_BATCH_SIZE', default=100)
+FREEIPA_MEMBERSHIP_QUEUE_DELAY = ENV.int('FREEIPA_MEMBERSHIP_QUEUE_DELAY', default=30)
+FREEIPA_CONNECTION_MAX_IDLE = ENV.int('FREEIPA_CONNECTION_MAX_IDLE', default=300)
 ADDITIONAL_USER_SEARCH_CLASSES = ['coldfront.plugins.freeipa.search.LDAPUserSearch',]
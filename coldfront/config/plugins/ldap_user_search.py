@@ -2,7 +2,7 @@ from coldfront.config.env import ENV
 from django.core.exceptions import ImproperlyConfigured
 
 try:
-    import ldap
+    import ldap3
 except ImportError:
     raise ImproperlyConfigured('Please run: pip install ldap3')
 
@@ -20,5 +20,8 @@ LDAP_USER_SEARCH_USE_TLS = ENV.bool('LDAP_USER_SEARCH_USE_TLS', default=False)
 LDAP_USER_SEARCH_PRIV_KEY_FILE = ENV.str("LDAP_USER_SEARCH_PRIV_KEY_FILE", default=None)
 LDAP_USER_SEARCH_CERT_FILE = ENV.str("LDAP_USER_SEARCH_CERT_FILE", default=None)
 LDAP_USER_SEARCH_CACERT_FILE = ENV.str("LDAP_USER_SEARCH_CACERT_FILE", default=None)
+LDAP_USER_SEARCH_POOL_SIZE = ENV.int('LDAP_USER_SEARCH_POOL_SIZE', default=4)
+LDAP_USER_SEARCH_POOL_CHECK_INTERVAL = ENV.int('LDAP_USER_SEARCH_POOL_CHECK_INTERVAL', default=60)
+LDAP_USER_SEARCH_CACHE_TIMEOUT = ENV.int('LDAP_USER_SEARCH_CACHE_TIMEOUT', default=300)
 
 ADDITIONAL_USER_SEARCH_CLASSES = ['coldfront.plugins.ldap_user_search.utils.LDAPUserSearch']
@@ -9,3 +9,5 @@ SLURM_SACCTMGR_PATH = ENV.str('SLURM_SACCTMGR_PATH', default='/usr/bin/sacctmgr'
 SLURM_NOOP = ENV.bool('SLURM_NOOP', False)
 SLURM_IGNORE_USERS = ENV.list('SLURM_IGNORE_USERS', default=['root'])
 SLURM_IGNORE_ACCOUNTS = ENV.list('SLURM_IGNORE_ACCOUNTS', default=[])
+SLURM_CHECK_STATE_DIR = ENV.str('SLURM_CHECK_STATE_DIR', default='')
+SLURM_SACCTMGR_BATCH_SIZE = ENV.int('SLURM_SACCTMGR_BATCH_SIZE', default=500)
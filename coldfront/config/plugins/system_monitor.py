@@ -9,3 +9,5 @@ SYSTEM_MONITOR_PANEL_TITLE = ENV.str('SYSMON_TITLE', default='HPC Cluster Status
 SYSTEM_MONITOR_ENDPOINT = ENV.str('SYSMON_ENDPOINT')
 SYSTEM_MONITOR_DISPLAY_MORE_STATUS_INFO_LINK = ENV.str('SYSMON_LINK')
 SYSTEM_MONITOR_DISPLAY_XDMOD_LINK = ENV.str('SYSMON_XDMOD_LINK')
+SYSTEM_MONITOR_REFRESH_INTERVAL = ENV.int('SYSMON_REFRESH_INTERVAL', default=60)
+SYSTEM_MONITOR_MAX_AGE = ENV.int('SYSMON_MAX_AGE', default=3600)
@@ -9,3 +9,7 @@ INSTALLED_APPS += [
 ]
 
 XDMOD_API_URL = ENV.str('XDMOD_API_URL')
+XDMOD_MAX_WORKERS = ENV.int('XDMOD_MAX_WORKERS', default=8)
+XDMOD_REQUEST_TIMEOUT = ENV.int('XDMOD_REQUEST_TIMEOUT', default=60)
+XDMOD_MAX_RETRIES = ENV.int('XDMOD_MAX_RETRIES', default=3)
+XDMOD_RETRY_BACKOFF = ENV.float('XDMOD_RETRY_BACKOFF', default=1.0)
@@ -25,6 +25,7 @@ urlpatterns = [
     path('grant/', include('coldfront.core.grant.urls')),
     path('publication/', include('coldfront.core.publication.urls')),
     path('research-output/', include('coldfront.core.research_output.urls')),
+    path('export/', include('coldfront.core.utils.urls')),
 ]
 
 
@@ -17,6 +17,8 @@ from coldfront.core.allocation.models import (Allocation, AllocationAccount,
                                               AllocationUserNote,
                                               AllocationUserStatusChoice,
                                               AttributeType)
+from coldfront.core.project import access
+from coldfront.core.project.models import ProjectUserAccess
 
 
 @admin.register(AllocationStatusChoice)
@@ -270,18 +272,27 @@ class AllocationUserAdmin(SimpleHistoryAdmin):
         else:
             return super().get_inline_instances(request)
 
-    def set_active(self, request, queryset):
+    def _set_status(self, queryset, name):
+        # queryset.update() does not send the signals that keep the access
+        # index current. The users and projects are read before the update
+        # since the updated rows may no longer match the changelist filters
+        if ProjectUserAccess.is_enabled():
+            rows = list(queryset.values_list('user_id', 'allocation__project_id'))
         queryset.update(
-            status=AllocationUserStatusChoice.objects.get(name='Active'))
+            status=AllocationUserStatusChoice.objects.get(name=name))
+        if ProjectUserAccess.is_enabled():
+            access.rebuild(
+                users={user for user, project in rows},
+                projects={project for user, project in rows})
+
+    def set_active(self, request, queryset):
+        self._set_status(queryset, 'Active')
 
     def set_denied(self, request, queryset):
-        queryset.update(
-            status=AllocationUserStatusChoice.objects.get(name='Denied'))
+        self._set_status(queryset, 'Denied')
 
     def set_removed(self, request, queryset):
-
-        queryset.update(
-            status=AllocationUserStatusChoice.objects.get(name='Removed'))
+        self._set_status(queryset, 'Removed')
 
     set_active.short_description = "Set Selected User's Status To Active"
 
@@ -0,0 +1,69 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from coldfront.core import attribute_expansion
+from coldfront.core.allocation.models import (AllocationAttribute,
+                                              AttributeExpansionDependency)
+from coldfront.core.attribute_cache import attribute_cache
+from coldfront.core.resource.models import ResourceAttribute
+
+
+def _expandable(model, type_field):
+    return model.objects.filter(**{
+        type_field + '__attribute_type__name__startswith':
+            attribute_expansion.ATTRIBUTE_EXPANSION_TYPE_PREFIX,
+    }).select_related(type_field + '__attribute_type').order_by('pk')
+
+
+class Command(BaseCommand):
+    help = 'Rebuild or verify the stored expanded values of allocation and resource attributes'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--verify', action='store_true',
+            help='Compare stored expanded values with freshly expanded ones without writing')
+
+    def handle(self, *args, **options):
+        if not attribute_expansion.EXPANDED_VALUE_CACHE_ENABLED:
+            raise CommandError('EXPANDED_VALUE_CACHE_ENABLED is not set')
+
+        attributes = [
+            ('allocation', _expandable(AllocationAttribute, 'allocation_attribute_type')),
+            ('resource', _expandable(ResourceAttribute, 'resource_attribute_type')),
+        ]
+        if options['verify']:
+            self.verify(attributes)
+        else:
+            self.rebuild(attributes)
+
+    def rebuild(self, attributes):
+        start = time.monotonic()
+        AttributeExpansionDependency.objects.all().delete()
+        AllocationAttribute.objects.exclude(expanded_cache=None).update(expanded_cache=None)
+        ResourceAttribute.objects.exclude(expanded_cache=None).update(expanded_cache=None)
+
+        with attribute_cache():
+            for label, queryset in attributes:
+                count = 0
+                for attr in queryset:
+                    attr.expanded_value()
+                    count += 1
+                self.stdout.write('Expanded {} {} attributes'.format(count, label))
+
+        self.stdout.write('Rebuilt {} dependencies in {:.2f}s'.format(
+            AttributeExpansionDependency.objects.count(), time.monotonic() - start))
+
+    def verify(self, attributes):
+        mismatches = 0
+        for label, queryset in attributes:
+            for attr in queryset.exclude(expanded_cache=None):
+                expected = attr.expanded_value(use_cache=False)
+                if expected != attr.expanded_cache:
+                    mismatches += 1
+                    self.stdout.write('{} attribute {} ({}): stored {!r} expected {!r}'.format(
+                        label, attr.pk, attr, attr.expanded_cache, expected))
+
+        if mismatches:
+            raise CommandError('{} stored expanded values are stale'.format(mismatches))
+        self.stdout.write('All stored expanded values are current')
@@ -0,0 +1,34 @@
+# Generated by Django 4.2.11 on 2026-10-18 17:34
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('resource', '0003_resourceattribute_expanded_cache'),
+        ('allocation', '0005_auto_20211117_1413'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='allocationattribute',
+            name='expanded_cache',
+            field=models.TextField(blank=True, editable=False, null=True),
+        ),
+        migrations.CreateModel(
+            name='AttributeExpansionDependency',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=128)),
+                ('allocation', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='allocation.allocation')),
+                ('allocation_attribute', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='allocation.allocationattribute')),
+                ('resource', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='resource.resource')),
+                ('resource_attribute', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='resource.resourceattribute')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['allocation', 'name'], name='allocation__allocat_3d647f_idx'), models.Index(fields=['resource', 'name'], name='allocation__resourc_3aa912_idx')],
+            },
+        ),
+    ]
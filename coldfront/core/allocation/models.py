@@ -8,14 +8,17 @@ from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
 from django.db import models
+from django.db.models import Prefetch
 from django.utils.html import mark_safe
 from django.utils.module_loading import import_string
 from model_utils.models import TimeStampedModel
 from simple_history.models import HistoricalRecords
 
-from coldfront.core.project.models import Project, ProjectPermission
-from coldfront.core.resource.models import Resource
+from coldfront.core.project.models import (Project, ProjectPermission,
+                                           ProjectUserAccess)
+from coldfront.core.resource.models import Resource, ResourceAttribute
 from coldfront.core.utils.common import import_from_settings
+import coldfront.core.attribute_cache as attribute_cache
 import coldfront.core.attribute_expansion as attribute_expansion
 
 logger = logging.getLogger(__name__)
@@ -28,6 +31,25 @@ ALLOCATION_RESOURCE_ORDERING = import_from_settings(
     'ALLOCATION_RESOURCE_ORDERING',
     ['-is_allocatable', 'name'])
 
+
+def ordered_resources_prefetch(lookup='resources'):
+    """
+    Params:
+        lookup (str): lookup of the allocation resources, e.g. 'allocation__resources' when prefetching through allocation users
+
+    Returns:
+        Prefetch: loads the resources of allocations, with their type and attributes, into ordered_resources in ALLOCATION_RESOURCE_ORDERING order; used by get_parent_resource, get_resources_as_list and get_resources_as_string
+    """
+
+    return Prefetch(
+        lookup,
+        queryset=Resource.objects.select_related('resource_type').prefetch_related(
+            Prefetch('resourceattribute_set',
+                     queryset=ResourceAttribute.objects.select_related(
+                         'resource_attribute_type__attribute_type'))
+        ).order_by(*ALLOCATION_RESOURCE_ORDERING),
+        to_attr='ordered_resources')
+
 class AllocationPermission(Enum):
     """ A project permission stores the user and manager fields of a project. """
 
@@ -184,6 +206,9 @@ class Allocation(TimeStampedModel):
             str: the resources for the allocation
         """
 
+        if hasattr(self, 'ordered_resources'):
+            return ', '.join([ele.name for ele in self.ordered_resources])
+
         return ', '.join([ele.name for ele in self.resources.all().order_by(
             *ALLOCATION_RESOURCE_ORDERING)])
 
@@ -194,6 +219,9 @@ class Allocation(TimeStampedModel):
             list[Resource]: the resources for the allocation
         """
 
+        if hasattr(self, 'ordered_resources'):
+            return sorted(self.ordered_resources, key=lambda ele: not ele.is_allocatable)
+
         return [ele for ele in self.resources.all().order_by('-is_allocatable')]
 
     @property
@@ -203,6 +231,9 @@ class Allocation(TimeStampedModel):
             Resource: the parent resource for the allocation
         """
 
+        if hasattr(self, 'ordered_resources'):
+            return self.ordered_resources[0] if self.ordered_resources else None
+
         if self.resources.count() == 1:
             return self.resources.first()
         else:
@@ -226,8 +257,8 @@ class Allocation(TimeStampedModel):
             str: the value of the first attribute found for this allocation with the specified name
         """
 
-        attr = self.allocationattribute_set.filter(
-            allocation_attribute_type__name=name).first()
+        attrs = attribute_cache.get_attributes(self, name)
+        attr = attrs[0] if attrs else None
         if attr:
             if expand:
                 return attr.expanded_value(
@@ -276,8 +307,7 @@ class Allocation(TimeStampedModel):
             list: the list of values of the attributes found with specified name
         """
 
-        attr = self.allocationattribute_set.filter(
-            allocation_attribute_type__name=name).all()
+        attr = attribute_cache.get_attributes(self, name)
         if expand:
             return [a.expanded_value(typed=typed,
                 extra_allocations=extra_allocations) for a in attr]
@@ -301,10 +331,11 @@ class Allocation(TimeStampedModel):
 
         return self.allocationattribute_set.filter(allocation_attribute_type__is_private=False).order_by('allocation_attribute_type__name')
 
-    def user_permissions(self, user):
+    def user_permissions(self, user, use_index=None):
         """
         Params:
             user (User): user for whom to return permissions
+            use_index (bool): whether to read the access index, defaults to PROJECT_ACCESS_INDEX_ENABLED
 
         Returns:
             list[AllocationPermission]: list of user permissions for the allocation
@@ -313,7 +344,18 @@ class Allocation(TimeStampedModel):
         if user.is_superuser:
             return list(AllocationPermission)
 
-        project_perms = self.project.user_permissions(user)
+        if use_index is None:
+            use_index = ProjectUserAccess.is_enabled()
+
+        if use_index:
+            bits = ProjectUserAccess.objects.permissions(user, allocation=self)
+            if bits & ProjectUserAccess.MANAGER:
+                return [AllocationPermission.USER, AllocationPermission.MANAGER]
+            if bits & ProjectUserAccess.USER:
+                return [AllocationPermission.USER]
+            return []
+
+        project_perms = self.project.user_permissions(user, use_index=False)
 
         if ProjectPermission.USER not in project_perms:
             return []
@@ -426,22 +468,36 @@ class AllocationAttribute(TimeStampedModel):
         allocation_attribute_type (AllocationAttributeType): attribute type to link
         allocation (Allocation): allocation to link
         value (str): value of the allocation attribute
+        expanded_cache (str): stored expanded value, see EXPANDED_VALUE_CACHE_ENABLED
     """
 
     allocation_attribute_type = models.ForeignKey(
         AllocationAttributeType, on_delete=models.CASCADE)
     allocation = models.ForeignKey(Allocation, on_delete=models.CASCADE)
     value = models.CharField(max_length=128)
-    history = HistoricalRecords()
+    expanded_cache = models.TextField(null=True, blank=True, editable=False)
+    history = HistoricalRecords(excluded_fields=['expanded_cache'])
 
     def save(self, *args, **kwargs):
         """ Saves the allocation attribute. """
 
+        self.expanded_cache = None
         super().save(*args, **kwargs)
+        attribute_cache.invalidate(Allocation, self.allocation_id)
+        attribute_expansion.invalidate_expanded_values([
+            (('allocation', self.allocation_id), self.allocation_attribute_type.name)])
         if self.allocation_attribute_type.has_usage and not AllocationAttributeUsage.objects.filter(allocation_attribute=self).exists():
             AllocationAttributeUsage.objects.create(
                 allocation_attribute=self)
 
+    def delete(self, *args, **kwargs):
+        """ Deletes the allocation attribute. """
+
+        attribute_cache.invalidate(Allocation, self.allocation_id)
+        attribute_expansion.invalidate_expanded_values([
+            (('allocation', self.allocation_id), self.allocation_attribute_type.name)])
+        return super().delete(*args, **kwargs)
+
     def clean(self):
         """ Validates the allocation attribute and raises errors if the allocation attribute is invalid. """
 
@@ -482,11 +538,12 @@ class AllocationAttribute(TimeStampedModel):
             value=raw_value, type_name=atype_name)
                 
     
-    def expanded_value(self, extra_allocations=[], typed=True):
+    def expanded_value(self, extra_allocations=[], typed=True, use_cache=True):
         """
         Params:
             typed (bool): indicates whether or not to convert the attribute value to an int/ float/ str based on the base AttributeType name (unrecognized values not converted, so will return str)
             extra_allocations (list[Allocation]): allocations which are available to reference in the attribute list in addition to those associated with this ResourceAttribute
+            use_cache (bool): whether to read and store expanded_cache when EXPANDED_VALUE_CACHE_ENABLED is set; False always expands the value afresh
 
         Returns:
             int, float, str: the value of the attribute after attribute expansion
@@ -494,6 +551,8 @@ class AllocationAttribute(TimeStampedModel):
         For attributes with attribute type of 'Attribute Expanded Text' we look for an attribute with same name suffixed with '_attriblist' (this should be ResourceAttribute of the Resource associated with the attribute). If the attriblist attribute is found, we use it to generate a dictionary to use to expand the attribute value, and the expanded value is returned.  
 
         If the expansion fails, or if no attriblist attribute is found, or if the attribute type is not 'Attribute Expanded Text', we just return the raw value.
+
+        If EXPANDED_VALUE_CACHE_ENABLED is set and no extra_allocations are given, the expanded value is stored in expanded_cache and reused until an attribute it was computed from changes.
         """
 
         raw_value = self.value
@@ -506,10 +565,22 @@ class AllocationAttribute(TimeStampedModel):
             # We are not an expandable type, return raw_value
             return raw_value
 
+        store = use_cache and attribute_expansion.EXPANDED_VALUE_CACHE_ENABLED and not extra_allocations
+        if store and self.expanded_cache is not None:
+            return self.expanded_cache
+
         allocs = [ self.allocation ] + extra_allocations
         resources = list(self.allocation.resources.all())
         attrib_name = self.allocation_attribute_type.name
 
+        if store:
+            return attribute_expansion.expand_and_store(
+                attribute = self,
+                raw_value = raw_value,
+                attribute_name = attrib_name,
+                resources = resources,
+                allocations = allocs)
+
         attriblist = attribute_expansion.get_attriblist_str(
             attribute_name = attrib_name,
             resources = resources,
@@ -543,6 +614,31 @@ class AllocationAttributeUsage(TimeStampedModel):
     def __str__(self):
         return '{}: {}'.format(self.allocation_attribute.allocation_attribute_type.name, self.value)
 
+class AttributeExpansionDependency(models.Model):
+    """ An attribute expansion dependency records an attribute read while expanding the stored value of an allocation or resource attribute. Used to clear stored expanded values when the attributes they were computed from change.
+
+    Attributes:
+        allocation_attribute (AllocationAttribute): dependent allocation attribute, if any
+        resource_attribute (ResourceAttribute): dependent resource attribute, if any
+        allocation (Allocation): allocation the attribute was read from, if any
+        resource (Resource): resource the attribute was read from, if any
+        name (str): name of the attribute read
+    """
+
+    allocation_attribute = models.ForeignKey(
+        AllocationAttribute, on_delete=models.CASCADE, null=True)
+    resource_attribute = models.ForeignKey(
+        'resource.ResourceAttribute', on_delete=models.CASCADE, null=True)
+    allocation = models.ForeignKey(Allocation, on_delete=models.CASCADE, null=True)
+    resource = models.ForeignKey(Resource, on_delete=models.CASCADE, null=True)
+    name = models.CharField(max_length=128)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['allocation', 'name']),
+            models.Index(fields=['resource', 'name']),
+        ]
+
 class AllocationUserStatusChoice(TimeStampedModel):
     """ An allocation user status choice indicates the status of an allocation user. Examples include Active, Error, and Removed.
     
@@ -1,4 +1,9 @@
 import django.dispatch
+from django.db.models.signals import m2m_changed
+from django.dispatch import receiver
+
+from coldfront.core.allocation.models import Allocation, AllocationAttribute
+import coldfront.core.attribute_expansion as attribute_expansion
 
 allocation_new = django.dispatch.Signal()
     #providing_args=["allocation_pk"]
@@ -14,3 +19,25 @@ allocation_remove_user = django.dispatch.Signal()
 
 allocation_change_approved = django.dispatch.Signal()
     #providing_args=["allocation_pk", "allocation_change_pk"]
+
+
+@receiver(m2m_changed, sender=Allocation.resources.through)
+def invalidate_expanded_values(sender, instance, action, reverse, pk_set, **kwargs):
+    """Clears stored expanded values of allocations whose resources changed"""
+    if not attribute_expansion.EXPANDED_VALUE_CACHE_ENABLED:
+        return
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+
+    if not reverse:
+        allocation_pks = [instance.pk]
+    elif action == 'pre_clear':
+        allocation_pks = list(instance.allocation_set.values_list('pk', flat=True))
+    else:
+        allocation_pks = pk_set
+
+    attributes = AllocationAttribute.objects.filter(allocation_id__in=allocation_pks)
+    sources = {(('allocation', pk), name) for pk, name in attributes.values_list(
+        'allocation_id', 'allocation_attribute_type__name')}
+    attributes.update(expanded_cache=None)
+    attribute_expansion.invalidate_expanded_values(sources)
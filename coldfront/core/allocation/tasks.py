@@ -1,10 +1,21 @@
 import datetime
 # import the logging library
 import logging
-
-from coldfront.core.allocation.models import (Allocation,
-                                              AllocationStatusChoice)
-from coldfront.core.user.models import User
+import time
+
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Prefetch
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from django_q.tasks import async_task
+
+from coldfront.core.allocation.models import (ALLOCATION_RESOURCE_ORDERING,
+                                              Allocation,
+                                              AllocationAttribute,
+                                              AllocationStatusChoice,
+                                              AllocationUser)
+from coldfront.core.project.models import ProjectUser
+from coldfront.core.resource.models import Resource
 from coldfront.core.utils.common import import_from_settings
 from coldfront.core.utils.mail import send_email_template
 
@@ -26,170 +37,230 @@ EMAIL_ALLOCATION_EXPIRING_NOTIFICATION_DAYS = import_from_settings(
 EMAIL_ADMINS_ON_ALLOCATION_EXPIRE = import_from_settings('EMAIL_ADMINS_ON_ALLOCATION_EXPIRE')
 EMAIL_ADMIN_LIST = import_from_settings('EMAIL_ADMIN_LIST')
 
-def update_statuses():
+ALLOCATION_FUNCS_ON_EXPIRE = import_from_settings(
+    'ALLOCATION_FUNCS_ON_EXPIRE', [])
+ALLOCATION_EXPIRE_BATCH_SIZE = import_from_settings(
+    'ALLOCATION_EXPIRE_BATCH_SIZE', 500)
 
+def update_statuses():
+    """Expires allocations past their end date
+
+    Statuses are changed in a single UPDATE and the history records are
+    written in bulk. ALLOCATION_FUNCS_ON_EXPIRE are queued as django-q
+    tasks, each receiving a batch of ALLOCATION_EXPIRE_BATCH_SIZE
+    allocation pks.
+    """
+    start = time.monotonic()
     expired_status_choice = AllocationStatusChoice.objects.get(
         name='Expired')
-    allocations_to_expire = Allocation.objects.filter(
-        status__name__in=['Active','Payment Pending','Payment Requested', 'Unpaid',], end_date__lt=datetime.datetime.now().date())
-    for sub_obj in allocations_to_expire:
-        sub_obj.status = expired_status_choice
-        sub_obj.save()
 
-    logger.info('Allocations set to expired: {}'.format(
-        allocations_to_expire.count()))
+    with transaction.atomic():
+        allocations_to_expire = list(Allocation.objects.select_for_update().filter(
+            status__name__in=['Active','Payment Pending','Payment Requested', 'Unpaid',], end_date__lt=datetime.datetime.now().date()))
+        pks = [sub_obj.pk for sub_obj in allocations_to_expire]
+
+        now = timezone.now()
+        Allocation.objects.filter(pk__in=pks).update(
+            status=expired_status_choice, modified=now)
+
+        for sub_obj in allocations_to_expire:
+            sub_obj.status = expired_status_choice
+            sub_obj.modified = now
+        Allocation.history.bulk_history_create(
+            allocations_to_expire, batch_size=ALLOCATION_EXPIRE_BATCH_SIZE,
+            update=True, default_change_reason='Allocation expired')
+    updated = time.monotonic()
+
+    hook_tasks = 0
+    if ALLOCATION_FUNCS_ON_EXPIRE:
+        for i in range(0, len(pks), ALLOCATION_EXPIRE_BATCH_SIZE):
+            async_task('coldfront.core.allocation.tasks.run_expire_funcs',
+                       pks[i:i + ALLOCATION_EXPIRE_BATCH_SIZE])
+            hook_tasks += 1
+
+    logger.info('Allocations set to expired: %s in %.2fs, queued %s expire task(s) in %.2fs',
+                len(pks), updated - start, hook_tasks, time.monotonic() - updated)
+
+    return {
+        'expired': len(pks),
+        'hook_tasks': hook_tasks,
+        'seconds': round(time.monotonic() - start, 3),
+    }
+
+
+def run_expire_funcs(allocation_pks):
+    """Runs ALLOCATION_FUNCS_ON_EXPIRE for each of allocation_pks"""
+    funcs = [import_string(func_string) for func_string in ALLOCATION_FUNCS_ON_EXPIRE]
+    for allocation_pk in allocation_pks:
+        for func_to_run in funcs:
+            func_to_run(allocation_pk)
+
+
+def _notification_recipients(allocations, attribute_names):
+    """Returns the active allocation users of allocations to notify
+
+    Only users who are active on the allocation's project and have
+    notifications enabled are returned, ordered by user. Allocations come
+    with their resources in parent resource order and their attributes
+    named in attribute_names prefetched into notification_attributes.
+    """
+    notify = ProjectUser.objects.filter(
+        project=OuterRef('allocation__project'),
+        user=OuterRef('user'),
+        status__name='Active',
+        enable_notifications=True)
+
+    return AllocationUser.objects.filter(
+        allocation__in=allocations,
+        status__name='Active',
+    ).filter(
+        Exists(notify)
+    ).select_related(
+        'user', 'allocation__status', 'allocation__project__pi'
+    ).prefetch_related(
+        Prefetch('allocation__resources',
+                 queryset=Resource.objects.order_by(*ALLOCATION_RESOURCE_ORDERING)),
+        Prefetch('allocation__allocationattribute_set',
+                 queryset=AllocationAttribute.objects.filter(
+                     allocation_attribute_type__name__in=attribute_names
+                 ).select_related('allocation_attribute_type').order_by('pk'),
+                 to_attr='notification_attributes'),
+    ).order_by('user_id', 'pk')
+
+
+def _notification_value(allocation, name):
+    """Returns value of the first prefetched notification attribute named name"""
+    for attribute in allocation.notification_attributes:
+        if attribute.allocation_attribute_type.name == name:
+            return attribute.value
+    return None
+
+
+def _parent_resource_name(allocation):
+    """Returns name of the parent resource from the prefetched resources"""
+    resources = allocation.resources.all()
+    return resources[0].name if resources else ''
 
 
 def send_expiry_emails():
+    base_url = CENTER_BASE_URL.strip("/")
+    expiration_days = sorted(set(EMAIL_ALLOCATION_EXPIRING_NOTIFICATION_DAYS))
+
     #Allocations expiring soon
-    for user in User.objects.all():
+    today = datetime.datetime.today()
+    days_by_end_date = {
+        (today + datetime.timedelta(days=days_remaining)).date(): days_remaining
+        for days_remaining in expiration_days
+    }
+    expiring_allocations = Allocation.objects.filter(
+        status__name__in=['Active', 'Payment Pending', 'Payment Requested', 'Unpaid'],
+        end_date__in=list(days_by_end_date))
+
+    recipients = {}
+    for allocationuser in _notification_recipients(
+            expiring_allocations, ['EXPIRE NOTIFICATION', 'CLOUD_USAGE_NOTIFICATION']):
+        allocation = allocationuser.allocation
+        if _notification_value(allocation, 'EXPIRE NOTIFICATION') == 'No':
+            continue
+        if _notification_value(allocation, 'CLOUD_USAGE_NOTIFICATION') == 'No':
+            continue
+        recipients.setdefault(allocationuser.user, []).append(
+            (days_by_end_date[allocation.end_date], allocation))
+
+    for user, expiring in recipients.items():
         projectdict = {}
         expirationdict = {}
-        email_receiver_list = []
-        for days_remaining in sorted(set(EMAIL_ALLOCATION_EXPIRING_NOTIFICATION_DAYS)):
-
-            expring_in_days = (datetime.datetime.today(
-                ) + datetime.timedelta(days=days_remaining)).date()
-                       
-            for allocationuser in user.allocationuser_set.all():
-                allocation = allocationuser.allocation
-
-                if (((allocation.status.name in ['Active', 'Payment Pending', 'Payment Requested', 'Unpaid']) and (allocation.end_date == expring_in_days))):
-                    
-                    project_url = f'{CENTER_BASE_URL.strip("/")}/{"project"}/{allocation.project.pk}/'
-
-                    if (allocation.status.name in ['Payment Pending', 'Payment Requested', 'Unpaid']):
-                        allocation_renew_url = f'{CENTER_BASE_URL.strip("/")}/{"allocation"}/{allocation.pk}/'
-                    else:
-                        allocation_renew_url = f'{CENTER_BASE_URL.strip("/")}/{"allocation"}/{allocation.pk}/{"renew"}/'
-
-                    resource_name = allocation.get_parent_resource.name
-
-                    template_context = {
-                        'center_name': CENTER_NAME,
-                        'expring_in_days': days_remaining,
-                        'project_dict': projectdict,
-                        'expiration_dict': expirationdict,
-                        'expiration_days': sorted(set(EMAIL_ALLOCATION_EXPIRING_NOTIFICATION_DAYS)),
-                        'project_renewal_help_url': CENTER_PROJECT_RENEWAL_HELP_URL,
-                        'opt_out_instruction_url': EMAIL_OPT_OUT_INSTRUCTION_URL,
-                        'signature': EMAIL_SIGNATURE
-                    }
-                    
-                    expire_notification = allocation.allocationattribute_set.filter(
-                        allocation_attribute_type__name='EXPIRE NOTIFICATION').first()
-                    if expire_notification and expire_notification.value == 'No':
-                        continue
-
-                    cloud_usage_notification = allocation.allocationattribute_set.filter(
-                        allocation_attribute_type__name='CLOUD_USAGE_NOTIFICATION').first()
-                    if cloud_usage_notification and cloud_usage_notification.value == 'No':
-                        continue
-
-                    for projectuser in allocation.project.projectuser_set.filter(user=user, status__name='Active'): 
-                        if ((projectuser.enable_notifications) and 
-                            (allocationuser.user == user and allocationuser.status.name == 'Active')):
-
-                            if (user.email not in email_receiver_list):
-                                email_receiver_list.append(user.email)
-
-                            if days_remaining not in expirationdict:
-                                expirationdict[days_remaining] = []
-                                expirationdict[days_remaining].append((project_url, allocation_renew_url, resource_name))
-                            else:
-                                expirationdict[days_remaining].append((project_url, allocation_renew_url, resource_name))
-
-                            if allocation.project.title not in projectdict:
-                                projectdict[allocation.project.title] = (project_url, allocation.project.pi.username,)
-                            
-        if email_receiver_list:
-
-            send_email_template(f'Your access to {CENTER_NAME}\'s resources is expiring soon',
-                        'email/allocation_expiring.txt',
-                        template_context,
-                        EMAIL_SENDER,
-                        email_receiver_list
-                        ) 
-
-            logger.debug(f'Allocation(s) expiring in soon, email sent to user {user}.')
+        # Group by notification day first, as the template lists them in order
+        expiring.sort(key=lambda entry: entry[0])
+        for days_remaining, allocation in expiring:
+            project_url = f'{base_url}/{"project"}/{allocation.project.pk}/'
+
+            if (allocation.status.name in ['Payment Pending', 'Payment Requested', 'Unpaid']):
+                allocation_renew_url = f'{base_url}/{"allocation"}/{allocation.pk}/'
+            else:
+                allocation_renew_url = f'{base_url}/{"allocation"}/{allocation.pk}/{"renew"}/'
+
+            expirationdict.setdefault(days_remaining, []).append(
+                (project_url, allocation_renew_url, _parent_resource_name(allocation)))
+
+            if allocation.project.title not in projectdict:
+                projectdict[allocation.project.title] = (project_url, allocation.project.pi.username,)
+
+        template_context = {
+            'center_name': CENTER_NAME,
+            'expring_in_days': days_remaining,
+            'project_dict': projectdict,
+            'expiration_dict': expirationdict,
+            'expiration_days': expiration_days,
+            'project_renewal_help_url': CENTER_PROJECT_RENEWAL_HELP_URL,
+            'opt_out_instruction_url': EMAIL_OPT_OUT_INSTRUCTION_URL,
+            'signature': EMAIL_SIGNATURE
+        }
+
+        send_email_template(f'Your access to {CENTER_NAME}\'s resources is expiring soon',
+                    'email/allocation_expiring.txt',
+                    template_context,
+                    EMAIL_SENDER,
+                    [user.email]
+                    )
+
+        logger.debug(f'Allocation(s) expiring in soon, email sent to user {user}.')
 
     #Allocations expired
     admin_projectdict = {}
     admin_allocationdict = {}
-    for user in User.objects.all():
+    expired_allocations = Allocation.objects.filter(
+        end_date=(today + datetime.timedelta(days=-1)).date())
+
+    recipients = {}
+    for allocationuser in _notification_recipients(
+            expired_allocations, ['EXPIRE NOTIFICATION']):
+        allocation = allocationuser.allocation
+        project_url = f'{base_url}/{"project"}/{allocation.project.pk}/'
+        resource_name = _parent_resource_name(allocation)
+
+        if _notification_value(allocation, 'EXPIRE NOTIFICATION') == 'Yes':
+            recipients.setdefault(allocationuser.user, []).append(allocation)
+
+        if EMAIL_ADMINS_ON_ALLOCATION_EXPIRE:
+            allocation_url = f'{base_url}/{"allocation"}/{allocation.pk}/'
+            entry = {allocation_url : resource_name}
+            if entry not in admin_allocationdict.setdefault(project_url, []):
+                admin_allocationdict[project_url].append(entry)
+
+            if allocation.project.title not in admin_projectdict:
+                admin_projectdict[allocation.project.title] = (project_url, allocation.project.pi.username)
+
+    for user, expired in recipients.items():
         projectdict = {}
         allocationdict = {}
-        email_receiver_list = []
-        
-        expring_in_days = (datetime.datetime.today() + datetime.timedelta(days=-1)).date()
-                
-        for allocationuser in user.allocationuser_set.all():
-            allocation = allocationuser.allocation
-
-            if (allocation.end_date == expring_in_days):
-                
-                project_url = f'{CENTER_BASE_URL.strip("/")}/{"project"}/{allocation.project.pk}/'
-
-                allocation_renew_url = f'{CENTER_BASE_URL.strip("/")}/{"allocation"}/{allocation.pk}/{"renew"}/'
-
-                allocation_url = f'{CENTER_BASE_URL.strip("/")}/{"allocation"}/{allocation.pk}/'
-
-                resource_name = allocation.get_parent_resource.name
-
-                template_context = {
-                    'center_name': CENTER_NAME,
-                    'project_dict': projectdict,
-                    'allocation_dict': allocationdict,
-                    'project_renewal_help_url': CENTER_PROJECT_RENEWAL_HELP_URL,
-                    'opt_out_instruction_url': EMAIL_OPT_OUT_INSTRUCTION_URL,
-                    'signature': EMAIL_SIGNATURE
-                }
-
-                expire_notification = allocation.allocationattribute_set.filter(
-                    allocation_attribute_type__name='EXPIRE NOTIFICATION').first()
-
-                for projectuser in allocation.project.projectuser_set.filter(user=user, status__name='Active'): 
-                    if ((projectuser.enable_notifications) and 
-                        (allocationuser.user == user and allocationuser.status.name == 'Active')):
-
-                        if expire_notification and expire_notification.value == 'Yes':
-
-                            if (user.email not in email_receiver_list):
-                                email_receiver_list.append(user.email)
-
-                            if project_url not in allocationdict:
-                                    allocationdict[project_url] = []
-                                    allocationdict[project_url].append({allocation_renew_url : resource_name})
-                            else:
-                                if {allocation_renew_url : resource_name} not in allocationdict[project_url]:
-                                    allocationdict[project_url].append({allocation_renew_url : resource_name})
-
-                            if allocation.project.title not in projectdict:
-                                projectdict[allocation.project.title] = (project_url, allocation.project.pi.username)
-
-                        if EMAIL_ADMINS_ON_ALLOCATION_EXPIRE:
-                            
-                            if project_url not in admin_allocationdict:
-                                    admin_allocationdict[project_url] = []
-                                    admin_allocationdict[project_url].append({allocation_url : resource_name})
-                            else:
-                                if {allocation_url : resource_name} not in admin_allocationdict[project_url]:
-                                    admin_allocationdict[project_url].append({allocation_url : resource_name})
-
-                            if allocation.project.title not in admin_projectdict:
-                                admin_projectdict[allocation.project.title] = (project_url, allocation.project.pi.username)
-
-                            
-        if email_receiver_list:
-
-            send_email_template('Your access to resource(s) have expired',
-                        'email/allocation_expired.txt',
-                        template_context,
-                        EMAIL_SENDER,
-                        email_receiver_list
-                        ) 
-
-            logger.debug(f'Allocation(s) expired email sent to user {user}.')
+        for allocation in expired:
+            project_url = f'{base_url}/{"project"}/{allocation.project.pk}/'
+            allocation_renew_url = f'{base_url}/{"allocation"}/{allocation.pk}/{"renew"}/'
+            entry = {allocation_renew_url : _parent_resource_name(allocation)}
+            if entry not in allocationdict.setdefault(project_url, []):
+                allocationdict[project_url].append(entry)
+
+            if allocation.project.title not in projectdict:
+                projectdict[allocation.project.title] = (project_url, allocation.project.pi.username)
+
+        template_context = {
+            'center_name': CENTER_NAME,
+            'project_dict': projectdict,
+            'allocation_dict': allocationdict,
+            'project_renewal_help_url': CENTER_PROJECT_RENEWAL_HELP_URL,
+            'opt_out_instruction_url': EMAIL_OPT_OUT_INSTRUCTION_URL,
+            'signature': EMAIL_SIGNATURE
+        }
+
+        send_email_template('Your access to resource(s) have expired',
+                    'email/allocation_expired.txt',
+                    template_context,
+                    EMAIL_SENDER,
+                    [user.email]
+                    )
+
+        logger.debug(f'Allocation(s) expired email sent to user {user}.')
 
     if EMAIL_ADMINS_ON_ALLOCATION_EXPIRE:
 
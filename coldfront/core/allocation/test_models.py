@@ -1,8 +1,31 @@
 """Unit tests for the allocation models"""
 
+from io import StringIO
+from unittest import mock
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.test import TestCase
 
-from coldfront.core.test_helpers.factories import AllocationFactory, ResourceFactory
+from coldfront.core import attribute_expansion
+from coldfront.core.allocation.models import (
+    Allocation,
+    AllocationAttribute,
+    AttributeExpansionDependency,
+)
+from coldfront.core.attribute_cache import attribute_cache
+from coldfront.core.resource.models import (
+    AttributeType,
+    ResourceAttribute,
+    ResourceAttributeType,
+)
+from coldfront.core.test_helpers.factories import (
+    AAttributeTypeFactory,
+    AllocationFactory,
+    AllocationAttributeFactory,
+    AllocationAttributeTypeFactory,
+    ResourceFactory,
+)
 
 
 class AllocationModelTests(TestCase):
@@ -21,3 +44,240 @@ class AllocationModelTests(TestCase):
             self.allocation.project.pi
         )
         self.assertEqual(str(self.allocation), allocation_str)
+
+
+class AllocationAttributeCacheTests(TestCase):
+    """tests for attribute lookups inside an attribute_cache block"""
+
+    @classmethod
+    def setUpTestData(cls):
+        """Set up allocation with two attributes"""
+        cls.allocation = AllocationFactory()
+        cls.allocation.resources.add(ResourceFactory(name='holylfs07/tier1'))
+        AllocationAttributeFactory(
+            allocation=cls.allocation,
+            allocation_attribute_type=AllocationAttributeTypeFactory(name='quota'),
+            value=100)
+        AllocationAttributeFactory(
+            allocation=cls.allocation,
+            allocation_attribute_type=AllocationAttributeTypeFactory(name='group'),
+            value=200)
+
+    def test_cached_lookups_use_one_query(self):
+        """test that repeated lookups are answered from the cache"""
+        with attribute_cache():
+            with self.assertNumQueries(1):
+                self.assertEqual(self.allocation.get_attribute('quota'), 100)
+                self.assertEqual(self.allocation.get_attribute('group'), 200)
+                self.assertEqual(self.allocation.get_attribute_list('quota'), [100])
+                self.assertIsNone(self.allocation.get_attribute('missing'))
+
+    def test_save_invalidates_cache(self):
+        """test that saving an attribute invalidates the cached entry"""
+        with attribute_cache():
+            self.assertEqual(self.allocation.get_attribute('quota'), 100)
+            attr = self.allocation.allocationattribute_set.get(
+                allocation_attribute_type__name='quota')
+            attr.value = 300
+            attr.save()
+            self.assertEqual(self.allocation.get_attribute('quota'), 300)
+            attr.delete()
+            self.assertIsNone(self.allocation.get_attribute('quota'))
+
+
+class AttributeExpansionTests(TestCase):
+    """tests for expanded_value with compiled attriblists"""
+
+    ATTRIBLIST = """
+        # comment
+        cpus := :cpus
+        cpus *= RESOURCE:cpu_factor
+        cpus /= 3
+        cpus (= floor
+        acct := 'acct_'
+        acct += ALLOCATION:slurm_account
+        """
+
+    @classmethod
+    def setUpTestData(cls):
+        """Set up an allocation with an expandable attribute"""
+        cls.allocation = AllocationFactory()
+        cls.resource = ResourceFactory(name='cluster')
+        cls.allocation.resources.add(cls.resource)
+        for name, type_name, value in [('cpu_factor', 'Int', '4'),
+                                       ('spec_attriblist', 'Text', cls.ATTRIBLIST)]:
+            ResourceAttribute.objects.create(
+                resource=cls.resource,
+                resource_attribute_type=ResourceAttributeType.objects.create(
+                    name=name,
+                    attribute_type=AttributeType.objects.get_or_create(name=type_name)[0]),
+                value=value)
+        for name, type_name, value in [('cpus', 'Int', 10),
+                                       ('slurm_account', 'Text', 'physics')]:
+            AllocationAttributeFactory(
+                allocation=cls.allocation,
+                allocation_attribute_type=AllocationAttributeTypeFactory(
+                    name=name, attribute_type=AAttributeTypeFactory(name=type_name)),
+                value=value)
+        cls.spec = AllocationAttributeFactory(
+            allocation=cls.allocation,
+            allocation_attribute_type=AllocationAttributeTypeFactory(
+                name='spec',
+                attribute_type=AAttributeTypeFactory(name='Attribute Expanded Text')),
+            value='{acct}:{cpus}')
+
+    def setUp(self):
+        attribute_expansion.compile_attriblist.cache_clear()
+
+    def test_expanded_value(self):
+        """test that the attriblist statements are evaluated in order"""
+        self.assertEqual(self.spec.expanded_value(), 'acct_physics:13')
+
+    def test_compiled_once(self):
+        """test that an attriblist is parsed once for repeated expansions"""
+        for _ in range(3):
+            self.spec.expanded_value()
+        info = attribute_expansion.compile_attriblist.cache_info()
+        self.assertEqual((info.misses, info.hits), (1, 2))
+
+    def test_matches_statement_by_statement_processing(self):
+        """test that compiled programs give the same dictionary as processing each line"""
+        kwargs = {'resources': [self.resource], 'allocations': [self.allocation]}
+        apdict = {}
+        for line in self.ATTRIBLIST.splitlines():
+            attribute_expansion.process_attribute_parameter_string(
+                line.strip(), 'spec', apdict, **kwargs)
+        self.assertEqual(attribute_expansion.make_attribute_parameter_dictionary(
+            'spec', self.ATTRIBLIST, **kwargs), apdict)
+        self.assertEqual(apdict['cpus'], 13)
+
+    def test_argument_kinds(self):
+        """test that arguments are classified when compiled"""
+        program = attribute_expansion.compile_attriblist(
+            "a := 'text'\nb := 2.5\nc := :name\nd := 'open\ne := bogus\nf (= floor")
+        self.assertEqual([(s.pname, s.opcode, s.kind, s.argument) for s in program], [
+            ('a', ':', attribute_expansion.ARGUMENT_LITERAL, 'text'),
+            ('b', ':', attribute_expansion.ARGUMENT_LITERAL, 2.5),
+            ('c', ':', ':', 'name'),
+            ('d', ':', attribute_expansion.ARGUMENT_BAD_LITERAL, "'open"),
+            ('e', ':', attribute_expansion.ARGUMENT_UNKNOWN, 'bogus'),
+            ('f', '(', attribute_expansion.ARGUMENT_FUNCTION, 'floor'),
+        ])
+
+    def test_batch_expansion(self):
+        """test that batch expansion matches expanded_value without per-value queries"""
+        allocations = [self.allocation]
+        for cpus in [20, 30]:
+            allocation = Allocation.objects.create(
+                project=self.allocation.project, status=self.allocation.status)
+            allocation.resources.add(self.resource)
+            for name, value in [('cpus', cpus), ('slurm_account', 'chemistry')]:
+                AllocationAttributeFactory(
+                    allocation=allocation,
+                    allocation_attribute_type=AllocationAttributeTypeFactory(name=name),
+                    value=value)
+            AllocationAttributeFactory(
+                allocation=allocation,
+                allocation_attribute_type=self.spec.allocation_attribute_type,
+                value='{acct}:{cpus}')
+            allocations.append(allocation)
+        expected = [a.get_attribute('spec') for a in allocations]
+
+        with self.assertNumQueries(5):
+            batch = attribute_expansion.AttributeExpansionBatch(
+                Allocation.objects.filter(pk__in=[a.pk for a in allocations]).order_by('pk'),
+                ['spec'])
+            values = [batch.get_attribute(a, 'spec') for a in batch.allocations]
+            self.assertEqual(batch.get_resource_attribute(self.resource, 'cpu_factor'), 4)
+        self.assertEqual(values, expected)
+        self.assertEqual(values, ['acct_physics:13', 'acct_chemistry:26', 'acct_chemistry:40'])
+
+
+class ExpandedValueStoreTests(TestCase):
+    """tests for stored expanded values and their invalidation"""
+
+    @classmethod
+    def setUpTestData(cls):
+        """Set up an allocation whose expansion reads a resource and an allocation attribute"""
+        text = AttributeType.objects.get_or_create(name='Text')[0]
+        expanded = AttributeType.objects.get_or_create(name='Attribute Expanded Text')[0]
+        cls.allocation = AllocationFactory()
+        cls.resource = ResourceFactory(name='cluster')
+        cls.allocation.resources.add(cls.resource)
+        cls.resource_attrs = {}
+        for name, attribute_type, value in [
+                ('partition', text, 'batch'),
+                ('qos', expanded, '{partition}-qos'),
+                ('qos_attriblist', text, 'partition := :partition'),
+                ('spec_attriblist', text, 'acct := ALLOCATION:slurm_account\nqos := RESOURCE:qos')]:
+            cls.resource_attrs[name] = ResourceAttribute.objects.create(
+                resource=cls.resource,
+                resource_attribute_type=ResourceAttributeType.objects.create(
+                    name=name, attribute_type=attribute_type),
+                value=value)
+        cls.account = AllocationAttributeFactory(
+            allocation=cls.allocation,
+            allocation_attribute_type=AllocationAttributeTypeFactory(
+                name='slurm_account', attribute_type=AAttributeTypeFactory(name='Text')),
+            value='physics')
+        cls.spec = AllocationAttributeFactory(
+            allocation=cls.allocation,
+            allocation_attribute_type=AllocationAttributeTypeFactory(
+                name='spec',
+                attribute_type=AAttributeTypeFactory(name='Attribute Expanded Text')),
+            value='{acct}:{qos}')
+
+    def setUp(self):
+        patcher = mock.patch.object(attribute_expansion, 'EXPANDED_VALUE_CACHE_ENABLED', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _spec(self):
+        return AllocationAttribute.objects.select_related(
+            'allocation_attribute_type__attribute_type').get(pk=self.spec.pk)
+
+    def test_value_is_stored_with_dependencies(self):
+        """test that the expanded value is stored and reused"""
+        self.assertEqual(self.allocation.get_attribute('spec'), 'physics:batch-qos')
+        spec = self._spec()
+        self.assertEqual(spec.expanded_cache, 'physics:batch-qos')
+        self.assertEqual(set(AttributeExpansionDependency.objects.filter(
+            allocation_attribute=spec).values_list('allocation_id', 'resource_id', 'name')), {
+            (None, self.resource.pk, 'spec_attriblist'),
+            (self.allocation.pk, None, 'spec_attriblist'),
+            (self.allocation.pk, None, 'slurm_account'),
+            (None, self.resource.pk, 'qos'),
+        })
+        with self.assertNumQueries(0):
+            self.assertEqual(spec.expanded_value(), 'physics:batch-qos')
+
+    def test_changes_clear_dependents(self):
+        """test that changed attributes clear stored values depending on them"""
+        self.allocation.get_attribute('spec')
+
+        account = AllocationAttribute.objects.get(pk=self.account.pk)
+        account.value = 'chemistry'
+        account.save()
+        self.assertIsNone(self._spec().expanded_cache)
+        self.assertEqual(self.allocation.get_attribute('spec'), 'chemistry:batch-qos')
+
+        # Cleared through the resource attribute qos, which reads partition
+        partition = self.resource_attrs['partition']
+        partition.value = 'gpu'
+        partition.save()
+        self.assertIsNone(self._spec().expanded_cache)
+        self.assertEqual(self.allocation.get_attribute('spec'), 'chemistry:gpu-qos')
+
+        self.allocation.resources.remove(self.resource)
+        self.assertIsNone(self._spec().expanded_cache)
+        self.assertEqual(self.allocation.get_attribute('spec'), '{acct}:{qos}')
+
+    def test_rebuild_and_verify_command(self):
+        """test that the command stores all values and detects stale ones"""
+        call_command('rebuild_expanded_values', stdout=StringIO())
+        self.assertEqual(self._spec().expanded_cache, 'physics:batch-qos')
+        call_command('rebuild_expanded_values', '--verify', stdout=StringIO())
+
+        AllocationAttribute.objects.filter(pk=self.account.pk).update(value='chemistry')
+        with self.assertRaises(CommandError):
+            call_command('rebuild_expanded_values', '--verify', stdout=StringIO())
@@ -0,0 +1,217 @@
+"""Unit tests for the allocation tasks"""
+
+import datetime
+from unittest import mock
+
+from django.core import mail
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from coldfront.core.allocation import tasks
+from coldfront.core.allocation.models import Allocation, AllocationStatusChoice
+from coldfront.core.test_helpers.factories import (
+    AllocationAttributeFactory,
+    AllocationAttributeTypeFactory,
+    AllocationUserFactory,
+    AllocationUserStatusChoiceFactory,
+    ProjectFactory,
+    ProjectUserFactory,
+    ResourceFactory,
+    UserFactory,
+)
+
+
+def _days(n):
+    return (datetime.datetime.today() + datetime.timedelta(days=n)).date()
+
+
+class SendExpiryEmailsTests(TestCase):
+    """tests for send_expiry_emails"""
+
+    @classmethod
+    def setUpTestData(cls):
+        """Set up allocations expiring soon and expired yesterday"""
+        cls.alice = UserFactory(username='alice')
+        cls.bob = UserFactory(username='bob')
+        cls.carol = UserFactory(username='carol')
+        cls.dave = UserFactory(username='dave')
+        cls.cluster = ResourceFactory(name='cluster')
+        cls.storage = ResourceFactory(name='storage')
+
+        cls.lab1 = ProjectFactory(title='lab1', pi=cls.alice)
+        cls.lab2 = ProjectFactory(title='lab2', pi=cls.bob)
+        for project, users in [(cls.lab1, [cls.alice, cls.carol, cls.dave]),
+                               (cls.lab2, [cls.bob, cls.alice])]:
+            for user in users:
+                ProjectUserFactory(project=project, user=user)
+        cls.lab1.projectuser_set.filter(user=cls.carol).update(
+            enable_notifications=False)
+
+        removed = AllocationUserStatusChoiceFactory(name='Removed')
+        cls.expiring = cls._allocation(
+            cls.lab1, 'Active', 7, [cls.cluster, cls.storage],
+            [cls.alice, cls.carol])
+        AllocationUserFactory(
+            allocation=cls.expiring, user=cls.dave, status=removed)
+        cls._allocation(cls.lab2, 'Payment Pending', 7, [cls.cluster],
+                        [cls.bob, cls.alice])
+        cls._allocation(cls.lab1, 'Active', 30, [cls.storage], [cls.alice])
+        opted_out = cls._allocation(
+            cls.lab2, 'Active', 7, [cls.storage], [cls.bob])
+        cls._attribute(opted_out, 'EXPIRE NOTIFICATION', 'No')
+        cls._allocation(cls.lab2, 'Denied', 7, [cls.storage], [cls.bob])
+
+        cls.expired = cls._allocation(
+            cls.lab1, 'Expired', -1, [cls.cluster], [cls.alice, cls.carol])
+        cls._attribute(cls.expired, 'EXPIRE NOTIFICATION', 'Yes')
+        cls._allocation(cls.lab2, 'Expired', -1, [cls.storage], [cls.bob])
+
+    @classmethod
+    def _allocation(cls, project, status, days, resources, users):
+        allocation = Allocation.objects.create(
+            project=project,
+            status=AllocationStatusChoice.objects.get_or_create(name=status)[0],
+            start_date=_days(-365),
+            end_date=_days(days),
+            justification='test')
+        allocation.resources.add(*resources)
+        for user in users:
+            AllocationUserFactory(allocation=allocation, user=user)
+        return allocation
+
+    @classmethod
+    def _attribute(cls, allocation, name, value):
+        AllocationAttributeFactory(
+            allocation=allocation,
+            allocation_attribute_type=AllocationAttributeTypeFactory(name=name),
+            value=value)
+
+    def setUp(self):
+        for patcher in [
+                mock.patch('coldfront.core.utils.mail.EMAIL_ENABLED', True),
+                mock.patch.object(tasks, 'EMAIL_ALLOCATION_EXPIRING_NOTIFICATION_DAYS', [30, 7]),
+                mock.patch.object(tasks, 'EMAIL_ADMINS_ON_ALLOCATION_EXPIRE', True),
+                mock.patch.object(tasks, 'EMAIL_SENDER', 'coldfront@example.com'),
+                mock.patch.object(tasks, 'EMAIL_ADMIN_LIST', 'admin@example.com'),
+                mock.patch.object(tasks, 'CENTER_BASE_URL', 'https://coldfront/')]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _emails(self):
+        return [(m.subject.split('] ')[-1], m.to, m.body) for m in mail.outbox]
+
+    def test_expiring_and_expired_emails(self):
+        """test that notified users and admins get the expected emails"""
+        tasks.send_expiry_emails()
+
+        emails = self._emails()
+        self.assertEqual([(subject, to) for subject, to, _ in emails], [
+            ("Your access to {}'s resources is expiring soon".format(tasks.CENTER_NAME),
+             ['alice@example.com']),
+            ("Your access to {}'s resources is expiring soon".format(tasks.CENTER_NAME),
+             ['bob@example.com']),
+            ('Your access to resource(s) have expired', ['alice@example.com']),
+            ('Allocation(s) have expired', ['admin@example.com']),
+        ])
+
+        alice = emails[0][2]
+        self.assertIn('Project Title: lab1', alice)
+        self.assertIn('Project Title: lab2', alice)
+        self.assertIn('Allocation(s) expiring in 7 days:', alice)
+        self.assertIn('Allocation(s) expiring in 30 days:', alice)
+        self.assertLess(alice.index('expiring in 7 days'), alice.index('expiring in 30 days'))
+
+        bob = emails[1][2]
+        self.assertIn('Project Title: lab2', bob)
+        self.assertNotIn('lab1', bob)
+        self.assertEqual(bob.count('cluster'), 1)
+        self.assertNotIn('storage', bob)
+
+        admin = emails[3][2]
+        self.assertIn('cluster : https://coldfront/allocation/{}/'.format(
+            self.expired.pk), admin)
+        self.assertIn('storage : https://coldfront/allocation/', admin)
+
+    def test_query_count_does_not_grow_with_users(self):
+        """test that the number of queries is independent of the number of users"""
+        def count_queries():
+            with CaptureQueriesContext(connection) as queries:
+                tasks.send_expiry_emails()
+            return len(queries)
+
+        before = count_queries()
+        for i in range(20):
+            user = UserFactory(username='extra{}'.format(i))
+            ProjectUserFactory(project=self.lab1, user=user)
+            AllocationUserFactory(allocation=self.expiring, user=user)
+        self.assertEqual(count_queries(), before)
+
+
+class UpdateStatusesTests(TestCase):
+    """tests for update_statuses"""
+
+    @classmethod
+    def setUpTestData(cls):
+        """Set up allocations past and before their end date"""
+        AllocationStatusChoice.objects.get_or_create(name='Expired')
+        cls.project = ProjectFactory(title='lab1')
+        cls.past = [cls._allocation('Active', -1 - i) for i in range(5)]
+        cls.past.append(cls._allocation('Unpaid', -3))
+        cls.current = cls._allocation('Active', 10)
+        cls.denied = cls._allocation('Denied', -3)
+
+    @classmethod
+    def _allocation(cls, status, days):
+        return Allocation.objects.create(
+            project=cls.project,
+            status=AllocationStatusChoice.objects.get_or_create(name=status)[0],
+            start_date=_days(-365),
+            end_date=_days(days),
+            justification='test')
+
+    def setUp(self):
+        for patcher in [
+                mock.patch.object(tasks, 'ALLOCATION_EXPIRE_BATCH_SIZE', 4),
+                mock.patch.object(tasks, 'ALLOCATION_FUNCS_ON_EXPIRE',
+                                  ['coldfront.core.allocation.utils.test_allocation_function'])]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(tasks, 'async_task')
+        self.async_task = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_bulk_expire(self):
+        """test that statuses and history are updated and hooks queued in batches"""
+        result = tasks.update_statuses()
+
+        expired = set(Allocation.objects.filter(
+            status__name='Expired').values_list('pk', flat=True))
+        self.assertEqual(expired, {a.pk for a in self.past})
+        self.assertEqual(result['expired'], 6)
+        self.assertEqual(result['hook_tasks'], 2)
+
+        history = self.past[0].history.first()
+        self.assertEqual(history.status.name, 'Expired')
+        self.assertEqual(history.history_type, '~')
+
+        batches = [call.args[1] for call in self.async_task.call_args_list]
+        self.assertEqual([len(b) for b in batches], [4, 2])
+        self.assertEqual(set(sum(batches, [])), expired)
+
+    def test_single_update(self):
+        """test that all allocations are expired with one UPDATE and one history INSERT"""
+        with mock.patch.object(tasks, 'ALLOCATION_EXPIRE_BATCH_SIZE', 100):
+            with CaptureQueriesContext(connection) as queries:
+                tasks.update_statuses()
+
+        statements = [q['sql'].split()[0] for q in queries]
+        self.assertEqual(statements.count('UPDATE'), 1)
+        self.assertEqual(statements.count('INSERT'), 1)
+        self.assertEqual(statements.count('SELECT'), 2)
+
+    def test_run_expire_funcs(self):
+        """test that queued tasks run the expire functions for each pk"""
+        with mock.patch('coldfront.core.allocation.utils.test_allocation_function') as func:
+            tasks.run_expire_funcs([1, 2])
+        self.assertEqual(func.call_args_list, [mock.call(1), mock.call(2)])
@@ -1,6 +1,10 @@
+import datetime
 import logging
 
+from django.core.cache import cache
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 
 from coldfront.core.test_helpers import utils
@@ -13,14 +17,18 @@ from coldfront.core.test_helpers.factories import (
     AllocationUserFactory,
     AllocationAttributeFactory,
     ProjectStatusChoiceFactory,
+    AllocationAttributeUsageFactory,
     ProjectUserRoleChoiceFactory,
     AllocationStatusChoiceFactory,
     AllocationAttributeTypeFactory,
     AllocationChangeRequestFactory,
 )
+from coldfront.core.utils.pagination import encode_cursor, keyset_ordering
 from coldfront.core.allocation.models import (
+    Allocation,
     AllocationChangeRequest,
     AllocationChangeStatusChoice,
+    AllocationUserNote,
 )
 
 logging.disable(logging.CRITICAL)
@@ -123,6 +131,60 @@ class AllocationListViewTest(AllocationViewBaseTest):
         )
         self.assertEqual(len(response.context['allocation_list']), 1)
 
+    def test_allocation_list_keyset_pagination(self):
+        """Confirm that following Next and Previous cursors visits every allocation once in order"""
+        cache.clear()
+        Allocation.objects.filter(pk__in=[a.pk for a in self.additional_allocations[::7]]).update(end_date=None)
+        Allocation.objects.filter(pk__in=[a.pk for a in self.additional_allocations[::3]]).update(
+            end_date=datetime.date(2030, 1, 1))
+        self.client.force_login(self.admin_user, backend=BACKEND)
+        for order_by, direction in [('id', 'des'), ('end_date', 'asc'), ('end_date', 'des'),
+                                    ('project__pi__username', 'asc'), ('status__name', 'des')]:
+            descending = direction == 'des'
+            expected = list(Allocation.objects.order_by(
+                *keyset_ordering(order_by, descending)).values_list('pk', flat=True))
+            url = f'/allocation/?show_all_allocations=on&order_by={order_by}&direction={direction}'
+            response = self.client.get(url)
+            self.assertEqual(response.context['allocations_count'], len(expected))
+            seen, pages = [], []
+            while True:
+                page = response.context['page_obj']
+                pages.append(page)
+                seen += [a.pk for a in page.object_list]
+                if not page.has_next():
+                    break
+                response = self.client.get(url + f'&page={page.next_page_number()}&after={page.next_cursor}')
+            self.assertEqual(seen, expected, order_by)
+            self.assertEqual(len(pages), pages[0].paginator.num_pages)
+
+            response = self.client.get(
+                url + f'&page={len(pages) - 1}&before={pages[-1].previous_cursor}')
+            self.assertEqual([a.pk for a in response.context['allocation_list']],
+                             [a.pk for a in pages[-2].object_list])
+
+    def test_allocation_list_invalid_cursor(self):
+        """Confirm that a cursor with a value the field does not accept falls back to OFFSET"""
+        self.client.force_login(self.admin_user, backend=BACKEND)
+        url = '/allocation/?show_all_allocations=on&order_by=end_date&direction=asc'
+        response = self.client.get(url)
+        for cursor in [encode_cursor('notadate', 1), encode_cursor({}, 1), 'notacursor']:
+            invalid = self.client.get(url + f'&after={cursor}')
+            self.assertEqual(invalid.status_code, 200)
+            self.assertEqual([a.pk for a in invalid.context['allocation_list']],
+                             [a.pk for a in response.context['allocation_list']])
+
+    def test_allocation_list_count_is_cached(self):
+        """Confirm that the allocation count query is not repeated within the cache timeout"""
+        cache.clear()
+        self.client.force_login(self.admin_user, backend=BACKEND)
+        url = '/allocation/?show_all_allocations=on'
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertFalse([q for q in queries if q['sql'].startswith(
+            'SELECT COUNT(*) AS "__count" FROM "allocation_allocation"')])
+        self.assertEqual(response.context['allocations_count'], Allocation.objects.count())
+
 
 class AllocationChangeDetailViewTest(AllocationViewBaseTest):
     """Tests for AllocationChangeDetailView"""
@@ -212,6 +274,33 @@ class AllocationDetailViewTest(AllocationViewBaseTest):
         utils.test_user_cannot_access(self, self.proj_nonallocation_user, self.url)
         # check access for allocation user with "Removed" status
 
+    def test_allocation_detail_query_count(self):
+        """Test that the number of queries does not grow with the allocation"""
+        def count_queries(user):
+            self.client.force_login(user, backend=BACKEND)
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(self.url)
+            self.assertEqual(response.status_code, 200)
+            return len(queries)
+
+        before = {user: count_queries(user) for user in [self.admin_user, self.pi_user]}
+        self.allocation.resources.add(ResourceFactory(name='holylfs07/tier0'))
+        for i in range(10):
+            user = UserFactory(username='extra{}'.format(i))
+            AllocationUserFactory(allocation=self.allocation, user=user)
+            attribute = AllocationAttributeFactory(
+                allocation=self.allocation, value=100,
+                allocation_attribute_type=AllocationAttributeTypeFactory(name='Quota {}'.format(i)))
+            AllocationAttributeUsageFactory(allocation_attribute=attribute, value=i)
+            AllocationChangeRequestFactory(allocation=self.allocation)
+            AllocationUserNote.objects.create(
+                allocation=self.allocation, author=self.admin_user,
+                is_private=False, note='note {}'.format(i))
+
+        for user, count in before.items():
+            self.assertEqual(count_queries(user), count)
+            self.assertLessEqual(count, 21)
+
     def test_allocationdetail_requestchange_button(self):
         """Test visibility of "Request Change" button for different user types"""
         utils.page_contains_for_user(self, self.admin_user, self.url, 'Request Change')
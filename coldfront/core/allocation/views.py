@@ -9,8 +9,7 @@ from django.contrib import messages
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import User
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
-from django.core.paginator import EmptyPage, PageNotAnInteger, Paginator
-from django.db.models import Q
+from django.db.models import Prefetch, Q
 from django.db.models.query import QuerySet
 from django.forms import formset_factory
 from django.http import HttpResponseRedirect, JsonResponse, HttpResponseBadRequest
@@ -47,7 +46,8 @@ from coldfront.core.allocation.models import (Allocation,
                                               AllocationStatusChoice,
                                               AllocationUser,
                                               AllocationUserNote,
-                                              AllocationUserStatusChoice)
+                                              AllocationUserStatusChoice,
+                                              ordered_resources_prefetch)
 from coldfront.core.allocation.signals import (allocation_new,
                                                allocation_activate,
                                                allocation_activate_user,
@@ -57,10 +57,12 @@ from coldfront.core.allocation.signals import (allocation_new,
 from coldfront.core.allocation.utils import (generate_guauge_data_from_usage,
                                              get_user_resources)
 from coldfront.core.project.models import (Project, ProjectUser, ProjectPermission,
+                                           ProjectUserAccess,
                                            ProjectUserStatusChoice)
 from coldfront.core.resource.models import Resource
 from coldfront.core.utils.common import get_domain_url, import_from_settings
 from coldfront.core.utils.mail import send_allocation_admin_email, send_allocation_customer_email
+from coldfront.core.utils.pagination import KeysetPaginationMixin
 
 ALLOCATION_ENABLE_ALLOCATION_RENEWAL = import_from_settings(
     'ALLOCATION_ENABLE_ALLOCATION_RENEWAL', True)
@@ -91,27 +93,62 @@ class AllocationDetailView(LoginRequiredMixin, UserPassesTestMixin, TemplateView
 
     def test_func(self):
         """ UserPassesTestMixin Tests"""
-        pk = self.kwargs.get('pk')
-        allocation_obj = get_object_or_404(Allocation, pk=pk)
+        allocation_obj = self.get_allocation()
 
         if self.request.user.has_perm('allocation.can_view_all_allocations'):
             return True
 
         return allocation_obj.has_perm(self.request.user, AllocationPermission.USER)
 
+    def get_prefetch_plan(self):
+        """Returns the related objects loaded with the allocation.
+
+        Everything the detail page shows is loaded here, limited to what the
+        user may see, so the number of queries does not depend on the number
+        of attributes, users, notes or change requests.
+        """
+        attributes = AllocationAttribute.objects.select_related(
+            'allocation_attribute_type', 'allocationattributeusage'
+        ).order_by('allocation_attribute_type__name')
+        notes = AllocationUserNote.objects.select_related('author')
+        if not self.request.user.is_superuser:
+            attributes = attributes.filter(allocation_attribute_type__is_private=False)
+            notes = notes.filter(is_private=False)
+
+        return [
+            ordered_resources_prefetch(),
+            Prefetch('allocationattribute_set', queryset=attributes,
+                     to_attr='visible_attributes'),
+            Prefetch('allocationuser_set',
+                     queryset=AllocationUser.objects.exclude(
+                         status__name__in=['Removed']
+                     ).select_related('user', 'status').order_by('user__username'),
+                     to_attr='listed_users'),
+            Prefetch('allocationchangerequest_set',
+                     queryset=AllocationChangeRequest.objects.select_related(
+                         'status').order_by('-pk'),
+                     to_attr='listed_changes'),
+            Prefetch('allocationusernote_set', queryset=notes,
+                     to_attr='visible_notes'),
+        ]
+
+    def get_allocation(self):
+        """Returns the allocation with the prefetch plan applied, loaded once per request"""
+        if not hasattr(self, '_allocation'):
+            self._allocation = get_object_or_404(
+                Allocation.objects.select_related(
+                    'status', 'project__status', 'project__pi'
+                ).prefetch_related(*self.get_prefetch_plan()),
+                pk=self.kwargs.get('pk'))
+        return self._allocation
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        pk = self.kwargs.get('pk')
-        allocation_obj = get_object_or_404(Allocation, pk=pk)
-        allocation_users = allocation_obj.allocationuser_set.exclude(
-            status__name__in=['Removed']).order_by('user__username')
+        allocation_obj = self.get_allocation()
 
         # set visible usage attributes
-        alloc_attr_set = allocation_obj.get_attribute_set(self.request.user)
-        attributes_with_usage = [a for a in alloc_attr_set if hasattr(a, 'allocationattributeusage')]
-        attributes = alloc_attr_set
-
-        allocation_changes = allocation_obj.allocationchangerequest_set.all().order_by('-pk')
+        attributes = allocation_obj.visible_attributes
+        attributes_with_usage = [a for a in attributes if hasattr(a, 'allocationattributeusage')]
 
         guage_data = []
         invalid_attributes = []
@@ -130,25 +167,21 @@ class AllocationDetailView(LoginRequiredMixin, UserPassesTestMixin, TemplateView
         for a in invalid_attributes:
             attributes_with_usage.remove(a)
 
-        context['allocation_users'] = allocation_users
+        context['allocation_users'] = allocation_obj.listed_users
         context['guage_data'] = guage_data
         context['attributes_with_usage'] = attributes_with_usage
         context['attributes'] = attributes
-        context['allocation_changes'] = allocation_changes
+        context['allocation_changes'] = allocation_obj.listed_changes
 
         # Can the user update the project?
         context['is_allowed_to_update_project'] = allocation_obj.project.has_perm(self.request.user, ProjectPermission.UPDATE)
 
-        noteset = allocation_obj.allocationusernote_set
-        notes = noteset.all() if self.request.user.is_superuser else noteset.filter(is_private=False)
-
-        context['notes'] = notes
+        context['notes'] = allocation_obj.visible_notes
         context['ALLOCATION_ENABLE_ALLOCATION_RENEWAL'] = ALLOCATION_ENABLE_ALLOCATION_RENEWAL
         return context
 
     def get(self, request, *args, **kwargs):
-        pk = self.kwargs.get('pk')
-        allocation_obj = get_object_or_404(Allocation, pk=pk)
+        allocation_obj = self.get_allocation()
 
         initial_data = {
             'status': allocation_obj.status,
@@ -271,12 +304,17 @@ class AllocationDetailView(LoginRequiredMixin, UserPassesTestMixin, TemplateView
         return HttpResponseRedirect(reverse('allocation-detail', kwargs={'pk': pk}))
 
 
-class AllocationListView(LoginRequiredMixin, ListView):
+class AllocationListView(LoginRequiredMixin, KeysetPaginationMixin, ListView):
 
     model = Allocation
     template_name = 'allocation/allocation_list.html'
     context_object_name = 'allocation_list'
     paginate_by = 25
+    keyset_fields = ('id', 'project__pi__username', 'status__name', 'end_date')
+    list_select_related = ('project__pi', 'status')
+    list_only_fields = ('id', 'end_date', 'status__name', 'project__title',
+                        'project__pi__username', 'project__pi__first_name',
+                        'project__pi__last_name')
 
     def get_queryset(self):
 
@@ -294,10 +332,14 @@ class AllocationListView(LoginRequiredMixin, ListView):
             data = allocation_search_form.cleaned_data
 
             if data.get('show_all_allocations') and (self.request.user.is_superuser or self.request.user.has_perm('allocation.can_view_all_allocations')):
-                allocations = Allocation.objects.prefetch_related(
-                    'project', 'project__pi', 'status',).all().order_by(order_by)
+                allocations = Allocation.objects.all().order_by(order_by)
+            elif ProjectUserAccess.is_enabled():
+                allocations = Allocation.objects.filter(
+                    Q(project__status__name__in=['New', 'Active', ]) &
+                    Q(pk__in=ProjectUserAccess.objects.listed_allocations(self.request.user))
+                ).distinct().order_by(order_by)
             else:
-                allocations = Allocation.objects.prefetch_related('project', 'project__pi', 'status',).filter(
+                allocations = Allocation.objects.filter(
                     Q(project__status__name__in=['New', 'Active', ]) &
                     Q(project__projectuser__status__name='Active') &
                     Q(project__projectuser__user=self.request.user) &
@@ -356,7 +398,7 @@ class AllocationListView(LoginRequiredMixin, ListView):
                     status__in=data.get('status'))
 
         else:
-            allocations = Allocation.objects.prefetch_related('project', 'project__pi', 'status',).filter(
+            allocations = Allocation.objects.filter(
                 Q(allocationuser__user=self.request.user) &
                 Q(allocationuser__status__name='Active')
             ).order_by(order_by)
@@ -366,8 +408,7 @@ class AllocationListView(LoginRequiredMixin, ListView):
     def get_context_data(self, **kwargs):
 
         context = super().get_context_data(**kwargs)
-        allocations_count = self.get_queryset().count()
-        context['allocations_count'] = allocations_count
+        context['allocations_count'] = context['paginator'].count
 
         allocation_search_form = AllocationSearchForm(self.request.GET)
 
@@ -400,18 +441,6 @@ class AllocationListView(LoginRequiredMixin, ListView):
         context['filter_parameters'] = filter_parameters
         context['filter_parameters_with_order_by'] = filter_parameters_with_order_by
 
-        allocation_list = context.get('allocation_list')
-        paginator = Paginator(allocation_list, self.paginate_by)
-
-        page = self.request.GET.get('page')
-
-        try:
-            allocation_list = paginator.page(page)
-        except PageNotAnInteger:
-            allocation_list = paginator.page(1)
-        except EmptyPage:
-            allocation_list = paginator.page(paginator.num_pages)
-
         return context
 
 
@@ -0,0 +1,131 @@
+#Opt-in cache for Allocation and Resource attribute lookups.
+#
+#Allocation.get_attribute(), Resource.get_attribute() and their _list
+#variants normally run one query per call.  Inside an attribute_cache()
+#block (or a request wrapped by AttributeCacheMiddleware), the first
+#lookup on an allocation or resource loads all of its attributes in a
+#single query, keyed by attribute type name, and later lookups are
+#answered from memory.  Saving or deleting an attribute invalidates the
+#cached entry for its owner.  Owners loaded with
+#prefetch_related('<owner>attribute_set') (with the attribute type selected)
+#are answered from the prefetched attributes, cache or not.
+
+import contextlib
+import contextvars
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+_cache = contextvars.ContextVar('coldfront_attribute_cache', default=None)
+
+
+def is_active():
+    """Returns True if an attribute cache is active in this context"""
+    return _cache.get() is not None
+
+
+@contextlib.contextmanager
+def attribute_cache():
+    """Context manager enabling the attribute cache for its duration.
+
+    Nested blocks reuse the outermost cache.  The cache is discarded when
+    the outermost block exits.
+    """
+    if is_active():
+        yield
+        return
+
+    token = _cache.set({})
+    try:
+        yield
+    finally:
+        _cache.reset(token)
+
+
+class AttributeCacheMiddleware:
+    """Enables the attribute cache for the duration of each request"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with attribute_cache():
+            return self.get_response(request)
+
+
+def _key(owner):
+    return (owner._meta.label_lower, owner.pk)
+
+
+def _type_field(owner):
+    """Returns name of the attribute type foreign key for owner's attributes
+
+    AllocationAttribute uses allocation_attribute_type and ResourceAttribute
+    uses resource_attribute_type.
+    """
+    return '{}_attribute_type'.format(owner._meta.model_name)
+
+
+def get_attributes(owner, name):
+    """Returns the list of attributes of owner with type named name.
+
+    Owner is an Allocation or Resource.  Attributes are returned ordered by primary key, matching the order
+    used by QuerySet.first().  If the attributes of owner were prefetched
+    they are filtered in memory, otherwise if no cache is active this is a
+    plain filtered query.
+    """
+    set_name = '{}attribute_set'.format(owner._meta.model_name)
+    attribute_set = getattr(owner, set_name)
+    type_field = _type_field(owner)
+    prefetched = getattr(owner, '_prefetched_objects_cache', {}).get(set_name)
+    if prefetched is not None:
+        return sorted((attr for attr in prefetched
+                       if getattr(attr, type_field).name == name),
+                      key=lambda attr: attr.pk)
+
+    cache = _cache.get()
+    if cache is None:
+        return list(attribute_set.filter(**{
+            type_field + '__name': name}).order_by('pk'))
+
+    key = _key(owner)
+    if key not in cache:
+        by_name = {}
+        for attr in attribute_set.select_related(
+                type_field + '__attribute_type').order_by('pk'):
+            by_name.setdefault(
+                getattr(attr, type_field).name, []).append(attr)
+        cache[key] = by_name
+
+    return cache[key].get(name, [])
+
+
+def prime(owner, attributes):
+    """Stores attributes as the complete attribute list of owner.
+
+    Used by bulk loaders which fetched the attributes of many owners at
+    once.  Does nothing if no cache is active.
+    """
+    cache = _cache.get()
+    if cache is None:
+        return
+
+    type_field = _type_field(owner)
+    by_name = {}
+    for attr in attributes:
+        by_name.setdefault(getattr(attr, type_field).name, []).append(attr)
+    cache[_key(owner)] = by_name
+
+
+def invalidate(owner_model, owner_pk):
+    """Drops cached attributes of the Allocation or Resource with owner_pk
+
+    Takes the model class and primary key so callers holding only a
+    foreign key id do not need to fetch the owner.
+    """
+    cache = _cache.get()
+    if cache is None:
+        return
+
+    cache.pop((owner_model._meta.label_lower, owner_pk), None)
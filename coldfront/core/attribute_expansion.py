@@ -4,19 +4,61 @@
 #of parameters (typically related to other attributes) inside of 
 #attributes.  Used in the expanded_value() method of AllocationAttribute
 #and ResourceAttribute.
-
+#
+#Attriblist strings are compiled once into a tuple of parsed statements
+#(see compile_attriblist) and the compiled programs are kept in a bounded
+#LRU cache, so expanding many attributes sharing the same few attriblists
+#only pays for the evaluation step.
+#
+#When EXPANDED_VALUE_CACHE_ENABLED is set, expanded values are also stored
+#in the expanded_cache column of AllocationAttribute and ResourceAttribute
+#together with AttributeExpansionDependency rows naming every attribute
+#read by the expansion.  Saving or deleting an attribute clears the
+#stored values of its dependents (transitively), which are recomputed on
+#their next read.
+
+import collections
+import functools
 import logging
 import math
 
+from django.apps import apps
+from django.db import transaction
+from django.db.models import Q, prefetch_related_objects
+
+from coldfront.core import attribute_cache
+from coldfront.core.utils.common import import_from_settings
+
 
 logger = logging.getLogger(__name__)
 
 #ALLOCATION_ATTRIBUTE_VIEW_LIST = import_from_settings(
 #    'ALLOCATION_ATTRIBUTE_VIEW_LIST', [])
+ATTRIBUTE_EXPANSION_CACHE_SIZE = import_from_settings(
+    'ATTRIBUTE_EXPANSION_CACHE_SIZE', 256)
+EXPANDED_VALUE_CACHE_ENABLED = import_from_settings(
+    'EXPANDED_VALUE_CACHE_ENABLED', False)
 
 ATTRIBUTE_EXPANSION_TYPE_PREFIX = 'Attribute Expanded'
 ATTRIBUTE_EXPANSION_ATTRIBLIST_SUFFIX = '_attriblist'
 
+# Argument kinds assigned by classify_argument.  Attribute/parameter
+# references use the prefix they were written with as their kind.
+ARGUMENT_LITERAL = 'literal'
+ARGUMENT_BAD_LITERAL = 'bad literal'
+ARGUMENT_UNKNOWN = 'unknown'
+ARGUMENT_FUNCTION = 'function'
+ATTRIBUTE_SOURCES = [ ':APDICT', 'RESOURCE:', 'ALLOCATION:', ':' ]
+
+# A parsed attribute parameter statement '<pname> <opcode>= <argument>'.
+# kind and argument are the output of classify_argument (for the '('
+# opcode, kind is ARGUMENT_FUNCTION and argument the function name).
+# Statements without an '=' are kept with opcode None so the error can
+# be reported with the name of the attribute being expanded.
+AttributeParameterStatement = collections.namedtuple(
+    'AttributeParameterStatement',
+    ['parameter_string', 'pname', 'opcode', 'kind', 'argument'])
+
 
 def is_expandable_type(attribute_type):
     """Returns True if attribute_type is expandable.
@@ -97,8 +139,31 @@ def get_attribute_parameter_value(
     This method returns the expanded value, or None if unable to 
     evaluate
     """
-    value = None
-    
+    kind, argument = classify_argument(argument)
+    return resolve_argument(
+        kind = kind,
+        argument = argument,
+        attribute_parameter_dict = attribute_parameter_dict,
+        error_text = error_text,
+        resources = resources,
+        allocations = allocations)
+
+
+def classify_argument(argument):
+    """Classifies the argument of an attribute parameter statement.
+
+    This does the parsing half of get_attribute_parameter_value, which
+    only depends on the text of the argument, so it can be done once when
+    an attriblist is compiled.  Returns a (kind, value) tuple:
+    (ARGUMENT_LITERAL, value) - a string or numeric literal, value is the
+        python value of the literal
+    (ARGUMENT_BAD_LITERAL, argument) - a string literal missing its final
+        single quote
+    (prefix, name) - an attribute/parameter reference, prefix is the
+        matching entry of ATTRIBUTE_SOURCES and name the argument with
+        the prefix stripped
+    (ARGUMENT_UNKNOWN, argument) - anything else
+    """
     # Check for string constant
     if argument.startswith("'"):
         # Looks like a string literal
@@ -108,70 +173,76 @@ def get_attribute_parameter_value(
         tmp = tmpstr[-1:]
         if tmp == "'":
             #Good string literal
-            tmpstr = tmpstr[:-1]
-            return tmpstr
+            return ARGUMENT_LITERAL, tmpstr[:-1]
         else:
             #Bad string literal
-            logger.warn("Bad string literal '{}' found while processing "
-                "{}; missing final single quote".format(
-                argument, error_text))
-            return None
+            return ARGUMENT_BAD_LITERAL, argument
 
     # If argument if prefixed with any of the strings in attrib_sources,
-    # strip the prefix and set attrib_source accordingly
-    attrib_source = None
-    attrib_sources = [ ':APDICT', 'RESOURCE:', 'ALLOCATION:', ':' ]
-    for asrc in attrib_sources:
+    # strip the prefix and use it as the kind
+    for asrc in ATTRIBUTE_SOURCES:
         if argument.startswith(asrc):
-            # Got a match
-            attrib_source = asrc
-            tmplen = len(asrc)
-            argument = argument[tmplen:]
-            break
+            return asrc, argument[len(asrc):]
+
+    # If reach here, argument is not a string literal, or a 
+    # parameter or attribute name, so try numeric constant
+    try:
+        return ARGUMENT_LITERAL, int(argument)
+    except ValueError:
+        try:
+            return ARGUMENT_LITERAL, float(argument)
+        except ValueError:
+            return ARGUMENT_UNKNOWN, argument
+
+
+def resolve_argument(kind, argument, attribute_parameter_dict, error_text,
+    resources=[], allocations=[]):
+    """Evaluates an argument classified by classify_argument.
+
+    This does the evaluation half of get_attribute_parameter_value,
+    dereferencing parameters and attributes.  Returns the value, or None
+    if unable to evaluate.
+    """
+    if kind == ARGUMENT_LITERAL:
+        return argument
+
+    if kind == ARGUMENT_BAD_LITERAL:
+        logger.warn("Bad string literal '{}' found while processing "
+            "{}; missing final single quote".format(
+            argument, error_text))
+        return None
+
+    if kind == ARGUMENT_UNKNOWN:
+        logger.warn("Unable to evaluate argument '{arg}' while "
+            "processing {etxt}, returning None".format(
+            arg=argument, etxt=error_text))
+        return None
 
     # Try expanding as a parameter/attribute
     # We do attribute_parameter_dict first, then allocations, then
     # resources to try to get value most specific to use case
     if ( attribute_parameter_dict is not None and 
-        (attrib_source == ':' or attrib_source == 'APDICT:')):
+        (kind == ':' or kind == 'APDICT:')):
         if argument in attribute_parameter_dict:
             return attribute_parameter_dict[argument]
 
-    if attrib_source == ':' or attrib_source == 'ALLOCATION:':
+    if kind == ':' or kind == 'ALLOCATION:':
         for alloc in allocations:
             tmp = alloc.get_attribute(argument)
             if tmp is not None:
                 return tmp
 
-    if attrib_source == ':' or attrib_source == 'RESOURCE:':
+    if kind == ':' or kind == 'RESOURCE:':
         for res in resources:
             tmp = res.get_attribute(argument)
             if tmp is not None:
                 return tmp
 
-    if attrib_source is not None:
-        # We were given an attribute or parameter name, but could not
-        # find it.  Just return None
-        return None
+    # We were given an attribute or parameter name, but could not
+    # find it.  Just return None
+    return None
 
-    # If reach here, argument is not a string literal, or a 
-    # parameter or attribute name, so try numeric constant
-    try:
-        value = int(argument)
-        return value
-    except ValueError:
-        try:
-            value = float(argument)
-            return value
-        except ValueError:
-            logger.warn("Unable to evaluate argument '{arg}' while "
-                "processing {etxt}, returning None".format(
-                arg=argument, etxt=error_text))
-            return None
 
-    # Should not reach here
-    return None
-    
 def process_attribute_parameter_operation(
     opcode, oldvalue, argument, error_text):
     """Process the specified operation for attribute_parameter_dict.
@@ -254,6 +325,7 @@ def process_attribute_parameter_operation(
         if opcode == '(':
             if argument == 'floor':
                 newval = math.floor(oldvalue)
+                return newval
             else:
                 logger.error('Unrecognized function named {} in {}= for '
                     '{}, returning None'.format(
@@ -300,24 +372,41 @@ def process_attribute_parameter_string(
     the operations and argument values.
     """
 
+    statement = parse_attribute_parameter_string(parameter_string)
+    if statement is None:
+        # Comment or blank line
+        return attribute_parameter_dict
+    return evaluate_attribute_parameter_statement(
+        statement = statement,
+        attribute_name = attribute_name,
+        attribute_parameter_dict = attribute_parameter_dict,
+        resources = resources,
+        allocations = allocations)
+
+
+def parse_attribute_parameter_string(parameter_string):
+    """Parses a single attribute parameter definition/statement.
+
+    Returns an AttributeParameterStatement with the parameter name, the
+    opcode and the classified argument (see classify_argument), or None
+    for comment and blank lines.  Statements without an '=' are returned
+    with opcode None; the error is logged when they are evaluated.
+    """
+
     # Strip leading/trailing white space
     parmstr = parameter_string.strip()
-    # Ignore comment lines/blank lines (return attribute_parameter_dict)
+    # Ignore comment lines/blank lines
     if not parmstr:
-        return attribute_parameter_dict
+        return None
     if parmstr.startswith('#'):
-        return attribute_parameter_dict
+        return None
 
     # Parse the parameter string to get pname, op, and argument
     tmp = parmstr.split('=', 1)
     if len(tmp) != 2:
         # No '=' found, so invalid format of parmstr
-        # Log error and return unmodified attribute_parameter_dict
-        logger.error("Invalid parameter string '{pstr}', no '=', while "
-            "creating attribute parameter dictionary for expanding "
-            "attribute {aname}".format(
-            aname=attribute_name, pstr=parameter_string))
-        return attribute_parameter_dict
+        return AttributeParameterStatement(
+            parameter_string, None, None, None, None)
     pname = tmp[0]
     argument = tmp[1].strip()
     # Remove opcode and remove trailing whitespace from pname
@@ -325,37 +414,102 @@ def process_attribute_parameter_string(
     pname = pname[:-1].strip()
 
     # Argument is a parameter/attribute/constant unless opcode is '('
-    # So get its value if parameter/attribute/constant
-    value = None
     if opcode == '(':
-        value = argument
+        kind = ARGUMENT_FUNCTION
     else:
-        # Extra text to display in diagnostics if error occurs
-        error_text = 'processing attribute_parameter_string={pstr} ' \
-            'for expansion of attribute {aname}'.format(
-            pstr = parameter_string, aname=attribute_name)
-        value = get_attribute_parameter_value(
-            argument = argument,
+        kind, argument = classify_argument(argument)
+    return AttributeParameterStatement(
+        parameter_string, pname, opcode, kind, argument)
+
+
+def evaluate_attribute_parameter_statement(statement, attribute_name,
+    attribute_parameter_dict, resources=[], allocations=[]):
+    """Evaluates a statement from parse_attribute_parameter_string.
+
+    The new value of the statement's parameter is stored in
+    attribute_parameter_dict, which is also returned.
+    """
+    if statement.opcode is None:
+        # Log error and return unmodified attribute_parameter_dict
+        logger.error("Invalid parameter string '{pstr}', no '=', while "
+            "creating attribute parameter dictionary for expanding "
+            "attribute {aname}".format(
+            aname=attribute_name, pstr=statement.parameter_string))
+        return attribute_parameter_dict
+
+    # Extra text to display in diagnostics if error occurs
+    error_text = 'processing attribute_parameter_string={pstr} ' \
+        'for expansion of attribute {aname}'.format(
+        pstr = statement.parameter_string, aname=attribute_name)
+
+    # Get the value of the argument if parameter/attribute/constant
+    if statement.kind == ARGUMENT_FUNCTION:
+        value = statement.argument
+    else:
+        value = resolve_argument(
+            kind = statement.kind,
+            argument = statement.argument,
             attribute_parameter_dict = attribute_parameter_dict,
-            resources = resources, 
-            allocations = allocations,
-            error_text = error_text)
+            error_text = error_text,
+            resources = resources,
+            allocations = allocations)
 
     # Get the old value of the parameter
-    if pname in attribute_parameter_dict:
-        oldval = attribute_parameter_dict[pname]
-    else:
-        oldval = None
+    oldval = attribute_parameter_dict.get(statement.pname)
 
     # Perform the requested operation
     newval = process_attribute_parameter_operation(
-        opcode=opcode, oldvalue=oldval, argument=value,
+        opcode=statement.opcode, oldvalue=oldval, argument=value,
         error_text=error_text)
     # Set value in dictionary and return
-    attribute_parameter_dict[pname] = newval
+    attribute_parameter_dict[statement.pname] = newval
     return attribute_parameter_dict
 
 
+@functools.lru_cache(maxsize=ATTRIBUTE_EXPANSION_CACHE_SIZE)
+def compile_attriblist(attriblist_string):
+    """Compiles an attriblist string into a program.
+
+    The program is a tuple of AttributeParameterStatement, one per line
+    of attriblist_string in order, with comment and blank lines dropped.
+    Compiled programs are kept in a LRU cache holding up to
+    ATTRIBUTE_EXPANSION_CACHE_SIZE attriblist strings, so programs must
+    not be modified.
+    """
+    statements = (parse_attribute_parameter_string(line.strip())
+        for line in attriblist_string.splitlines())
+    return tuple(stmt for stmt in statements if stmt is not None)
+
+
+def attriblist_references(program):
+    """Returns the set of attribute names a compiled attriblist reads.
+
+    Includes the names of all RESOURCE:, ALLOCATION: and : arguments.  The
+    latter may also name parameters, so the set can contain names which
+    are not attributes.
+    """
+    return {stmt.argument for stmt in program
+        if stmt.kind in (':', 'RESOURCE:', 'ALLOCATION:')}
+
+
+def evaluate_attriblist(program, attribute_name, resources=[],
+    allocations=[]):
+    """Runs a program from compile_attriblist, returning the dictionary.
+
+    Statements are evaluated in order top to bottom; see
+    evaluate_attribute_parameter_statement.
+    """
+    apdict = dict()
+    for statement in program:
+        evaluate_attribute_parameter_statement(
+            statement = statement,
+            attribute_name = attribute_name,
+            attribute_parameter_dict = apdict,
+            resources = resources,
+            allocations = allocations)
+    return apdict
+
+
 def make_attribute_parameter_dictionary(attribute_name,
         attribute_parameter_string, resources=[], allocations=[]):
     """Create the attribute parameter dictionary.  Used by expand_attribute.
@@ -372,26 +526,17 @@ def make_attribute_parameter_dictionary(attribute_name,
     
     This routine processes the attribute_parameter_string line by line, in
     order top to bottom, to generate the dictionary that is returned.
+    The string is compiled (and cached) by compile_attriblist, so only
+    the evaluation is repeated for attriblists seen before.
 
     See process_attribute_parameter_string for details on the processing
     of each line.
     """
-
-    # Initialize our dictionary
-    apdict = dict()
-
-    # Covert attribute_parameter_string to a real list
-    attrib_parm_list = list(map(str.strip,
-        attribute_parameter_string.splitlines() ))
-    # Process each element in the list
-    for parmstr in attrib_parm_list:
-        apdict = process_attribute_parameter_string(
-            parameter_string = parmstr,
-            attribute_parameter_dict = apdict,
-            attribute_name = attribute_name,
-            resources = resources,
-            allocations = allocations)
-    return apdict
+    return evaluate_attriblist(
+        program = compile_attriblist(attribute_parameter_string),
+        attribute_name = attribute_name,
+        resources = resources,
+        allocations = allocations)
 
 
 def expand_attribute(raw_value, attribute_name, attriblist_string, 
@@ -461,6 +606,279 @@ def expand_attribute(raw_value, attribute_name, attriblist_string,
         return raw_value
 
 
+class _BatchOwner:
+    """Stands in for an Allocation or Resource during batch expansion.
+
+    Answers get_attribute and get_attribute_list, the only methods used
+    by the expansion functions above, from the loaded attributes.
+    """
+
+    __slots__ = ('batch', 'instance')
+
+    def __init__(self, batch, instance):
+        self.batch = batch
+        self.instance = instance
+
+    def get_attribute(self, name, **kwargs):
+        values = self.get_attribute_list(name)
+        return values[0] if values else None
+
+    def get_attribute_list(self, name, **kwargs):
+        return self.batch._values(self.instance, name)
+
+
+class AttributeExpansionBatch:
+    """Expands attributes of many allocations with a few queries.
+
+    The allocations (a queryset or list) are loaded with their resources,
+    all attributes of those resources, and the allocation attributes named
+    in attribute_names together with every allocation attribute their
+    attriblists reference, directly or through other expandable
+    attributes.  This takes a small number of queries independent of the
+    number of allocations (one per level of attribute references).
+
+    get_attribute and get_attribute_list then return the same (typed)
+    values as Allocation.get_attribute and Allocation.get_attribute_list,
+    and get_resource_attribute the same as Resource.get_attribute,
+    evaluated in memory.  Values, including those of referenced
+    attributes, are computed once per allocation or resource.  Lookups of
+    allocation attributes that were not loaded fall back to the model
+    methods.
+    """
+
+    def __init__(self, allocations, attribute_names):
+        AllocationAttribute = apps.get_model('allocation', 'AllocationAttribute')
+        ResourceAttribute = apps.get_model('resource', 'ResourceAttribute')
+
+        self.allocations = list(allocations)
+        prefetch_related_objects(self.allocations, 'resources')
+        resources = {r.pk: r for a in self.allocations for r in a.resources.all()}
+        self._resource_pks = set(resources)
+
+        self._attributes = {}
+        self._memo = {}
+        for attr in ResourceAttribute.objects.filter(
+                resource__in=list(resources)).select_related(
+                'resource_attribute_type__attribute_type').order_by('pk'):
+            attr.resource = resources[attr.resource_id]
+            self._attributes.setdefault(
+                (attr.resource, attr.resource_attribute_type.name), []).append(attr)
+
+        by_pk = {a.pk: a for a in self.allocations}
+        self._loaded = set()
+        wanted = set(attribute_names)
+        while wanted - self._loaded:
+            names = wanted - self._loaded
+            attriblist_names = {name + ATTRIBUTE_EXPANSION_ATTRIBLIST_SUFFIX
+                for name in names}
+            for attr in AllocationAttribute.objects.filter(
+                    allocation__in=list(by_pk),
+                    allocation_attribute_type__name__in=names | attriblist_names,
+                    ).select_related(
+                    'allocation_attribute_type__attribute_type').order_by('pk'):
+                attr.allocation = by_pk[attr.allocation_id]
+                self._attributes.setdefault(
+                    (attr.allocation, attr.allocation_attribute_type.name), []).append(attr)
+            self._loaded |= names | attriblist_names
+
+            # Follow the references of all attriblists for the new names
+            for (owner, name), attrs in self._attributes.items():
+                if name in attriblist_names:
+                    for attr in attrs:
+                        wanted |= attriblist_references(
+                            compile_attriblist(attr.value))
+
+    def get_attribute(self, allocation, name):
+        """Returns the expanded value of the first attribute named name"""
+        values = self.get_attribute_list(allocation, name)
+        return values[0] if values else None
+
+    def get_attribute_list(self, allocation, name):
+        """Returns the expanded values of the attributes named name"""
+        return self._values(allocation, name)
+
+    def get_resource_attribute(self, resource, name):
+        """Returns the expanded value of the first resource attribute named name
+
+        Resources other than those of the allocations fall back to
+        Resource.get_attribute.
+        """
+        values = self._values(resource, name)
+        return values[0] if values else None
+
+    def _values(self, instance, name):
+        key = (instance, name)
+        if key not in self._memo:
+            if instance._meta.model_name == 'allocation':
+                loaded = name in self._loaded
+            else:
+                loaded = instance.pk in self._resource_pks
+            if not loaded:
+                self._memo[key] = instance.get_attribute_list(name)
+            else:
+                self._memo[key] = [self._expand(instance, attr)
+                    for attr in self._attributes.get(key, [])]
+        return self._memo[key]
+
+    def _expand(self, instance, attr):
+        """Returns the typed and expanded value of attr, as expanded_value()"""
+        if instance._meta.model_name == 'allocation':
+            attribute_type = attr.allocation_attribute_type
+            allocations = [ _BatchOwner(self, instance) ]
+            resources = [ _BatchOwner(self, r) for r in instance.resources.all() ]
+        else:
+            attribute_type = attr.resource_attribute_type
+            allocations = []
+            resources = [ _BatchOwner(self, instance) ]
+
+        raw_value = convert_type(
+            value=attr.value, type_name=attribute_type.attribute_type.name)
+        if not is_expandable_type(attribute_type.attribute_type):
+            return raw_value
+        if EXPANDED_VALUE_CACHE_ENABLED and attr.expanded_cache is not None:
+            return attr.expanded_cache
+
+        attriblist = get_attriblist_str(
+            attribute_name = attribute_type.name,
+            resources = resources,
+            allocations = allocations)
+        if not attriblist:
+            return raw_value
+
+        return expand_attribute(
+            raw_value = raw_value,
+            attribute_name = attribute_type.name,
+            attriblist_string = attriblist,
+            resources = resources,
+            allocations = allocations)
+
+
+class _RecordingOwner:
+    """Wraps an Allocation or Resource, recording the attributes read.
+
+    Each get_attribute or get_attribute_list call adds
+    ((owner model name, owner pk), attribute name) to reads.
+    """
+
+    __slots__ = ('instance', 'reads')
+
+    def __init__(self, instance, reads):
+        self.instance = instance
+        self.reads = reads
+
+    def get_attribute(self, name, **kwargs):
+        self.reads.add(((self.instance._meta.model_name, self.instance.pk), name))
+        return self.instance.get_attribute(name, **kwargs)
+
+    def get_attribute_list(self, name, **kwargs):
+        self.reads.add(((self.instance._meta.model_name, self.instance.pk), name))
+        return self.instance.get_attribute_list(name, **kwargs)
+
+
+# Field of AttributeExpansionDependency referencing the dependent attribute
+_DEPENDENT_FIELDS = {
+    'allocationattribute': 'allocation_attribute',
+    'resourceattribute': 'resource_attribute',
+}
+
+
+def expand_and_store(attribute, raw_value, attribute_name, resources=[],
+    allocations=[]):
+    """Expands attribute like expanded_value() and stores the result.
+
+    Used by AllocationAttribute.expanded_value and
+    ResourceAttribute.expanded_value when EXPANDED_VALUE_CACHE_ENABLED is
+    set and the stored value is missing.  The attributes read from the
+    resources and allocations are recorded as AttributeExpansionDependency
+    rows of attribute, replacing any previous ones.  Only string results
+    (i.e. of 'Attribute Expanded Text' attributes) are stored.
+    """
+    reads = set()
+    resources = [ _RecordingOwner(r, reads) for r in resources ]
+    allocations = [ _RecordingOwner(a, reads) for a in allocations ]
+
+    expanded = raw_value
+    attriblist = get_attriblist_str(
+        attribute_name = attribute_name,
+        resources = resources,
+        allocations = allocations)
+    if attriblist:
+        expanded = expand_attribute(
+            raw_value = raw_value,
+            attribute_name = attribute_name,
+            attriblist_string = attriblist,
+            resources = resources,
+            allocations = allocations)
+
+    if isinstance(expanded, str) and attribute.pk is not None:
+        Dependency = apps.get_model('allocation', 'AttributeExpansionDependency')
+        field = _DEPENDENT_FIELDS[attribute._meta.model_name]
+        with transaction.atomic():
+            type(attribute).objects.filter(pk=attribute.pk).update(
+                expanded_cache=expanded)
+            Dependency.objects.filter(**{field: attribute.pk}).delete()
+            Dependency.objects.bulk_create([
+                Dependency(**{
+                    field + '_id': attribute.pk,
+                    owner_model + '_id': owner_pk,
+                    'name': name})
+                for (owner_model, owner_pk), name in reads])
+        attribute.expanded_cache = expanded
+
+    return expanded
+
+
+def invalidate_expanded_values(sources):
+    """Clears the stored expanded values depending on sources.
+
+    Sources is an iterable of ((owner model name, owner pk), attribute
+    name) pairs, e.g. (('allocation', 12), 'slurm_account_name'), for
+    attributes which were changed, added or deleted.  Dependents of the
+    cleared values are cleared as well.  Does nothing unless
+    EXPANDED_VALUE_CACHE_ENABLED is set.
+    """
+    if not EXPANDED_VALUE_CACHE_ENABLED:
+        return
+
+    AllocationAttribute = apps.get_model('allocation', 'AllocationAttribute')
+    ResourceAttribute = apps.get_model('resource', 'ResourceAttribute')
+    Dependency = apps.get_model('allocation', 'AttributeExpansionDependency')
+
+    seen = set()
+    sources = set(sources)
+    while sources:
+        seen |= sources
+        query = Q()
+        for (owner_model, owner_pk), name in sources:
+            query |= Q(**{owner_model + '_id': owner_pk, 'name': name})
+
+        dependents = set()
+        cleared = {AllocationAttribute: set(), ResourceAttribute: set()}
+        for row in Dependency.objects.filter(query).values_list(
+                'allocation_attribute_id',
+                'allocation_attribute__allocation_id',
+                'allocation_attribute__allocation_attribute_type__name',
+                'resource_attribute_id',
+                'resource_attribute__resource_id',
+                'resource_attribute__resource_attribute_type__name'):
+            if row[0] is not None:
+                cleared[AllocationAttribute].add(row[0])
+                dependents.add((('allocation', row[1]), row[2]))
+            if row[3] is not None:
+                cleared[ResourceAttribute].add(row[3])
+                dependents.add((('resource', row[4]), row[5]))
+
+        for model, pks in cleared.items():
+            if pks:
+                model.objects.filter(pk__in=pks).update(expanded_cache=None)
+        for (owner_model, owner_pk), name in dependents:
+            # Allocation and Resource live in apps of the same name
+            attribute_cache.invalidate(
+                apps.get_model(owner_model, owner_model), owner_pk)
+
+        sources = dependents - seen
+
+
 def convert_type(value, type_name, error_text='unknown'):
     """This returns value with a python type corresponding to type_name.
 
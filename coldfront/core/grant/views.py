@@ -1,4 +1,5 @@
 import csv
+import itertools
 
 from django.contrib import messages
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
@@ -11,6 +12,7 @@ from django.views.generic import DetailView, FormView, ListView, TemplateView
 from django.views.generic.edit import CreateView, UpdateView
 
 from coldfront.core.utils.common import Echo
+from coldfront.core.utils.export import EXPORT_CHUNK_SIZE
 from coldfront.core.grant.forms import GrantDeleteForm, GrantDownloadForm, GrantForm
 from coldfront.core.grant.models import (Grant, GrantFundingAgency,
                                          GrantStatusChoice)
@@ -337,28 +339,24 @@ class GrantDownloadView(LoginRequiredMixin, UserPassesTestMixin, View):
             'Direct Funding',
         ]
 
-        rows = []
-        grants = Grant.objects.prefetch_related('project', 'project__pi').all().order_by('-total_amount_awarded')
-        for grant in grants:
-            row = [
-                grant.title,
-                ' '.join((grant.project.pi.first_name, grant.project.pi.last_name)),
-                grant.role,
-                grant.grant_pi_full_name,
-                grant.total_amount_awarded,
-                grant.funding_agency,
-                grant.grant_number,
-                grant.grant_start,
-                grant.grant_end,
-                grant.percent_credit,
-                grant.direct_funding,
-            ]
-
-            rows.append(row)
-        rows.insert(0, header)
+        grants = Grant.objects.select_related('project__pi').order_by(
+            '-total_amount_awarded').iterator(chunk_size=EXPORT_CHUNK_SIZE)
+        rows = ([
+            grant.title,
+            ' '.join((grant.project.pi.first_name, grant.project.pi.last_name)),
+            grant.role,
+            grant.grant_pi_full_name,
+            grant.total_amount_awarded,
+            grant.funding_agency,
+            grant.grant_number,
+            grant.grant_start,
+            grant.grant_end,
+            grant.percent_credit,
+            grant.direct_funding,
+        ] for grant in grants)
         pseudo_buffer = Echo()
         writer = csv.writer(pseudo_buffer)
-        response = StreamingHttpResponse((writer.writerow(row) for row in rows),
+        response = StreamingHttpResponse((writer.writerow(row) for row in itertools.chain([header], rows)),
                                          content_type="text/csv")
         response['Content-Disposition'] = 'attachment; filename="grants.csv"'
         return response
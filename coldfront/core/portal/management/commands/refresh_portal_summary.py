@@ -0,0 +1,15 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from coldfront.core.portal.tasks import refresh_summary_snapshot
+
+
+class Command(BaseCommand):
+    help = 'Recompute the center summary, allocation summary and allocation by field of science pages'
+
+    def handle(self, *args, **options):
+        start = time.monotonic()
+        snapshot = refresh_summary_snapshot()
+        self.stdout.write('Refreshed portal summary snapshot {} in {:.2f}s'.format(
+            snapshot.pk, time.monotonic() - start))
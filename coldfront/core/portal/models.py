@@ -1,3 +1,24 @@
 from django.db import models
+from model_utils.models import TimeStampedModel
 
-# Create your models here.
+
+class SummarySnapshot(TimeStampedModel):
+    """ A summary snapshot holds the figures and chart data of the portal summary pages, computed by coldfront.core.portal.tasks.refresh_summary_snapshot.
+    
+    Attributes:
+        data (dict): template context of each summary page, keyed by page name (center_summary, allocation_summary and allocation_by_fos)
+    """
+
+    data = models.JSONField()
+
+    @classmethod
+    def latest(cls):
+        """
+        Returns:
+            SummarySnapshot: the most recent snapshot, or None if there is none
+        """
+
+        return cls.objects.order_by('-created', '-pk').first()
+
+    def __str__(self):
+        return 'Summary snapshot {}'.format(self.created)
@@ -0,0 +1,150 @@
+import logging
+import operator
+import time
+
+from django.contrib.humanize.templatetags.humanize import intcomma
+from django.db import transaction
+from django.db.models import Count, FloatField, OuterRef, Subquery, Sum
+
+from coldfront.core.allocation.models import (ALLOCATION_RESOURCE_ORDERING,
+                                              Allocation, AllocationUser)
+from coldfront.core.grant.models import Grant
+from coldfront.core.portal.models import SummarySnapshot
+from coldfront.core.portal.utils import (generate_allocations_chart_data,
+                                         generate_publication_by_year_chart_data,
+                                         generate_resources_chart_data,
+                                         generate_total_grants_by_agency_chart_data)
+from coldfront.core.project.models import Project
+from coldfront.core.publication.models import Publication
+from coldfront.core.research_output.models import ResearchOutput
+from coldfront.core.resource.models import Resource
+
+logger = logging.getLogger(__name__)
+
+
+def center_summary_data():
+    """Returns the center summary page context"""
+    context = {}
+
+    # Publications Card
+    publications_by_year = [
+        (ele['year'], ele['num_pub']) for ele in Publication.objects.filter(
+            year__gte=1999).values('year').annotate(
+            num_pub=Count('unique_id', distinct=True)).order_by('-year')]
+
+    context['publication_by_year_bar_chart_data'] = generate_publication_by_year_chart_data(
+        publications_by_year)
+    context['total_publications_count'] = sum(
+        num_pub for _, num_pub in publications_by_year)
+
+    # Research Outputs card
+    context['total_research_outputs_count'] = ResearchOutput.objects.count()
+
+    # Grants Card
+    amount = Sum('total_amount_awarded', output_field=FloatField())
+    total_grants_by_agency = sorted([['{}: ${} ({})'.format(
+        ele['funding_agency__name'],
+        intcomma(int(ele['total_amount'])),
+        ele['count']
+    ), ele['total_amount']] for ele in Grant.objects.values(
+        'funding_agency__name').annotate(
+        total_amount=amount, count=Count('total_amount_awarded')).order_by()],
+        key=operator.itemgetter(1), reverse=True)
+
+    context['grants_agency_chart_data'] = generate_total_grants_by_agency_chart_data(
+        total_grants_by_agency)
+
+    total_by_role = {ele['role']: ele['total_amount'] or 0 for ele in Grant.objects.values(
+        'role').annotate(total_amount=amount).order_by()}
+    context['grants_total'] = intcomma(int(sum(total_by_role.values())))
+    context['grants_total_pi_only'] = intcomma(int(total_by_role.get('PI', 0)))
+    context['grants_total_copi_only'] = intcomma(int(total_by_role.get('CoPI', 0)))
+    context['grants_total_sp_only'] = intcomma(int(total_by_role.get('SP', 0)))
+
+    return context
+
+
+def allocation_by_fos_data():
+    """Returns the allocations by field of science page context"""
+    fos = 'project__field_of_science__description'
+    allocations_by_fos = {
+        str(ele[fos]): ele['count'] for ele in Allocation.objects.filter(
+            status__name='Active').values(fos).annotate(
+            count=Count('id')).order_by('-count', fos)}
+
+    user_allocations = AllocationUser.objects.filter(
+        status__name='Active', allocation__status__name='Active')
+    active_users_by_fos = {
+        str(ele['allocation__' + fos]): ele['count'] for ele in user_allocations.values(
+            'allocation__' + fos).annotate(count=Count('id')).order_by()}
+
+    context = {}
+    context['allocations_by_fos'] = allocations_by_fos
+    context['active_users_by_fos'] = active_users_by_fos
+    context['total_allocations_users'] = user_allocations.values(
+        'user').distinct().count()
+    context['active_pi_count'] = Project.objects.filter(
+        status__name__in=['Active', 'New']).values('pi').distinct().count()
+    return context
+
+
+def allocation_summary_data():
+    """Returns the allocation summary page context.
+
+    Active allocations are counted by their parent resource, or by the
+    parent of that resource if it has one.
+    """
+    parent_resource = Resource.objects.filter(
+        allocation=OuterRef('pk')).order_by(*ALLOCATION_RESOURCE_ORDERING).values('pk')[:1]
+    counts = {ele['parent_resource']: ele['count'] for ele in Allocation.objects.filter(
+        status__name='Active').annotate(parent_resource=Subquery(parent_resource)).values(
+        'parent_resource').annotate(count=Count('id')).order_by()}
+
+    resources = Resource.objects.select_related(
+        'resource_type', 'parent_resource__resource_type').in_bulk(
+        [pk for pk in counts if pk is not None])
+
+    allocations_count_by_resource = {}
+    allocation_count_by_resource_type = {}
+    for pk, count in counts.items():
+        resource = resources.get(pk)
+        if resource is None:
+            continue
+        resource = resource.parent_resource or resource
+        allocations_count_by_resource.setdefault(resource.pk, {
+            'name': resource.name,
+            'resource_type': resource.resource_type.name,
+            'count': 0,
+        })['count'] += count
+        type_name = resource.resource_type.name
+        allocation_count_by_resource_type[type_name] = \
+            allocation_count_by_resource_type.get(type_name, 0) + count
+
+    context = {}
+    context['allocations_chart_data'] = generate_allocations_chart_data()
+    context['allocations_count_by_resource'] = sorted(
+        allocations_count_by_resource.values(), key=operator.itemgetter('name'))
+    context['resources_chart_data'] = generate_resources_chart_data(
+        allocation_count_by_resource_type)
+    return context
+
+
+def refresh_summary_snapshot():
+    """Computes the portal summary pages and stores them as the latest snapshot.
+
+    Older snapshots are deleted.  Scheduled by add_scheduled_tasks every
+    PORTAL_SUMMARY_REFRESH_MINUTES minutes.
+    """
+    start = time.monotonic()
+    data = {
+        'center_summary': center_summary_data(),
+        'allocation_by_fos': allocation_by_fos_data(),
+        'allocation_summary': allocation_summary_data(),
+    }
+    with transaction.atomic():
+        snapshot = SummarySnapshot.objects.create(data=data)
+        SummarySnapshot.objects.exclude(pk=snapshot.pk).delete()
+
+    logger.info('Refreshed portal summary snapshot in %.2fs',
+                time.monotonic() - start)
+    return snapshot
@@ -1,3 +1,106 @@
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 
-# Create your tests here.
+from coldfront.core.allocation.models import Allocation, AllocationStatusChoice
+from coldfront.core.grant.models import Grant
+from coldfront.core.portal import tasks
+from coldfront.core.portal.models import SummarySnapshot
+from coldfront.core.publication.models import Publication
+from coldfront.core.test_helpers.factories import (
+    AllocationUserFactory,
+    FieldOfScienceFactory,
+    GrantFundingAgencyFactory,
+    GrantStatusChoiceFactory,
+    ProjectFactory,
+    ProjectStatusChoiceFactory,
+    PublicationSourceFactory,
+    ResourceFactory,
+    ResourceTypeFactory,
+)
+
+
+class SummarySnapshotTests(TestCase):
+    """tests for the portal summary snapshot"""
+
+    @classmethod
+    def setUpTestData(cls):
+        """Set up allocations, grants and publications to summarize"""
+        physics = FieldOfScienceFactory(description='Physics')
+        project = ProjectFactory(title='lab1', field_of_science=physics,
+                                 status=ProjectStatusChoiceFactory(name='Active'))
+        cluster = ResourceFactory(name='cluster', resource_type=ResourceTypeFactory(name='Cluster'))
+        partition = ResourceFactory(name='cluster-gpu', parent_resource=cluster,
+                                    resource_type=ResourceTypeFactory(name='Cluster Partition'))
+        storage = ResourceFactory(name='storage', resource_type=ResourceTypeFactory(name='Storage'))
+
+        active = AllocationStatusChoice.objects.get_or_create(name='Active')[0]
+        AllocationStatusChoice.objects.get_or_create(name='New')
+        for resources in [[cluster], [partition], [storage, cluster], [storage]]:
+            allocation = Allocation.objects.create(
+                project=project, status=active, justification='test')
+            allocation.resources.add(*resources)
+            AllocationUserFactory(allocation=allocation, user=project.pi)
+
+        agency = GrantFundingAgencyFactory(name='NSF')
+        status = GrantStatusChoiceFactory(name='Active')
+        for role, amount in [('PI', 1000), ('PI', 500), ('CoPI', 250)]:
+            Grant.objects.create(
+                project=project, title='grant', role=role, grant_pi_full_name='pi',
+                funding_agency=agency, grant_start='2024-01-01', grant_end='2025-01-01',
+                percent_credit=10, direct_funding=1, total_amount_awarded=amount,
+                status=status)
+
+        source = PublicationSourceFactory()
+        for unique_id, year in [('a', 2020), ('b', 2020), ('c', 2021), ('d', 1990)]:
+            Publication.objects.create(
+                project=project, title=unique_id, author='author', year=year,
+                journal='journal', unique_id=unique_id, source=source)
+
+    def test_snapshot_figures(self):
+        """test that the snapshot holds the summary figures"""
+        data = tasks.refresh_summary_snapshot().data
+
+        center = data['center_summary']
+        self.assertEqual(center['total_publications_count'], 3)
+        self.assertEqual(center['publication_by_year_bar_chart_data']['columns'],
+                         [['Year', 2021, 2020], ['Publications', 1, 2]])
+        self.assertEqual(center['grants_total'], '1,750')
+        self.assertEqual(center['grants_total_pi_only'], '1,500')
+        self.assertEqual(center['grants_total_copi_only'], '250')
+        self.assertEqual(center['grants_total_sp_only'], '0')
+        self.assertEqual(center['grants_agency_chart_data']['columns'],
+                         [['NSF: $1,750 (3)', 1750.0]])
+
+        by_fos = data['allocation_by_fos']
+        self.assertEqual(by_fos['allocations_by_fos'], {'Physics': 4})
+        self.assertEqual(by_fos['active_users_by_fos'], {'Physics': 4})
+        self.assertEqual(by_fos['total_allocations_users'], 1)
+        self.assertEqual(by_fos['active_pi_count'], 1)
+
+        summary = data['allocation_summary']
+        self.assertEqual(summary['allocations_count_by_resource'], [
+            {'name': 'cluster', 'resource_type': 'Cluster', 'count': 3},
+            {'name': 'storage', 'resource_type': 'Storage', 'count': 1},
+        ])
+        self.assertIn(['Cluster: 3', 3], summary['resources_chart_data']['columns'])
+        self.assertIn(['Active: 4', 4], summary['allocations_chart_data']['columns'])
+
+    def test_views_read_snapshot(self):
+        """test that the summary pages are served from the latest snapshot"""
+        tasks.refresh_summary_snapshot()
+        snapshot = tasks.refresh_summary_snapshot()
+        self.assertEqual(list(SummarySnapshot.objects.all()), [snapshot])
+
+        for url in ['/center-summary', '/allocation-summary', '/allocation-by-fos']:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(queries), 1)
+        self.assertContains(response, 'Physics')
+
+    def test_first_view_creates_snapshot(self):
+        """test that a snapshot is computed if none exists yet"""
+        response = self.client.get('/center-summary')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(SummarySnapshot.objects.count(), 1)
@@ -1,5 +1,7 @@
 import datetime
 
+from django.db.models import Count, Q
+
 from coldfront.core.allocation.models import Allocation
 
 
@@ -79,14 +81,17 @@ def generate_resources_chart_data(allocations_count_by_resource_type):
 
 def generate_allocations_chart_data():
 
-    active_count = Allocation.objects.filter(status__name='Active').count()
-    new_count = Allocation.objects.filter(status__name='New').count()
-    renewal_requested_count = Allocation.objects.filter(status__name='Renewal Requested').count()
-
     now = datetime.datetime.now()
     start_time = datetime.date(now.year - 1, 1, 1)
-    expired_count = Allocation.objects.filter(
-        status__name='Expired', end_date__gte=start_time).count()
+    counts = Allocation.objects.aggregate(
+        active=Count('id', filter=Q(status__name='Active')),
+        new=Count('id', filter=Q(status__name='New')),
+        renewal_requested=Count('id', filter=Q(status__name='Renewal Requested')),
+        expired=Count('id', filter=Q(status__name='Expired', end_date__gte=start_time)))
+    active_count = counts['active']
+    new_count = counts['new']
+    renewal_requested_count = counts['renewal_requested']
+    expired_count = counts['expired']
 
     active_label = "Active: %d" % (active_count)
     new_label = "New: %d" % (new_count)
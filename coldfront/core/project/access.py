@@ -0,0 +1,105 @@
+"""Maintenance of the ProjectUserAccess permission index.
+
+rebuild() recomputes the index rows of a set of users and/or projects
+from ProjectUser, Project and AllocationUser with a few set-based
+queries, replacing the existing rows in one transaction.  The signal
+receivers in coldfront.core.project.signals call it for the affected
+user and project whenever memberships change.
+"""
+import logging
+from collections import defaultdict
+
+from django.db import transaction
+
+from coldfront.core.allocation.models import Allocation, AllocationUser
+from coldfront.core.project.models import ProjectUser, ProjectUserAccess
+
+logger = logging.getLogger(__name__)
+
+# Membership statuses granting permissions, see Project.user_permissions
+# and Allocation.user_permissions
+ACCESS_STATUSES = ('Active', 'New')
+
+
+def _ids(objs):
+    return [getattr(obj, 'pk', obj) for obj in objs]
+
+
+def compute(users=None, projects=None):
+    """Returns unsaved ProjectUserAccess rows for users and projects
+
+    users and projects are iterables of model instances or primary keys.
+    If either is None, rows are not restricted on it.
+    """
+    memberships = ProjectUser.objects.filter(status__name__in=ACCESS_STATUSES)
+    allocation_users = AllocationUser.objects.filter(status__name__in=ACCESS_STATUSES)
+    if users is not None:
+        memberships = memberships.filter(user_id__in=_ids(users))
+        allocation_users = allocation_users.filter(user_id__in=_ids(users))
+    if projects is not None:
+        memberships = memberships.filter(project_id__in=_ids(projects))
+
+    memberships = list(memberships.values_list(
+        'user_id', 'project_id', 'status__name', 'role__name', 'project__pi_id'))
+    project_ids = {project_id for _, project_id, _, _, _ in memberships}
+
+    allocations = defaultdict(list)
+    for allocation_id, project_id in Allocation.objects.filter(
+            project_id__in=project_ids).values_list('pk', 'project_id'):
+        allocations[project_id].append(allocation_id)
+
+    allocation_user_status = {
+        (user_id, allocation_id): status
+        for user_id, allocation_id, status in allocation_users.filter(
+            allocation__project_id__in=project_ids
+        ).values_list('user_id', 'allocation_id', 'status__name')
+    }
+
+    rows = []
+    for user_id, project_id, status, role, pi_id in memberships:
+        bits = ProjectUserAccess.USER
+        if role == 'Manager':
+            bits |= ProjectUserAccess.MANAGER | ProjectUserAccess.UPDATE
+        if pi_id == user_id:
+            bits |= ProjectUserAccess.PI
+        rows.append(ProjectUserAccess(
+            user_id=user_id, project_id=project_id, permissions=bits))
+
+        for allocation_id in allocations[project_id]:
+            allocation_status = allocation_user_status.get((user_id, allocation_id))
+            if bits & (ProjectUserAccess.MANAGER | ProjectUserAccess.PI):
+                allocation_bits = ProjectUserAccess.USER | ProjectUserAccess.MANAGER
+            elif allocation_status:
+                allocation_bits = ProjectUserAccess.USER
+            else:
+                continue
+
+            # Matches the default filter of AllocationListView
+            if status == 'Active' and (role == 'Manager' or allocation_status == 'Active'):
+                allocation_bits |= ProjectUserAccess.LISTED
+
+            rows.append(ProjectUserAccess(
+                user_id=user_id, project_id=project_id,
+                allocation_id=allocation_id, permissions=allocation_bits))
+
+    return rows
+
+
+def rebuild(users=None, projects=None, batch_size=1000):
+    """Replaces the index rows of users and projects, returns the new row count
+
+    With no arguments the whole index is rebuilt.
+    """
+    rows = compute(users=users, projects=projects)
+
+    existing = ProjectUserAccess.objects.all()
+    if users is not None:
+        existing = existing.filter(user_id__in=_ids(users))
+    if projects is not None:
+        existing = existing.filter(project_id__in=_ids(projects))
+
+    with transaction.atomic():
+        existing.delete()
+        ProjectUserAccess.objects.bulk_create(rows, batch_size=batch_size)
+
+    return len(rows)
@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class ProjectConfig(AppConfig):
     name = 'coldfront.core.project'
+
+    def ready(self):
+        import coldfront.core.project.signals
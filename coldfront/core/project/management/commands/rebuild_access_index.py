@@ -0,0 +1,59 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from coldfront.core.allocation.models import AllocationUser
+from coldfront.core.project import access
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the project and allocation access index'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--benchmark', type=int, metavar='N', default=0,
+            help='Compare permission checks with and without the index on N sampled allocation users')
+
+    def handle(self, *args, **options):
+        start = time.monotonic()
+        count = access.rebuild()
+        self.stdout.write('Rebuilt access index with {} rows in {:.2f}s'.format(
+            count, time.monotonic() - start))
+
+        if options['benchmark']:
+            self.benchmark(options['benchmark'])
+
+    def _check(self, pairs, use_index):
+        """Returns permissions for pairs, elapsed seconds and query count"""
+        queries = []
+
+        def count_query(execute, sql, params, many, context):
+            queries.append(sql)
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(count_query):
+            start = time.monotonic()
+            perms = [allocation.user_permissions(user, use_index=use_index) for user, allocation in pairs]
+            elapsed = time.monotonic() - start
+        return perms, elapsed, len(queries)
+
+    def benchmark(self, n):
+        pks = list(AllocationUser.objects.values_list('pk', flat=True))
+        sample = random.sample(pks, min(n, len(pks)))
+        pairs = [(au.user, au.allocation) for au in AllocationUser.objects.filter(
+            pk__in=sample).select_related('user', 'allocation__project')]
+        if not pairs:
+            self.stdout.write('No allocation users to benchmark')
+            return
+
+        direct, direct_time, direct_queries = self._check(pairs, False)
+        indexed, indexed_time, indexed_queries = self._check(pairs, True)
+
+        mismatches = sum(1 for a, b in zip(direct, indexed) if a != b)
+        for label, elapsed, queries in [('queries', direct_time, direct_queries),
+                                        ('index', indexed_time, indexed_queries)]:
+            self.stdout.write('{:<8} {:>8.3f} ms/check {:>6.2f} queries/check'.format(
+                label, 1000 * elapsed / len(pairs), queries / len(pairs)))
+        self.stdout.write('{} checks, {} mismatches'.format(len(pairs), mismatches))
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.11 on 2026-10-18 17:24
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('allocation', '0005_auto_20211117_1413'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('project', '0004_auto_20230406_1133'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProjectUserAccess',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('permissions', models.PositiveSmallIntegerField(default=0)),
+                ('allocation', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='allocation.allocation')),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='project.project')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'allocation'], name='project_pro_user_id_989f17_idx')],
+                'unique_together': {('user', 'project', 'allocation')},
+            },
+        ),
+    ]
@@ -15,6 +15,7 @@ from coldfront.core.field_of_science.models import FieldOfScience
 from coldfront.core.utils.common import import_from_settings
 
 PROJECT_ENABLE_PROJECT_REVIEW = import_from_settings('PROJECT_ENABLE_PROJECT_REVIEW', False)
+PROJECT_ACCESS_INDEX_ENABLED = import_from_settings('PROJECT_ACCESS_INDEX_ENABLED', False)
 
 class ProjectPermission(Enum):
     """ A project permission stores the user, manager, pi, and update fields of a project. """
@@ -177,10 +178,11 @@ We do not have information about your research. Please provide a detailed descri
 
         return False
 
-    def user_permissions(self, user):
+    def user_permissions(self, user, use_index=None):
         """
         Params:
             user (User): represents the user whose permissions are to be retrieved
+            use_index (bool): whether to read the access index, defaults to PROJECT_ACCESS_INDEX_ENABLED
 
         Returns:
             list[ProjectPermission]: a list of the user's permissions for the project
@@ -189,6 +191,13 @@ We do not have information about your research. Please provide a detailed descri
         if user.is_superuser:
             return list(ProjectPermission)
 
+        if use_index is None:
+            use_index = ProjectUserAccess.is_enabled()
+
+        if use_index:
+            bits = ProjectUserAccess.objects.permissions(user, project=self)
+            return [perm for perm, bit in ProjectUserAccess.PROJECT_PERMISSION_BITS if bits & bit]
+
         user_conditions = (models.Q(status__name__in=('Active', 'New')) & models.Q(user=user))
         if not self.projectuser_set.filter(user_conditions).exists():
             return []
@@ -358,6 +367,85 @@ class ProjectUser(TimeStampedModel):
         unique_together = ('user', 'project')
         verbose_name_plural = "Project User Status"
 
+class ProjectUserAccessManager(models.Manager):
+    def permissions(self, user, project=None, allocation=None):
+        """
+        Params:
+            user (User): user whose permissions to look up
+            project (Project): project to look up, if allocation is not given
+            allocation (Allocation): allocation to look up
+
+        Returns:
+            int: permission bits of the user, 0 if the user has no access
+        """
+
+        if allocation is not None:
+            rows = self.filter(user=user, allocation=allocation)
+        else:
+            rows = self.filter(user=user, project=project, allocation__isnull=True)
+        return rows.values_list('permissions', flat=True).first() or 0
+
+    def listed_allocations(self, user):
+        """
+        Params:
+            user (User): user whose allocations to return
+
+        Returns:
+            QuerySet: ids of the allocations listed on the user's allocation list page
+        """
+
+        return self.filter(user=user, allocation__isnull=False).annotate(
+            listed=models.F('permissions').bitand(ProjectUserAccess.LISTED)
+        ).filter(listed=ProjectUserAccess.LISTED).values('allocation_id')
+
+class ProjectUserAccess(models.Model):
+    """ A project user access row is a denormalized copy of a user's permissions on a project or one of its allocations. Rows are kept current by signals on Project, ProjectUser, Allocation and AllocationUser and can be rebuilt with the rebuild_access_index command.
+    
+    Attributes:
+        user (User): user the permissions belong to
+        project (Project): project the permissions apply to
+        allocation (Allocation): allocation the permissions apply to, empty for the project permissions
+        permissions (int): bitwise OR of the permission bits
+    """
+
+    USER = 1
+    MANAGER = 2
+    PI = 4
+    UPDATE = 8
+    # Allocation is shown on the user's allocation list page
+    LISTED = 16
+
+    PROJECT_PERMISSION_BITS = (
+        (ProjectPermission.USER, USER),
+        (ProjectPermission.MANAGER, MANAGER),
+        (ProjectPermission.PI, PI),
+        (ProjectPermission.UPDATE, UPDATE),
+    )
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    project = models.ForeignKey(Project, on_delete=models.CASCADE)
+    allocation = models.ForeignKey('allocation.Allocation', on_delete=models.CASCADE, null=True, blank=True)
+    permissions = models.PositiveSmallIntegerField(default=0)
+    objects = ProjectUserAccessManager()
+
+    class Meta:
+        unique_together = ('user', 'project', 'allocation')
+        indexes = [
+            models.Index(fields=['user', 'allocation']),
+        ]
+
+    @staticmethod
+    def is_enabled():
+        """
+        Returns:
+            bool: whether permission checks use the access index
+        """
+
+        return PROJECT_ACCESS_INDEX_ENABLED
+
+    def __str__(self):
+        return '%s %s %s (%s)' % (self.user.username, self.project_id, self.allocation_id, self.permissions)
+
 class AttributeType(TimeStampedModel):
     """ An attribute type indicates the data type of the attribute. Examples include Date, Float, Int, Text, and Yes/No. 
     
@@ -0,0 +1,43 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from coldfront.core.allocation.models import Allocation, AllocationUser
+from coldfront.core.project import access
+from coldfront.core.project.models import (Project, ProjectUser,
+                                           ProjectUserAccess)
+
+
+def _rebuild(users=None, projects=None):
+    if ProjectUserAccess.is_enabled():
+        transaction.on_commit(
+            lambda: access.rebuild(users=users, projects=projects))
+
+
+@receiver(post_save, sender=ProjectUser)
+@receiver(post_delete, sender=ProjectUser)
+def update_project_user_access(sender, instance, **kwargs):
+    _rebuild(users=[instance.user_id], projects=[instance.project_id])
+
+
+@receiver(post_save, sender=Project)
+def update_project_access(sender, instance, created, **kwargs):
+    # The PI may have changed
+    if not created:
+        _rebuild(projects=[instance.pk])
+
+
+@receiver(post_save, sender=Allocation)
+def update_allocation_access(sender, instance, created, **kwargs):
+    if created:
+        _rebuild(projects=[instance.project_id])
+
+
+@receiver(post_save, sender=AllocationUser)
+@receiver(post_delete, sender=AllocationUser)
+def update_allocation_user_access(sender, instance, **kwargs):
+    if not ProjectUserAccess.is_enabled():
+        return
+    project_ids = list(Allocation.objects.filter(
+        pk=instance.allocation_id).values_list('project_id', flat=True))
+    _rebuild(users=[instance.user_id], projects=project_ids)
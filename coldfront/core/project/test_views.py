@@ -1,10 +1,17 @@
 import logging
 
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 
 from coldfront.core.test_helpers import utils
 from coldfront.core.test_helpers.factories import (
     UserFactory,
+    ResourceFactory,
+    AllocationUserFactory,
+    AllocationAttributeFactory,
+    AllocationAttributeUsageFactory,
+    AllocationAttributeTypeFactory,
     ProjectFactory,
     ProjectUserFactory,
     PAttributeTypeFactory,
@@ -13,6 +20,7 @@ from coldfront.core.test_helpers.factories import (
     ProjectAttributeTypeFactory,
     ProjectUserRoleChoiceFactory,
 )
+from coldfront.core.allocation.models import Allocation, AllocationStatusChoice
 from coldfront.core.project.models import ProjectUserStatusChoice
 
 logging.disable(logging.CRITICAL)
@@ -115,6 +123,44 @@ class ProjectDetailViewTest(ProjectViewTestBase):
         # non-manager user cannot see add notification button
         utils.page_does_not_contain_for_user(self, self.project_user, self.url, 'Add Notification')
 
+    def test_projectdetail_query_count(self):
+        """Test that the number of queries does not grow with the project"""
+        def count_queries(user):
+            self.client.force_login(user, backend=self.backend)
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(self.url)
+            self.assertEqual(response.status_code, 200)
+            return len(queries)
+
+        def add_allocation():
+            allocation = Allocation.objects.create(
+                project=self.project,
+                status=AllocationStatusChoice.objects.get_or_create(name='Active')[0],
+                justification='test')
+            allocation.resources.add(ResourceFactory())
+            attribute = AllocationAttributeFactory(
+                allocation=allocation, value=100,
+                allocation_attribute_type=AllocationAttributeTypeFactory(name='Storage Quota (TB)'))
+            AllocationAttributeUsageFactory(allocation_attribute=attribute, value=10)
+            AllocationUserFactory(allocation=allocation, user=self.pi_user)
+            for user in users:
+                AllocationUserFactory(allocation=allocation, user=user)
+
+        users = []
+        add_allocation()
+        before = {user: count_queries(user) for user in [self.admin_user, self.pi_user]}
+        for i in range(10):
+            user = UserFactory(username='extra{}'.format(i))
+            ProjectUserFactory(project=self.project, user=user)
+            ProjectAttributeFactory(project=self.project, proj_attr_type=self.projectattributetype)
+            users.append(user)
+        for i in range(5):
+            add_allocation()
+
+        for user, count in before.items():
+            self.assertEqual(count_queries(user), count)
+            self.assertLessEqual(count, 25)
+
 
 class ProjectCreateTest(ProjectViewTestBase):
     """Tests for project create view"""
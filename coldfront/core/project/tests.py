@@ -1,21 +1,40 @@
 import logging
+from io import StringIO
+from unittest import mock
 
+from django.contrib import admin
 from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import Q
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 
+from coldfront.core.allocation.admin import AllocationUserAdmin
+from coldfront.core.allocation.models import Allocation, AllocationUser
 from coldfront.core.test_helpers.factories import (
     UserFactory,
     ProjectFactory,
+    AllocationFactory,
+    AllocationUserFactory,
+    AllocationUserStatusChoiceFactory,
     FieldOfScienceFactory,
+    ProjectUserFactory,
     ProjectAttributeFactory,
     ProjectStatusChoiceFactory,
     ProjectAttributeTypeFactory,
+    ProjectUserRoleChoiceFactory,
+    ProjectUserStatusChoiceFactory,
     PAttributeTypeFactory,
 )
+from coldfront.core.project import access
+from coldfront.core.project import models as project_models
 from coldfront.core.project.models import (
     Project,
     ProjectAttribute,
     ProjectAttributeType,
+    ProjectPermission,
+    ProjectUserAccess,
 )
 
 logging.disable(logging.CRITICAL)
@@ -205,3 +224,116 @@ class TestProjectAttribute(TestCase):
         )
         with self.assertRaises(ValidationError):
             new_attr.clean()
+
+
+class ProjectUserAccessTests(TestCase):
+    """Tests that the access index matches the query based permissions"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.pi = UserFactory(username='pi')
+        cls.manager = UserFactory(username='manager')
+        cls.member = UserFactory(username='member')
+        cls.newcomer = UserFactory(username='newcomer')
+        cls.removed = UserFactory(username='removed')
+        cls.outsider = UserFactory(username='outsider')
+        cls.users = [cls.pi, cls.manager, cls.member, cls.newcomer, cls.removed, cls.outsider]
+
+        cls.project = ProjectFactory(title='access_lab', pi=cls.pi,
+                                     status=ProjectStatusChoiceFactory(name='Active'))
+        manager_role = ProjectUserRoleChoiceFactory(name='Manager')
+        for user, role, status in [
+                (cls.pi, manager_role, 'Active'),
+                (cls.manager, manager_role, 'Active'),
+                (cls.member, None, 'Active'),
+                (cls.newcomer, None, 'New'),
+                (cls.removed, None, 'Removed')]:
+            kwargs = {'role': role} if role else {}
+            ProjectUserFactory(project=cls.project, user=user,
+                               status=ProjectUserStatusChoiceFactory(name=status), **kwargs)
+
+        cls.allocations = [AllocationFactory(project=cls.project)]
+        cls.allocations.append(Allocation.objects.create(
+            project=cls.project, status=cls.allocations[0].status, justification='second'))
+        for user in [cls.member, cls.newcomer, cls.removed]:
+            AllocationUserFactory(allocation=cls.allocations[0], user=user)
+
+    def setUp(self):
+        patcher = mock.patch.object(project_models, 'PROJECT_ACCESS_INDEX_ENABLED', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        access.rebuild()
+
+    def _permissions(self, use_index):
+        perms = [self.project.user_permissions(user, use_index=use_index) for user in self.users]
+        for allocation in self.allocations:
+            perms.extend(allocation.user_permissions(user, use_index=use_index) for user in self.users)
+        return perms
+
+    def assertIndexMatches(self):
+        self.assertEqual(self._permissions(True), self._permissions(False))
+        rows = sorted(ProjectUserAccess.objects.values_list(
+            'user_id', 'project_id', 'allocation_id', 'permissions'), key=str)
+        self.assertEqual(rows, sorted(
+            [(r.user_id, r.project_id, r.allocation_id, r.permissions) for r in access.compute()],
+            key=str))
+
+    def test_index_matches_queries(self):
+        """test that indexed permissions equal the query based permissions"""
+        self.assertIndexMatches()
+        self.assertEqual(self.project.user_permissions(self.manager), [
+            ProjectPermission.USER, ProjectPermission.MANAGER, ProjectPermission.UPDATE])
+
+    def test_signals_keep_index_current(self):
+        """test that membership changes update the index"""
+        with self.captureOnCommitCallbacks(execute=True):
+            self.project.projectuser_set.filter(user=self.manager).delete()
+            member = self.project.projectuser_set.get(user=self.member)
+            member.role = ProjectUserRoleChoiceFactory(name='Manager')
+            member.save()
+            AllocationUser.objects.get(user=self.newcomer).delete()
+            self.project.pi = self.member
+            self.project.save()
+            self.allocations.append(Allocation.objects.create(
+                project=self.project, status=self.allocations[0].status, justification='third'))
+        self.assertIndexMatches()
+
+    def test_admin_status_actions_update_index(self):
+        """test that admin status actions on a filtered changelist update the index"""
+        AllocationUserStatusChoiceFactory(name='Removed')
+        model_admin = AllocationUserAdmin(AllocationUser, admin.site)
+        # The changelist filtered by status no longer matches the updated rows
+        model_admin.set_removed(None, AllocationUser.objects.filter(
+            status__name='Active', user=self.member))
+        self.assertNotIn(self.allocations[0].pk, ProjectUserAccess.objects.listed_allocations(
+            self.member).values_list('allocation_id', flat=True))
+        self.assertIndexMatches()
+
+    def test_signals_skipped_when_disabled(self):
+        """test that allocation user saves do not look up the project when the index is off"""
+        allocation_user = AllocationUser.objects.get(user=self.member)
+        allocation_user = AllocationUser.objects.get(pk=allocation_user.pk)
+        with mock.patch.object(project_models, 'PROJECT_ACCESS_INDEX_ENABLED', False), \
+                CaptureQueriesContext(connection) as queries:
+            allocation_user.save()
+        self.assertFalse([q for q in queries if '"allocation_allocation"' in q['sql']])
+
+    def test_rebuild_command_benchmark(self):
+        """test that the benchmark finds no mismatches between the two checks"""
+        out = StringIO()
+        call_command('rebuild_access_index', '--benchmark', '10', stdout=out)
+        self.assertIn('3 checks, 0 mismatches', out.getvalue())
+
+    def test_listed_allocations(self):
+        """test that listed allocations match the allocation list filter"""
+        for user in self.users:
+            expected = set(Allocation.objects.filter(
+                Q(project__projectuser__status__name='Active') &
+                Q(project__projectuser__user=user) &
+                (Q(project__projectuser__role__name='Manager') |
+                 Q(allocationuser__user=user) &
+                 Q(allocationuser__status__name='Active'))
+            ).values_list('pk', flat=True))
+            listed = set(ProjectUserAccess.objects.listed_allocations(user).values_list(
+                'allocation_id', flat=True))
+            self.assertEqual(listed, expected, user)
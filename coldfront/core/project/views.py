@@ -14,7 +14,7 @@ from django.contrib.auth.models import User
 from coldfront.core.utils.common import import_from_settings
 from django.contrib.messages.views import SuccessMessageMixin
 from django.core.paginator import EmptyPage, PageNotAnInteger, Paginator
-from django.db.models import Q
+from django.db.models import Prefetch, Q
 from django.forms import formset_factory, modelformset_factory
 from django.http import (HttpResponse, HttpResponseForbidden,
                          HttpResponseRedirect)
@@ -28,9 +28,11 @@ from django.views.generic.base import TemplateView
 from django.views.generic.edit import FormView
 
 from coldfront.core.allocation.models import (Allocation,
+                                              AllocationAttribute,
                                               AllocationStatusChoice,
                                               AllocationUser,
-                                              AllocationUserStatusChoice)
+                                              AllocationUserStatusChoice,
+                                              ordered_resources_prefetch)
 from coldfront.core.allocation.signals import (allocation_activate_user,
                                                allocation_remove_user)
 from coldfront.core.grant.models import Grant
@@ -88,44 +90,77 @@ class ProjectDetailView(LoginRequiredMixin, UserPassesTestMixin, DetailView):
 
         project_obj = self.get_object()
 
-        if project_obj.projectuser_set.filter(user=self.request.user, status__name='Active').exists():
+        if any(project_user.user_id == self.request.user.pk and project_user.status.name == 'Active'
+               for project_user in project_obj.listed_users):
             return True
 
         messages.error(
             self.request, 'You do not have permission to view the previous page.')
         return False
 
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-        # Can the user update the project?
+    def get_allocations(self):
+        """Returns the allocations of the project the user may see"""
+        if self.request.user.is_superuser or self.request.user.has_perm('allocation.can_view_all_allocations'):
+            return Allocation.objects.filter(project=self.object).order_by('-end_date')
+
+        if self.object.status.name in ['Active', 'New', ]:
+            return Allocation.objects.filter(
+                Q(project=self.object) &
+                Q(project__projectuser__user=self.request.user) &
+                Q(project__projectuser__status__name__in=['Active', ]) &
+                Q(allocationuser__user=self.request.user) &
+                Q(allocationuser__status__name__in=['Active', ])
+            ).distinct().order_by('-end_date')
+
+        return Allocation.objects.filter(project=self.object)
+
+    def get_prefetch_plan(self):
+        """Returns the related objects loaded with the project.
+
+        Everything the detail page shows is loaded here, limited to what the
+        user may see, so the number of queries does not depend on the number
+        of users, allocations or attributes of the project.
+        """
+        attributes = ProjectAttribute.objects.select_related(
+            'proj_attr_type', 'projectattributeusage')
         if self.request.user.is_superuser:
-            context['is_allowed_to_update_project'] = True
-        elif self.object.projectuser_set.filter(user=self.request.user).exists():
-            project_user = self.object.projectuser_set.get(
-                user=self.request.user)
-            if project_user.role.name == 'Manager':
-                context['is_allowed_to_update_project'] = True
-            else:
-                context['is_allowed_to_update_project'] = False
+            attributes = attributes.order_by('proj_attr_type__name')
         else:
-            context['is_allowed_to_update_project'] = False
+            attributes = attributes.filter(proj_attr_type__is_private=False)
+
+        return [
+            Prefetch('projectuser_set',
+                     queryset=ProjectUser.objects.select_related(
+                         'user', 'role', 'status').order_by('user__username'),
+                     to_attr='listed_users'),
+            Prefetch('projectattribute_set', queryset=attributes,
+                     to_attr='visible_attributes'),
+            Prefetch('projectusermessage_set',
+                     queryset=ProjectUserMessage.objects.select_related('author')),
+        ]
 
-        pk = self.kwargs.get('pk')
-        project_obj = get_object_or_404(Project, pk=pk)
+    def get_object(self, queryset=None):
+        """Returns the project with the prefetch plan applied, loaded once per request"""
+        if not hasattr(self, '_project'):
+            queryset = Project.objects.select_related(
+                'pi', 'status', 'field_of_science'
+            ).prefetch_related(*self.get_prefetch_plan())
+            self._project = super().get_object(queryset)
+        return self._project
 
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        # Can the user update the project?
         if self.request.user.is_superuser:
-            attributes_with_usage = [attribute for attribute in project_obj.projectattribute_set.all(
-            ).order_by('proj_attr_type__name') if hasattr(attribute, 'projectattributeusage')]
-
-            attributes = [attribute for attribute in project_obj.projectattribute_set.all(
-            ).order_by('proj_attr_type__name')]
-
+            context['is_allowed_to_update_project'] = True
         else:
-            attributes_with_usage = [attribute for attribute in project_obj.projectattribute_set.filter(
-                proj_attr_type__is_private=False) if hasattr(attribute, 'projectattributeusage')]
+            context['is_allowed_to_update_project'] = any(
+                project_user.user_id == self.request.user.pk and project_user.role.name == 'Manager'
+                for project_user in self.object.listed_users)
 
-            attributes = [attribute for attribute in project_obj.projectattribute_set.filter(
-                proj_attr_type__is_private=False)]
+        attributes = self.object.visible_attributes
+        attributes_with_usage = [attribute for attribute in attributes
+                                 if hasattr(attribute, 'projectattributeusage')]
 
         guage_data = []
         invalid_attributes = []
@@ -142,34 +177,24 @@ class ProjectDetailView(LoginRequiredMixin, UserPassesTestMixin, DetailView):
             attributes_with_usage.remove(a)
 
         # Only show 'Active Users'
-        project_users = self.object.projectuser_set.filter(
-            status__name='Active').order_by('user__username')
+        project_users = [project_user for project_user in self.object.listed_users
+                         if project_user.status.name == 'Active']
 
         context['mailto'] = 'mailto:' + \
             ','.join([user.user.email for user in project_users])
 
-        if self.request.user.is_superuser or self.request.user.has_perm('allocation.can_view_all_allocations'):
-            allocations = Allocation.objects.prefetch_related(
-                'resources').filter(project=self.object).order_by('-end_date')
-        else:
-            if self.object.status.name in ['Active', 'New', ]:
-                allocations = Allocation.objects.filter(
-                    Q(project=self.object) &
-                    Q(project__projectuser__user=self.request.user) &
-                    Q(project__projectuser__status__name__in=['Active', ]) &
-                    Q(allocationuser__user=self.request.user) &
-                    Q(allocationuser__status__name__in=['Active', ])
-                ).distinct().order_by('-end_date')
-            else:
-                allocations = Allocation.objects.prefetch_related(
-                    'resources').filter(project=self.object)
+        allocations = list(self.get_allocations().select_related('status').prefetch_related(
+            ordered_resources_prefetch(),
+            Prefetch('allocationattribute_set',
+                     queryset=AllocationAttribute.objects.select_related(
+                         'allocation_attribute_type', 'allocationattributeusage'))))
 
         context['publications'] = Publication.objects.filter(
-            project=self.object, status='Active').order_by('-year')
+            project=self.object, status='Active').select_related('source').order_by('-year')
         context['research_outputs'] = ResearchOutput.objects.filter(
-            project=self.object).order_by('-created')
+            project=self.object).select_related('created_by').order_by('-created')
         context['grants'] = Grant.objects.filter(
-            project=self.object, status__name__in=['Active', 'Pending', 'Archived'])
+            project=self.object, status__name__in=['Active', 'Pending', 'Archived']).select_related('status')
         context['allocations'] = allocations
         context['attributes'] = attributes
         context['guage_data'] = guage_data
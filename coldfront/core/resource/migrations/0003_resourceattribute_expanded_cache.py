@@ -0,0 +1,18 @@
+# Generated by Django 4.2.11 on 2026-10-18 17:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('resource', '0002_auto_20191017_1141'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='resourceattribute',
+            name='expanded_cache',
+            field=models.TextField(blank=True, editable=False, null=True),
+        ),
+    ]
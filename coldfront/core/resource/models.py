@@ -5,6 +5,7 @@ from django.core.exceptions import ValidationError
 from django.db import models
 from model_utils.models import TimeStampedModel
 from simple_history.models import HistoricalRecords
+import coldfront.core.attribute_cache as attribute_cache
 import coldfront.core.attribute_expansion as attribute_expansion
 
 class AttributeType(TimeStampedModel):
@@ -173,8 +174,8 @@ class Resource(TimeStampedModel):
             str: the value of the first attribute found for this resource with the specified name
         """
 
-        attr = self.resourceattribute_set.filter(
-            resource_attribute_type__name=name).first()
+        attrs = attribute_cache.get_attributes(self, name)
+        attr = attrs[0] if attrs else None
         if attr:
             if expand:
                 return attr.expanded_value(
@@ -199,8 +200,7 @@ class Resource(TimeStampedModel):
             list: the list of values of the attributes found with specified name
         """
 
-        attr = self.resourceattribute_set.filter(
-            resource_attribute_type__name=name).all()
+        attr = attribute_cache.get_attributes(self, name)
         if expand:
             return [a.expanded_value(extra_allocations=extra_allocations,
                 typed=typed) for a in attr]
@@ -216,10 +216,9 @@ class Resource(TimeStampedModel):
             str: If the resource has OnDemand status or not
         """
 
-        ondemand = self.resourceattribute_set.filter(
-            resource_attribute_type__name='OnDemand').first()
+        ondemand = attribute_cache.get_attributes(self, 'OnDemand')
         if ondemand:
-            return ondemand.value
+            return ondemand[0].value
         return None
             
     def __str__(self):
@@ -235,13 +234,32 @@ class ResourceAttribute(TimeStampedModel):
         resource_attribute_type (ResourceAttributeType): resource attribute type to link
         resource (Resource): resource to link
         value (str): value of the resource attribute
+        expanded_cache (str): stored expanded value, see EXPANDED_VALUE_CACHE_ENABLED
     """
 
     resource_attribute_type = models.ForeignKey(
         ResourceAttributeType, on_delete=models.CASCADE)
     resource = models.ForeignKey(Resource, on_delete=models.CASCADE)
     value = models.TextField()
-    history = HistoricalRecords()
+    expanded_cache = models.TextField(null=True, blank=True, editable=False)
+    history = HistoricalRecords(excluded_fields=['expanded_cache'])
+
+    def save(self, *args, **kwargs):
+        """ Saves the resource attribute. """
+
+        self.expanded_cache = None
+        super().save(*args, **kwargs)
+        attribute_cache.invalidate(Resource, self.resource_id)
+        attribute_expansion.invalidate_expanded_values([
+            (('resource', self.resource_id), self.resource_attribute_type.name)])
+
+    def delete(self, *args, **kwargs):
+        """ Deletes the resource attribute. """
+
+        attribute_cache.invalidate(Resource, self.resource_id)
+        attribute_expansion.invalidate_expanded_values([
+            (('resource', self.resource_id), self.resource_attribute_type.name)])
+        return super().delete(*args, **kwargs)
 
     def clean(self):
         """ Validates the resource and raises errors if the resource is invalid. """
@@ -277,11 +295,12 @@ class ResourceAttribute(TimeStampedModel):
         return attribute_expansion.convert_type(
             value=raw_value, type_name=atype_name)
 
-    def expanded_value(self, typed=True, extra_allocations=[]):
+    def expanded_value(self, typed=True, extra_allocations=[], use_cache=True):
         """
         Params:
             typed (bool): indicates whether or not to convert the attribute value to an int/ float/ str based on the base AttributeType name (unrecognized values not converted, so will return str)
             extra_allocations (list[Allocation]): allocations which are available to reference in the attribute list in addition to those associated with this ResourceAttribute
+            use_cache (bool): whether to read and store expanded_cache when EXPANDED_VALUE_CACHE_ENABLED is set; False always expands the value afresh
 
         Returns:
             int, float, str: the value of the attribute after attribute expansion
@@ -289,6 +308,8 @@ class ResourceAttribute(TimeStampedModel):
         For attributes with attribute type of 'Attribute Expanded Text' we look for an attribute with same name suffixed with '_attriblist' (this should be ResourceAttribute of the Resource associated with the attribute). If the attriblist attribute is found, we use it to generate a dictionary to use to expand the attribute value, and the expanded value is returned.  
 
         If the expansion fails, or if no attriblist attribute is found, or if the attribute type is not 'Attribute Expanded Text', we just return the raw value.
+
+        If EXPANDED_VALUE_CACHE_ENABLED is set and no extra_allocations are given, the expanded value is stored in expanded_cache and reused until an attribute it was computed from changes.
         """
         
         raw_value = self.value
@@ -301,10 +322,22 @@ class ResourceAttribute(TimeStampedModel):
             # We are not an expandable type, return raw value
             return raw_value
 
+        store = use_cache and attribute_expansion.EXPANDED_VALUE_CACHE_ENABLED and not extra_allocations
+        if store and self.expanded_cache is not None:
+            return self.expanded_cache
+
         allocs = extra_allocations
         resources = [ self.resource ]
         attrib_name = self.resource_attribute_type.name
 
+        if store:
+            return attribute_expansion.expand_and_store(
+                attribute = self,
+                raw_value = raw_value,
+                attribute_name = attrib_name,
+                resources = resources,
+                allocations = allocs)
+
         attriblist = attribute_expansion.get_attriblist_str(
             attribute_name = attrib_name,
             resources = resources,
@@ -1,11 +1,17 @@
+import threading
+import time
+
 from coldfront.core.test_helpers.factories import UserFactory
-from django.test import TestCase
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 
 from coldfront.core.test_helpers.factories import (
     UserFactory,
 )
 
 from coldfront.core.user.models import UserProfile
+from coldfront.core.user.utils import CombinedUserSearch, UserSearch
 
 class TestUserProfile(TestCase):
     class Data:
@@ -51,4 +57,69 @@ class TestUserProfile(TestCase):
         # expecting CASCADE
         with self.assertRaises(UserProfile.DoesNotExist):
             UserProfile.objects.get(pk=profile_obj.pk)
-        self.assertEqual(0, len(UserProfile.objects.all()))
\ No newline at end of file
+        self.assertEqual(0, len(UserProfile.objects.all()))
+
+
+class ExtraUserSearch(UserSearch):
+    search_source = 'extra'
+
+    def search_a_user(self, user_search_string=None, search_by='all_fields'):
+        return [{'username': username, 'source': self.search_source}
+                for username in ['localuser', 'extrauser'] if username == user_search_string]
+
+
+class SlowUserSearch(ExtraUserSearch):
+    search_source = 'slow'
+    search_timeout = 0.2
+    release = threading.Event()
+
+    def search_a_user(self, user_search_string=None, search_by='all_fields'):
+        self.release.wait(5)
+        return super().search_a_user(user_search_string, search_by)
+
+
+class FailingUserSearch(ExtraUserSearch):
+    search_source = 'failing'
+
+    def search_a_user(self, user_search_string=None, search_by='all_fields'):
+        raise ConnectionError('unreachable')
+
+
+class CombinedUserSearchTest(TestCase):
+    """tests for searching users in all sources"""
+
+    @classmethod
+    def setUpTestData(cls):
+        for username in ['localuser', 'other', 'member']:
+            UserFactory(username=username)
+
+    def test_local_search_many(self):
+        """test that a list of usernames is looked up with one query"""
+        with CaptureQueriesContext(connection) as queries:
+            context = CombinedUserSearch('other localuser member nobody', 'all_fields', ['member']).search()
+        self.assertEqual(len(queries), 1)
+        self.assertEqual([match['username'] for match in context['matches']], ['localuser', 'other'])
+        self.assertEqual(context['number_of_usernames_found'], 2)
+        self.assertEqual(context['usernames_not_found'], ['nobody'])
+        self.assertEqual(context['sources_unavailable'], [])
+
+    @override_settings(ADDITIONAL_USER_SEARCH_CLASSES=[
+        'coldfront.core.user.tests.SlowUserSearch',
+        'coldfront.core.user.tests.FailingUserSearch',
+        'coldfront.core.user.tests.ExtraUserSearch',
+    ])
+    def test_partial_results(self):
+        """test that slow and failing sources are left out of the results"""
+        SlowUserSearch.release.clear()
+        self.addCleanup(SlowUserSearch.release.set)
+        start = time.monotonic()
+        context = CombinedUserSearch('localuser extrauser', 'all_fields').search()
+        self.assertLess(time.monotonic() - start, 2)
+
+        self.assertEqual([(match['username'], match['source']) for match in context['matches']],
+                         [('localuser', 'local'), ('extrauser', 'extra')])
+        self.assertEqual(context['sources_unavailable'], ['slow', 'failing'])
+        self.assertEqual(context['usernames_not_found'], [])
+
+        search = CombinedUserSearch('localuser', 'all_fields')
+        self.assertEqual(len(search.USER_SEARCH_CLASSES), 4)
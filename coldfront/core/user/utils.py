@@ -1,5 +1,8 @@
 import abc
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
 
 from django.contrib.auth.models import User
 from django.db.models import Q
@@ -9,7 +12,12 @@ from coldfront.core.utils.common import import_from_settings
 
 logger = logging.getLogger(__name__)
 
+USER_SEARCH_TIMEOUT = import_from_settings('USER_SEARCH_TIMEOUT', 10)
+
+
 class UserSearch(abc.ABC):
+    # Seconds CombinedUserSearch waits for this source, USER_SEARCH_TIMEOUT if None
+    search_timeout = None
 
     def __init__(self, user_search_string, search_by):
         self.user_search_string = user_search_string
@@ -19,18 +27,19 @@ class UserSearch(abc.ABC):
     def search_a_user(self, user_search_string=None, search_by='all_fields'):
         pass
 
+    def search_many(self, usernames):
+        """Returns the users with the given usernames. Sources that can look
+        up many usernames with one query should override this."""
+        matches = []
+        for username in usernames:
+            match = self.search_a_user(username, 'username_only')
+            if match:
+                matches.extend(match)
+        return matches
+
     def search(self):
         if len(self.user_search_string.split()) > 1:
-            search_by = 'username_only'
-            matches = []
-            number_of_usernames_found = 0
-            users_not_found = []
-
-            user_search_string = sorted(list(set(self.user_search_string.split())))
-            for username in user_search_string:
-                match = self.search_a_user(username, search_by)
-                if match:
-                    matches.extend(match)
+            matches = self.search_many(sorted(set(self.user_search_string.split())))
         else:
             matches = self.search_a_user(self.user_search_string, self.search_by)
 
@@ -40,6 +49,15 @@ class UserSearch(abc.ABC):
 class LocalUserSearch(UserSearch):
     search_source = 'local'
 
+    def to_user_dict(self, user):
+        return {
+            'last_name': user.last_name,
+            'first_name': user.first_name,
+            'username': user.username,
+            'email': user.email,
+            'source': self.search_source,
+        }
+
     def search_a_user(self, user_search_string=None, search_by='all_fields'):
         size_limit = 50
         if user_search_string and search_by == 'all_fields':
@@ -55,53 +73,96 @@ class LocalUserSearch(UserSearch):
         else:
             entries = User.objects.all()[:size_limit]
 
-        users = []
-        for idx, user in enumerate(entries, 1):
-            if user:
-                user_dict = {
-                    'last_name': user.last_name,
-                    'first_name': user.first_name,
-                    'username': user.username,
-                    'email': user.email,
-                    'source': self.search_source,
-                }
-                users.append(user_dict)
+        users = [self.to_user_dict(user) for user in entries]
 
         logger.info("Local user search for %s found %s results", user_search_string, len(users))
         return users
 
+    def search_many(self, usernames):
+        users = [self.to_user_dict(user) for user in User.objects.filter(
+            username__in=usernames, is_active=True).order_by('username')]
+
+        logger.info("Local user search for %s usernames found %s results", len(usernames), len(users))
+        return users
+
+
+def _search(search_class, user_search_string, search_by):
+    return import_string(search_class)(user_search_string, search_by).search()
+
 
 class CombinedUserSearch:
+    """Searches the local database and the ADDITIONAL_USER_SEARCH_CLASSES.
+
+    The additional sources are searched concurrently in threads while the
+    local database is searched.  A source that does not answer within its
+    search_timeout, or fails, is left out of the results and listed in
+    sources_unavailable.
+    """
 
     def __init__(self, user_search_string, search_by, usernames_names_to_exclude=[]):
-        self.USER_SEARCH_CLASSES = import_from_settings('ADDITIONAL_USER_SEARCH_CLASSES', [])
-        self.USER_SEARCH_CLASSES.insert(0, 'coldfront.core.user.utils.LocalUserSearch')
+        self.USER_SEARCH_CLASSES = ['coldfront.core.user.utils.LocalUserSearch'] + list(
+            import_from_settings('ADDITIONAL_USER_SEARCH_CLASSES', []))
         self.user_search_string = user_search_string
         self.search_by = search_by
         self.usernames_names_to_exclude = usernames_names_to_exclude
 
+    def search_sources(self):
+        """Returns a list of (search class, users) for the sources that
+        answered in time, in USER_SEARCH_CLASSES order"""
+        local_class, *search_classes = self.USER_SEARCH_CLASSES
+        start = time.monotonic()
+        executor = ThreadPoolExecutor(max_workers=max(1, len(search_classes)))
+        futures = [executor.submit(_search, search_class, self.user_search_string, self.search_by)
+                   for search_class in search_classes]
+        try:
+            # The local database is searched in this thread, as a test or
+            # request transaction is not visible to other connections
+            results = [(local_class, _search(local_class, self.user_search_string, self.search_by))]
+
+            for search_class, future in zip(search_classes, futures):
+                timeout = getattr(import_string(search_class), 'search_timeout', None)
+                if timeout is None:
+                    timeout = USER_SEARCH_TIMEOUT
+                try:
+                    users = future.result(timeout=max(0, start + timeout - time.monotonic()))
+                except FutureTimeoutError:
+                    logger.warning("User search %s timed out after %ss", search_class, timeout)
+                    users = None
+                except Exception:
+                    logger.exception("User search %s failed", search_class)
+                    users = None
+                results.append((search_class, users))
+        finally:
+            # Slow sources finish in the background
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+        return results
+
     def search(self):
 
         matches = []
-        usernames_not_found = []
-        usernames_found = []
-
+        usernames_found = set()
+        usernames_to_exclude = set(self.usernames_names_to_exclude)
+        sources_unavailable = []
 
-        for search_class in self.USER_SEARCH_CLASSES:
-            cls = import_string(search_class)
-            search_class_obj = cls(self.user_search_string, self.search_by)
-            users = search_class_obj.search()
+        for search_class, users in self.search_sources():
+            if users is None:
+                cls = import_string(search_class)
+                sources_unavailable.append(getattr(cls, 'search_source', cls.__name__))
+                continue
 
             for user in users:
                 username = user.get('username')
-                if username not in usernames_found and username not in self.usernames_names_to_exclude:
-                    usernames_found.append(username)
+                if username not in usernames_found and username not in usernames_to_exclude:
+                    usernames_found.add(username)
                     matches.append(user)
 
         if len(self.user_search_string.split()) > 1:
+            usernames_searched = set(self.user_search_string.split())
             number_of_usernames_searched = len(self.user_search_string.split())
             number_of_usernames_found = len(usernames_found)
-            usernames_not_found = list(set(self.user_search_string.split()) - set(usernames_found) - set(self.usernames_names_to_exclude))
+            usernames_not_found = sorted(usernames_searched - usernames_found - usernames_to_exclude)
         else:
             number_of_usernames_searched = None
             number_of_usernames_found = None
@@ -111,6 +172,7 @@ class CombinedUserSearch:
             'matches': matches,
             'number_of_usernames_searched': number_of_usernames_searched,
             'number_of_usernames_found': number_of_usernames_found,
-            'usernames_not_found': usernames_not_found
+            'usernames_not_found': usernames_not_found,
+            'sources_unavailable': sources_unavailable,
         }
         return context
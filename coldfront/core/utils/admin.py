@@ -1,3 +1,27 @@
 from django.contrib import admin
+from django.utils import timezone
+from django_q.tasks import async_task
 
-# Register your models here.
+from coldfront.core.utils.models import OutboxMessage
+
+
+@admin.register(OutboxMessage)
+class OutboxMessageAdmin(admin.ModelAdmin):
+    readonly_fields = ('created', 'modified', 'sent', 'attempts', 'last_error', )
+    fields = ('subject', 'sender', 'to', 'cc', 'body', 'status', 'next_attempt',
+              'attempts', 'last_error', 'sent', 'created', 'modified', )
+    list_display = ('pk', 'subject', 'Receivers', 'status', 'attempts', 'created', 'sent', )
+    list_filter = ('status', )
+    search_fields = ['subject', 'to', 'sender', ]
+    actions = ['retry', ]
+
+    def Receivers(self, obj):
+        return ', '.join(obj.to)
+
+    @admin.action(description='Retry sending selected emails')
+    def retry(self, request, queryset):
+        count = queryset.exclude(status=OutboxMessage.SENT).update(
+            status=OutboxMessage.PENDING, attempts=0, next_attempt=timezone.now(),
+            modified=timezone.now())
+        async_task('coldfront.core.utils.tasks.send_outbox')
+        self.message_user(request, 'Queued {} email(s) to be sent'.format(count))
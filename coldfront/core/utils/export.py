@@ -0,0 +1,231 @@
+#Streaming bulk export of allocations, projects and users.
+#
+#Each dataset reads its table with values_list(...).iterator(chunk_size=...)
+#and joins related rows (resources, attributes, usage) one chunk at a time,
+#so memory use is bounded by EXPORT_CHUNK_SIZE rather than the size of the
+#table.  Rows are dicts which write_csv() and write_jsonl() turn into lines
+#for a StreamingHttpResponse or a file.
+
+import csv
+import json
+from collections import defaultdict, namedtuple
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from coldfront.core.allocation.models import (ALLOCATION_RESOURCE_ORDERING,
+                                              Allocation, AllocationAttribute,
+                                              AllocationAttributeType,
+                                              AllocationUser)
+from coldfront.core.project.models import Project, ProjectUser
+from coldfront.core.utils.common import Echo, import_from_settings
+
+EXPORT_CHUNK_SIZE = import_from_settings('EXPORT_CHUNK_SIZE', 2000)
+
+FORMATS = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+}
+
+# Exported column names and the lookups they are read from
+PROJECT_FIELDS = [
+    ('id', 'id'),
+    ('title', 'title'),
+    ('pi', 'pi__username'),
+    ('status', 'status__name'),
+    ('field_of_science', 'field_of_science__description'),
+    ('requires_review', 'requires_review'),
+    ('created', 'created'),
+    ('modified', 'modified'),
+]
+
+PROJECT_USER_FIELDS = [
+    ('id', 'id'),
+    ('project_id', 'project_id'),
+    ('project', 'project__title'),
+    ('username', 'user__username'),
+    ('email', 'user__email'),
+    ('role', 'role__name'),
+    ('status', 'status__name'),
+    ('enable_notifications', 'enable_notifications'),
+    ('created', 'created'),
+    ('modified', 'modified'),
+]
+
+ALLOCATION_FIELDS = [
+    ('id', 'id'),
+    ('project_id', 'project_id'),
+    ('project', 'project__title'),
+    ('pi', 'project__pi__username'),
+    ('status', 'status__name'),
+    ('quantity', 'quantity'),
+    ('start_date', 'start_date'),
+    ('end_date', 'end_date'),
+    ('is_locked', 'is_locked'),
+    ('is_changeable', 'is_changeable'),
+    ('created', 'created'),
+    ('modified', 'modified'),
+]
+
+ALLOCATION_USER_FIELDS = [
+    ('id', 'id'),
+    ('allocation_id', 'allocation_id'),
+    ('project_id', 'allocation__project_id'),
+    ('username', 'user__username'),
+    ('email', 'user__email'),
+    ('status', 'status__name'),
+    ('created', 'created'),
+    ('modified', 'modified'),
+]
+
+
+def _rows(queryset, fields, chunk_size):
+    """Yields rows of queryset as dicts keyed by the column names of fields"""
+    names = [name for name, _ in fields]
+    for values in queryset.order_by('pk').values_list(
+            *[lookup for _, lookup in fields]).iterator(chunk_size=chunk_size):
+        yield dict(zip(names, values))
+
+
+def _chunks(rows, size):
+    """Yields lists of up to size rows"""
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def project_rows(chunk_size=None):
+    return _rows(Project.objects.all(), PROJECT_FIELDS,
+                 chunk_size or EXPORT_CHUNK_SIZE)
+
+
+def project_user_rows(chunk_size=None):
+    return _rows(ProjectUser.objects.all(), PROJECT_USER_FIELDS,
+                 chunk_size or EXPORT_CHUNK_SIZE)
+
+
+def allocation_user_rows(chunk_size=None):
+    return _rows(AllocationUser.objects.all(), ALLOCATION_USER_FIELDS,
+                 chunk_size or EXPORT_CHUNK_SIZE)
+
+
+def allocation_rows(chunk_size=None):
+    """Yields allocations with their resources, attributes and usage.
+
+    resources is the list of resource names in parent resource order.
+    attributes and usage map attribute type names to the value and usage
+    of the first attribute of that type, as Allocation.get_attribute does.
+    Related rows are read with one query per chunk of allocations.
+    """
+    chunk_size = chunk_size or EXPORT_CHUNK_SIZE
+    resource_ordering = [
+        '-resource__' + field[1:] if field.startswith('-') else 'resource__' + field
+        for field in ALLOCATION_RESOURCE_ORDERING]
+
+    for chunk in _chunks(_rows(Allocation.objects.all(), ALLOCATION_FIELDS,
+                               chunk_size), chunk_size):
+        pks = [row['id'] for row in chunk]
+
+        resources = defaultdict(list)
+        for allocation_id, name in Allocation.resources.through.objects.filter(
+                allocation_id__in=pks).order_by(
+                'allocation_id', *resource_ordering).values_list(
+                'allocation_id', 'resource__name'):
+            resources[allocation_id].append(name)
+
+        attributes = defaultdict(dict)
+        usage = defaultdict(dict)
+        for allocation_id, name, value, used in AllocationAttribute.objects.filter(
+                allocation_id__in=pks).order_by('pk').values_list(
+                'allocation_id', 'allocation_attribute_type__name', 'value',
+                'allocationattributeusage__value'):
+            if name in attributes[allocation_id]:
+                continue
+            attributes[allocation_id][name] = value
+            if used is not None:
+                usage[allocation_id][name] = used
+
+        for row in chunk:
+            pk = row['id']
+            row['resources'] = resources.get(pk, [])
+            row['attributes'] = attributes.get(pk, {})
+            row['usage'] = usage.get(pk, {})
+            yield row
+
+
+def allocation_columns():
+    """Returns the CSV columns of the allocations dataset.
+
+    There is one attributes:<name> column per attribute type and one
+    usage:<name> column per attribute type with usage.
+    """
+    columns = [name for name, _ in ALLOCATION_FIELDS] + ['resources']
+    attribute_types = list(AllocationAttributeType.objects.order_by(
+        'name').values_list('name', 'has_usage'))
+    columns += ['attributes:' + name for name, _ in attribute_types]
+    columns += ['usage:' + name for name, has_usage in attribute_types if has_usage]
+    return columns
+
+
+Dataset = namedtuple('Dataset', ['permission', 'columns', 'rows'])
+
+DATASETS = {
+    'allocations': Dataset(
+        'allocation.can_view_all_allocations', allocation_columns, allocation_rows),
+    'allocation-users': Dataset(
+        'allocation.can_view_all_allocations',
+        lambda: [name for name, _ in ALLOCATION_USER_FIELDS], allocation_user_rows),
+    'projects': Dataset(
+        'project.can_view_all_projects',
+        lambda: [name for name, _ in PROJECT_FIELDS], project_rows),
+    'project-users': Dataset(
+        'project.can_view_all_projects',
+        lambda: [name for name, _ in PROJECT_USER_FIELDS], project_user_rows),
+}
+
+
+def _flatten(row):
+    """Returns row with dict values spread into key:name columns and lists joined"""
+    flat = {}
+    for key, value in row.items():
+        if isinstance(value, dict):
+            for name, item in value.items():
+                flat['{}:{}'.format(key, name)] = item
+        elif isinstance(value, list):
+            flat[key] = ', '.join(str(item) for item in value)
+        else:
+            flat[key] = value
+    return flat
+
+
+def write_csv(columns, rows):
+    """Yields the CSV lines of rows, starting with a header of columns"""
+    writer = csv.writer(Echo())
+    yield writer.writerow(columns)
+    for row in rows:
+        flat = _flatten(row)
+        yield writer.writerow([flat.get(column, '') for column in columns])
+
+
+def write_jsonl(rows):
+    """Yields one JSON document per row"""
+    for row in rows:
+        yield json.dumps(row, cls=DjangoJSONEncoder) + '\n'
+
+
+def export(dataset, format, chunk_size=None):
+    """Returns an iterator over the lines of dataset in format.
+
+    Raises KeyError for an unknown dataset or format.
+    """
+    if format not in FORMATS:
+        raise KeyError(format)
+    dataset = DATASETS[dataset]
+    rows = dataset.rows(chunk_size)
+    if format == 'csv':
+        return write_csv(dataset.columns(), rows)
+    return write_jsonl(rows)
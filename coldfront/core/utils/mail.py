@@ -7,9 +7,11 @@ from django.template.loader import render_to_string
 from django.urls import reverse
 
 from coldfront.core.utils.common import import_from_settings
+from coldfront.core.utils.tasks import queue_email
 
 logger = logging.getLogger(__name__)
 EMAIL_ENABLED = import_from_settings('EMAIL_ENABLED', False)
+EMAIL_OUTBOX_ENABLED = import_from_settings('EMAIL_OUTBOX_ENABLED', False)
 EMAIL_SUBJECT_PREFIX = import_from_settings('EMAIL_SUBJECT_PREFIX')
 EMAIL_DEVELOPMENT_EMAIL_LIST = import_from_settings('EMAIL_DEVELOPMENT_EMAIL_LIST')
 EMAIL_SENDER = import_from_settings('EMAIL_SENDER')
@@ -21,6 +23,9 @@ CENTER_BASE_URL = import_from_settings('CENTER_BASE_URL')
 
 def send_email(subject, body, sender, receiver_list, cc=[]):
     """Helper function for sending emails
+
+    With EMAIL_OUTBOX_ENABLED the email is queued in the outbox and sent by
+    a django-q worker instead of during the request.
     """
 
     if not EMAIL_ENABLED:
@@ -43,6 +48,10 @@ def send_email(subject, body, sender, receiver_list, cc=[]):
     if cc and settings.DEBUG:
         cc = EMAIL_DEVELOPMENT_EMAIL_LIST
 
+    if EMAIL_OUTBOX_ENABLED:
+        queue_email(subject, body, sender, receiver_list, cc=cc)
+        return
+
     try:
         if cc:
             email = EmailMessage(
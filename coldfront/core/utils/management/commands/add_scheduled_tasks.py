@@ -7,8 +7,14 @@ from django.utils import timezone
 from django_q.models import Schedule
 from django_q.tasks import schedule
 
+from coldfront.core.utils.common import import_from_settings
+
 base_dir = settings.BASE_DIR
 
+PORTAL_SUMMARY_REFRESH_MINUTES = import_from_settings(
+    'PORTAL_SUMMARY_REFRESH_MINUTES', 15)
+EMAIL_OUTBOX_ENABLED = import_from_settings('EMAIL_OUTBOX_ENABLED', False)
+
 
 class Command(BaseCommand):
 
@@ -23,3 +29,13 @@ class Command(BaseCommand):
         schedule('coldfront.core.allocation.tasks.send_expiry_emails',
                  schedule_type=Schedule.DAILY,
                  next_run=date)
+
+        schedule('coldfront.core.portal.tasks.refresh_summary_snapshot',
+                 schedule_type=Schedule.MINUTES,
+                 minutes=PORTAL_SUMMARY_REFRESH_MINUTES)
+
+        # Picks up outbox emails left behind by a worker that stopped
+        if EMAIL_OUTBOX_ENABLED:
+            schedule('coldfront.core.utils.tasks.send_outbox',
+                     schedule_type=Schedule.MINUTES,
+                     minutes=15)
@@ -0,0 +1,43 @@
+import os
+import tempfile
+
+from django.core.management.base import BaseCommand
+
+from coldfront.core.utils import export
+
+
+class Command(BaseCommand):
+    help = 'Export allocations, projects or their users as CSV or JSON Lines'
+
+    def add_arguments(self, parser):
+        parser.add_argument('dataset', choices=sorted(export.DATASETS))
+        parser.add_argument(
+            '--format', choices=sorted(export.FORMATS), default='csv',
+            help='Output format (default: csv)')
+        parser.add_argument(
+            '--output', metavar='FILE',
+            help='Write to FILE instead of standard output. FILE is replaced only once the export is complete')
+        parser.add_argument(
+            '--chunk-size', type=int, default=None,
+            help='Rows read per query (default: EXPORT_CHUNK_SIZE)')
+
+    def handle(self, *args, **options):
+        lines = export.export(options['dataset'], options['format'],
+                              chunk_size=options['chunk_size'])
+        if not options['output']:
+            for line in lines:
+                self.stdout.write(line, ending='')
+            return
+
+        # Write next to the output and rename, so readers never see a partial file
+        output = options['output']
+        fd, path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(output)),
+                                    prefix='.' + os.path.basename(output))
+        try:
+            with os.fdopen(fd, 'w', newline='') as fh:
+                fh.writelines(lines)
+            os.chmod(path, 0o644)
+            os.replace(path, output)
+        except BaseException:
+            os.unlink(path)
+            raise
@@ -1,3 +1,50 @@
 from django.db import models
+from django.utils import timezone
+from model_utils.models import TimeStampedModel
 
-# Create your models here.
+
+class OutboxMessage(TimeStampedModel):
+    """ An outbox message is an email queued by coldfront.core.utils.mail.send_email when EMAIL_OUTBOX_ENABLED is set, and sent in batches by coldfront.core.utils.tasks.send_outbox.
+
+    Attributes:
+        subject (str): subject of the email, including the subject prefix
+        body (str): rendered body of the email
+        sender (str): sender address
+        to (list): receiver addresses
+        cc (list): cc addresses
+        status (str): pending, sending, sent or failed once EMAIL_OUTBOX_MAX_ATTEMPTS attempts failed
+        attempts (int): number of failed attempts to send the email
+        next_attempt (datetime): time the email may be sent, later after a failed attempt
+        last_error (str): error of the last failed attempt
+        sent (datetime): time the email was sent
+    """
+
+    PENDING = 'pending'
+    SENDING = 'sending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (SENDING, 'Sending'),
+        (SENT, 'Sent'),
+        (FAILED, 'Failed'),
+    )
+
+    subject = models.TextField()
+    body = models.TextField()
+    sender = models.CharField(max_length=254)
+    to = models.JSONField()
+    cc = models.JSONField(default=list, blank=True)
+    status = models.CharField(max_length=7, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    sent = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt']),
+        ]
+
+    def __str__(self):
+        return '{} to {}'.format(self.subject, ', '.join(self.to))
@@ -0,0 +1,192 @@
+#Keyset (cursor) pagination and cached counts for list views.
+#
+#OFFSET pagination makes the database produce and discard every row before
+#the requested page, and Paginator runs a COUNT over the same (often
+#multi-join, DISTINCT) query.  KeysetPaginationMixin instead reduces the
+#filtered queryset to a primary key subquery, seeks past the last row of
+#the previous page using a cursor carried in the Next/Previous links, and
+#caches the count per user and filter for LIST_COUNT_CACHE_TIMEOUT
+#seconds.
+
+import base64
+import hashlib
+import json
+
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.paginator import Page, Paginator
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F, Q
+
+from coldfront.core.utils.common import import_from_settings
+
+LIST_COUNT_CACHE_TIMEOUT = import_from_settings('LIST_COUNT_CACHE_TIMEOUT', 60)
+
+
+def encode_cursor(value, pk):
+    """Returns an URL safe cursor for the row with ordering value and pk"""
+    data = json.dumps([value, pk], cls=DjangoJSONEncoder)
+    return base64.urlsafe_b64encode(data.encode()).decode()
+
+
+def decode_cursor(cursor, field=None):
+    """Returns (value, pk) encoded by encode_cursor, or None if invalid
+
+    If field is given, value is converted with field.to_python() and a
+    value the field does not accept makes the cursor invalid.
+    """
+    try:
+        value, pk = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if field is not None and value is not None:
+            value = field.to_python(value)
+        return value, int(pk)
+    except (ValidationError, ValueError, TypeError):
+        return None
+
+
+def get_field(model, path):
+    """Returns the field at lookup path (e.g. project__pi__username)"""
+    names = path.split('__')
+    for name in names[:-1]:
+        model = model._meta.get_field(name).related_model
+    return model._meta.get_field(names[-1])
+
+
+def is_nullable(model, path):
+    """Returns True if the field at lookup path (e.g. project__pi__username)
+    can be NULL, including through a nullable foreign key"""
+    for name in path.split('__'):
+        field = model._meta.get_field(name)
+        if field.null:
+            return True
+        model = field.related_model
+    return False
+
+
+def keyset_filter(field, descending, nullable, value, pk, backwards=False):
+    """Returns a Q selecting the rows after (value, pk).
+
+    Rows are ordered as by keyset_ordering(field, descending).  If
+    backwards is True, selects the rows before (value, pk) instead.
+    """
+    op = 'lt' if descending != backwards else 'gt'
+    if value is None:
+        # The cursor is in the NULL rows, which are ordered last
+        q = Q(**{field + '__isnull': True, 'pk__' + op: pk})
+        if backwards:
+            q |= Q(**{field + '__isnull': False})
+        return q
+
+    q = (Q(**{field + '__' + op: value}) |
+         Q(**{field: value, 'pk__' + op: pk}))
+    if nullable and not backwards:
+        q |= Q(**{field + '__isnull': True})
+    return q
+
+
+def keyset_ordering(field, descending, backwards=False):
+    """Returns the order_by arguments ordering rows by field, NULLs last,
+    then pk.  If backwards is True, returns the reverse ordering."""
+    if descending != backwards:
+        expression = F(field).desc(nulls_last=(not backwards) or None, nulls_first=backwards or None)
+        return [expression, '-pk']
+    expression = F(field).asc(nulls_last=(not backwards) or None, nulls_first=backwards or None)
+    return [expression, 'pk']
+
+
+def cached_count(key_parts, queryset):
+    """Returns queryset.count(), cached for LIST_COUNT_CACHE_TIMEOUT seconds
+    under a key derived from key_parts and the SQL of queryset"""
+    digest = hashlib.sha256(
+        repr((key_parts, str(queryset.query))).encode()).hexdigest()
+    return cache.get_or_set(
+        'coldfront-list-count-' + digest, queryset.count,
+        LIST_COUNT_CACHE_TIMEOUT)
+
+
+class KeysetPaginationMixin:
+    """ListView mixin paginating with keyset cursors and cached counts.
+
+    get_queryset() may return a queryset with joins and distinct(); it is
+    only used as a primary key subquery.  The page is loaded from
+    model.objects with list_select_related and, if set, only the
+    list_only_fields columns.  If the queryset is ordered by one of the
+    keyset_fields, the Next and Previous links carry 'after' and 'before'
+    cursors and pages are fetched by seeking past the cursor.  Requests
+    without a cursor (e.g. the first page or an explicit page number) and
+    other orderings use OFFSET pagination.  Either way the total count is
+    cached per user and filter.
+
+    The Page in the context has next_cursor and previous_cursor
+    attributes for use in the pagination links.
+    """
+    keyset_fields = ('id',)
+    list_select_related = ()
+    list_only_fields = ()
+
+    def get_list_queryset(self, queryset):
+        """Returns the queryset the page rows are loaded from"""
+        rows = self.model.objects.filter(pk__in=queryset.order_by().values('pk'))
+        if self.list_select_related:
+            rows = rows.select_related(*self.list_select_related)
+        if self.list_only_fields:
+            rows = rows.only(*self.list_only_fields)
+        return rows
+
+    def paginate_queryset(self, queryset, page_size):
+        rows = self.get_list_queryset(queryset)
+        ordering = queryset.query.order_by
+        field = None
+        if len(ordering) == 1 and isinstance(ordering[0], str):
+            field = ordering[0].lstrip('-')
+        if field == 'pk':
+            field = 'id'
+        descending = field is not None and ordering[0].startswith('-')
+        if field in self.keyset_fields:
+            rows = rows.order_by(*keyset_ordering(field, descending))
+        else:
+            rows = rows.order_by(*ordering, 'pk')
+
+        paginator = Paginator(rows, page_size)
+        # Counting the rows is equivalent to counting the distinct
+        # queryset, without its joins
+        paginator.count = cached_count(
+            (self.model._meta.label, self.request.user.pk), rows.order_by())
+        page = paginator.get_page(self.request.GET.get('page'))
+        page.next_cursor = page.previous_cursor = None
+        if field not in self.keyset_fields:
+            return paginator, page, page.object_list, page.has_other_pages()
+
+        nullable = is_nullable(self.model, field)
+        cursor, backwards = self.request.GET.get('after'), False
+        if not cursor:
+            cursor, backwards = self.request.GET.get('before'), True
+        decoded = decode_cursor(cursor, get_field(self.model, field)) if cursor else None
+
+        if decoded is None:
+            # No or invalid cursor, fall back to OFFSET for this page
+            object_list = list(page.object_list)
+        else:
+            object_list = list(rows.filter(
+                keyset_filter(field, descending, nullable, *decoded, backwards=backwards)
+            ).order_by(*keyset_ordering(field, descending, backwards))[:page_size])
+            if backwards:
+                object_list.reverse()
+
+        page = Page(object_list, page.number, paginator)
+        page.next_cursor = page.previous_cursor = None
+        if object_list:
+            first, last = object_list[0], object_list[-1]
+            page.previous_cursor = encode_cursor(
+                _value(first, field), first.pk)
+            page.next_cursor = encode_cursor(_value(last, field), last.pk)
+        return paginator, page, object_list, page.has_other_pages()
+
+
+def _value(obj, path):
+    """Returns the value of lookup path (e.g. project__pi__username) on obj"""
+    for name in path.split('__'):
+        if obj is None:
+            return None
+        obj = getattr(obj, name)
+    return obj
@@ -0,0 +1,162 @@
+import datetime
+import logging
+import time
+
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from django_q.models import Schedule
+from django_q.tasks import async_task, schedule
+
+from coldfront.core.utils.common import import_from_settings
+from coldfront.core.utils.models import OutboxMessage
+
+logger = logging.getLogger(__name__)
+
+EMAIL_OUTBOX_DELAY = import_from_settings('EMAIL_OUTBOX_DELAY', 10)
+EMAIL_OUTBOX_BATCH_SIZE = import_from_settings('EMAIL_OUTBOX_BATCH_SIZE', 100)
+EMAIL_OUTBOX_RATE_LIMIT = import_from_settings('EMAIL_OUTBOX_RATE_LIMIT', 0)
+EMAIL_OUTBOX_MAX_ATTEMPTS = import_from_settings('EMAIL_OUTBOX_MAX_ATTEMPTS', 5)
+EMAIL_OUTBOX_RETRY_DELAY = import_from_settings('EMAIL_OUTBOX_RETRY_DELAY', 60)
+
+SEND_SCHEDULE_NAME = 'email-send-outbox'
+
+# Messages claimed longer ago than this by a worker that died are sent again
+CLAIM_TIMEOUT = datetime.timedelta(minutes=10)
+
+
+def _schedule_send(next_run):
+    if not Schedule.objects.filter(name=SEND_SCHEDULE_NAME).exists():
+        schedule('coldfront.core.utils.tasks.send_outbox',
+                 name=SEND_SCHEDULE_NAME,
+                 schedule_type=Schedule.ONCE,
+                 next_run=next_run)
+
+
+def queue_email(subject, body, sender, receiver_list, cc=[]):
+    """Queues an email in the outbox.
+
+    Queued emails are sent by send_outbox, scheduled to run
+    EMAIL_OUTBOX_DELAY seconds after the first queued email, so that emails
+    queued meanwhile are sent over the same connection.
+    """
+    OutboxMessage.objects.create(
+        subject=subject, body=body, sender=sender, to=list(receiver_list), cc=list(cc or []))
+
+    if EMAIL_OUTBOX_DELAY <= 0:
+        transaction.on_commit(lambda: async_task('coldfront.core.utils.tasks.send_outbox'))
+        return
+
+    _schedule_send(timezone.now() + datetime.timedelta(seconds=EMAIL_OUTBOX_DELAY))
+
+
+def _open(connection):
+    """Opens connection, returns False if the mail server cannot be reached"""
+    try:
+        connection.open()
+    except Exception as e:
+        logger.error('Failed to connect to the mail server: %s', e)
+        return False
+    return True
+
+
+def _claim(batch_size):
+    """Marks up to batch_size due messages as sending and returns them"""
+    now = timezone.now()
+    with transaction.atomic():
+        pks = list(OutboxMessage.objects.select_for_update(skip_locked=True).filter(
+            Q(status=OutboxMessage.PENDING, next_attempt__lte=now) |
+            Q(status=OutboxMessage.SENDING, modified__lt=now - CLAIM_TIMEOUT)
+        ).order_by('pk').values_list('pk', flat=True)[:batch_size])
+        OutboxMessage.objects.filter(pk__in=pks).update(status=OutboxMessage.SENDING, modified=now)
+
+    return list(OutboxMessage.objects.filter(pk__in=pks).order_by('pk'))
+
+
+def _failed(message, error):
+    """Schedules another attempt of message, or fails it after
+    EMAIL_OUTBOX_MAX_ATTEMPTS attempts"""
+    message.attempts += 1
+    message.last_error = str(error)
+    if message.attempts >= EMAIL_OUTBOX_MAX_ATTEMPTS:
+        message.status = OutboxMessage.FAILED
+        logger.error('Failed to send email to %s from %s with subject %s after %s attempts: %s',
+                     ','.join(message.to), message.sender, message.subject, message.attempts, error)
+    else:
+        message.status = OutboxMessage.PENDING
+        message.next_attempt = timezone.now() + datetime.timedelta(
+            seconds=EMAIL_OUTBOX_RETRY_DELAY * 2 ** (message.attempts - 1))
+        logger.warning('Failed to send email to %s with subject %s, retrying at %s: %s',
+                       ','.join(message.to), message.subject, message.next_attempt, error)
+    message.save(update_fields=['attempts', 'last_error', 'status', 'next_attempt', 'modified'])
+
+
+def send_outbox():
+    """Sends the queued emails that are due over one connection
+
+    Messages are claimed in batches of EMAIL_OUTBOX_BATCH_SIZE and sent at
+    most EMAIL_OUTBOX_RATE_LIMIT per second (0 for no limit).  A message
+    that cannot be sent is retried after EMAIL_OUTBOX_RETRY_DELAY seconds,
+    doubling after each attempt, and is left failed after
+    EMAIL_OUTBOX_MAX_ATTEMPTS attempts.  If the mail server cannot be
+    reached the remaining messages are sent on a later run.
+    """
+    start = time.monotonic()
+    interval = 1.0 / EMAIL_OUTBOX_RATE_LIMIT if EMAIL_OUTBOX_RATE_LIMIT > 0 else 0
+    next_send = time.monotonic()
+    sent = failed = 0
+
+    connection = get_connection(fail_silently=False)
+    connected = _open(connection)
+    try:
+        while connected:
+            messages = _claim(EMAIL_OUTBOX_BATCH_SIZE)
+            if not messages:
+                break
+
+            sent_pks = []
+            for i, message in enumerate(messages):
+                if interval:
+                    time.sleep(max(0, next_send - time.monotonic()))
+                    next_send = max(next_send, time.monotonic()) + interval
+
+                email = EmailMessage(message.subject, message.body, message.sender,
+                                     message.to, cc=message.cc, connection=connection)
+                try:
+                    connection.send_messages([email])
+                except Exception as e:
+                    _failed(message, e)
+                    failed += 1
+                    # Start over on a new connection in case this one broke
+                    connection.close()
+                    connected = _open(connection)
+                    if not connected:
+                        OutboxMessage.objects.filter(pk__in=[m.pk for m in messages[i + 1:]]).update(
+                            status=OutboxMessage.PENDING, modified=timezone.now())
+                        break
+                else:
+                    sent_pks.append(message.pk)
+
+            now = timezone.now()
+            OutboxMessage.objects.filter(pk__in=sent_pks).update(
+                status=OutboxMessage.SENT, sent=now, modified=now)
+            sent += len(sent_pks)
+    finally:
+        connection.close()
+
+    retry = OutboxMessage.objects.filter(status=OutboxMessage.PENDING).order_by('next_attempt').first()
+    if retry is not None:
+        next_run = max(retry.next_attempt, timezone.now())
+        if not connected:
+            next_run += datetime.timedelta(seconds=EMAIL_OUTBOX_RETRY_DELAY)
+        _schedule_send(next_run)
+
+    logger.info('Outbox emails sent: %s, failed attempts: %s in %.2fs',
+                sent, failed, time.monotonic() - start)
+
+    return {
+        'sent': sent,
+        'failed': failed,
+        'seconds': round(time.monotonic() - start, 3),
+    }
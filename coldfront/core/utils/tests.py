@@ -1,3 +1,177 @@
+import csv
+import io
+import json
+import os
+import tempfile
+from smtplib import SMTPException
+from unittest import mock
+
+from django.core import mail
+from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django_q.models import Schedule
+
+from coldfront.core.allocation.models import Allocation, AllocationStatusChoice
+from coldfront.core.test_helpers.factories import (
+    AllocationAttributeFactory,
+    AllocationAttributeTypeFactory,
+    AllocationUserFactory,
+    ProjectFactory,
+    ProjectUserFactory,
+    ResourceFactory,
+    UserFactory,
+)
+from coldfront.core.utils import export, tasks
+from coldfront.core.utils.mail import send_email
+from coldfront.core.utils.models import OutboxMessage
+
+BACKEND = 'django.contrib.auth.backends.ModelBackend'
+
+
+class ExportTests(TestCase):
+    """tests for the streaming exports"""
+
+    @classmethod
+    def setUpTestData(cls):
+        """Set up allocations with resources, attributes and usage"""
+        cls.project = ProjectFactory(title='lab1')
+        ProjectUserFactory(project=cls.project, user=cls.project.pi)
+        cls.cluster = ResourceFactory(name='cluster', is_allocatable=True)
+        cls.storage = ResourceFactory(name='storage', is_allocatable=False)
+        quota = AllocationAttributeTypeFactory(name='Quota', has_usage=True)
+        account = AllocationAttributeTypeFactory(name='Account')
+
+        active = AllocationStatusChoice.objects.get_or_create(name='Active')[0]
+        cls.allocations = []
+        for i in range(5):
+            allocation = Allocation.objects.create(
+                project=cls.project, status=active, justification='test')
+            allocation.resources.add(cls.storage, cls.cluster)
+            attribute = AllocationAttributeFactory(
+                allocation=allocation, allocation_attribute_type=quota, value=str(100 + i))
+            attribute.allocationattributeusage.value = i
+            attribute.allocationattributeusage.save()
+            AllocationAttributeFactory(
+                allocation=allocation, allocation_attribute_type=account, value='first')
+            AllocationAttributeFactory(
+                allocation=allocation, allocation_attribute_type=account, value='second')
+            AllocationUserFactory(allocation=allocation, user=cls.project.pi)
+            cls.allocations.append(allocation)
+        cls.admin = UserFactory(username='admin', is_superuser=True)
+
+    def test_allocation_rows(self):
+        """test that related rows are joined with two queries per chunk"""
+        with CaptureQueriesContext(connection) as queries:
+            rows = list(export.allocation_rows(chunk_size=2))
+
+        self.assertEqual(len(queries), 1 + 3 * 2)
+        self.assertEqual([row['id'] for row in rows], [a.pk for a in self.allocations])
+        row = rows[1]
+        self.assertEqual(row['pi'], self.project.pi.username)
+        self.assertEqual(row['status'], 'Active')
+        self.assertEqual(row['resources'], ['cluster', 'storage'])
+        self.assertEqual(row['attributes'], {'Quota': '101', 'Account': 'first'})
+        self.assertEqual(row['usage'], {'Quota': 1.0})
+
+    def test_export_view(self):
+        """test that admins get CSV and JSON Lines and others are refused"""
+        self.client.force_login(self.admin, backend=BACKEND)
+        response = self.client.get('/export/allocations.csv')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        content = b''.join(response.streaming_content).decode()
+        rows = list(csv.DictReader(io.StringIO(content)))
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(rows[0]['resources'], 'cluster, storage')
+        self.assertEqual(rows[0]['attributes:Quota'], '100')
+        self.assertEqual(rows[0]['usage:Quota'], '0.0')
+        self.assertNotIn('usage:Account', rows[0])
+
+        response = self.client.get('/export/project-users.jsonl')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual([json.loads(line)['username'] for line in lines],
+                         [self.project.pi.username])
+
+        self.assertEqual(self.client.get('/export/grants.csv').status_code, 404)
+        self.assertEqual(self.client.get('/export/projects.xml').status_code, 404)
+
+        self.client.force_login(self.project.pi, backend=BACKEND)
+        self.assertEqual(self.client.get('/export/projects.csv').status_code, 403)
+
+    def test_export_command(self):
+        """test that the command writes the export to a file"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            output = os.path.join(tmpdir, 'allocation-users.jsonl')
+            call_command('export_data', 'allocation-users', '--format', 'jsonl',
+                         '--output', output, '--chunk-size', '2')
+            with open(output) as fh:
+                rows = [json.loads(line) for line in fh]
+            self.assertEqual(os.listdir(tmpdir), ['allocation-users.jsonl'])
+
+        self.assertEqual([row['allocation_id'] for row in rows],
+                         [a.pk for a in self.allocations])
+
+
+@mock.patch('coldfront.core.utils.mail.EMAIL_ENABLED', True)
+@mock.patch('coldfront.core.utils.mail.EMAIL_OUTBOX_ENABLED', True)
+class OutboxTests(TestCase):
+    """tests for the email outbox"""
+
+    def queue(self, count):
+        for i in range(count):
+            send_email('subject {}'.format(i), 'body', 'sender@example.com',
+                       ['user{}@example.com'.format(i)])
+
+    def test_send_email_queues(self):
+        """test that send_email queues the email and schedules one send"""
+        self.queue(3)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(OutboxMessage.objects.filter(status=OutboxMessage.PENDING).count(), 3)
+        self.assertEqual(Schedule.objects.filter(name=tasks.SEND_SCHEDULE_NAME).count(), 1)
+
+    def test_send_outbox(self):
+        """test that queued emails are sent in batches over one connection"""
+        self.queue(5)
+        with mock.patch.object(tasks, 'EMAIL_OUTBOX_BATCH_SIZE', 2), \
+                mock.patch('django.core.mail.backends.locmem.EmailBackend.open') as open_connection:
+            self.assertEqual(tasks.send_outbox()['sent'], 5)
+        open_connection.assert_called_once()
+        self.assertEqual([m.to for m in mail.outbox],
+                         [['user{}@example.com'.format(i)] for i in range(5)])
+        self.assertEqual(mail.outbox[0].subject, '[ColdFront] subject 0')
+        self.assertFalse(OutboxMessage.objects.exclude(status=OutboxMessage.SENT).exists())
+
+        self.assertEqual(tasks.send_outbox()['sent'], 0)
+        self.assertEqual(len(mail.outbox), 5)
+
+    def test_retry_and_fail(self):
+        """test that failed emails are retried later and failed after the last attempt"""
+        self.queue(2)
+        send_messages = mail.get_connection().send_messages
+
+        def fail_user0(messages):
+            if messages[0].to == ['user0@example.com']:
+                raise SMTPException('rejected')
+            return send_messages(messages)
+
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages',
+                        side_effect=fail_user0), mock.patch.object(tasks, 'EMAIL_OUTBOX_MAX_ATTEMPTS', 2):
+            self.assertEqual(tasks.send_outbox(), {'sent': 1, 'failed': 1, 'seconds': mock.ANY})
+            message = OutboxMessage.objects.get(to=['user0@example.com'])
+            self.assertEqual(message.status, OutboxMessage.PENDING)
+            self.assertEqual(message.attempts, 1)
+            self.assertEqual(message.last_error, 'rejected')
+            self.assertGreater(message.next_attempt, timezone.now())
+
+            # Not due yet
+            self.assertEqual(tasks.send_outbox()['failed'], 0)
 
-# Create your tests here.
+            OutboxMessage.objects.filter(pk=message.pk).update(next_attempt=timezone.now())
+            tasks.send_outbox()
+            message.refresh_from_db()
+            self.assertEqual(message.status, OutboxMessage.FAILED)
+            self.assertEqual(message.attempts, 2)
+        self.assertEqual([m.to for m in mail.outbox], [['user1@example.com']])
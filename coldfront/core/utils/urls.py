@@ -0,0 +1,7 @@
+from django.urls import path
+
+import coldfront.core.utils.views as utils_views
+
+urlpatterns = [
+    path('<str:dataset>.<str:format>', utils_views.ExportView.as_view(), name='export'),
+]
@@ -1,3 +1,30 @@
-from django.shortcuts import render
+from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
+from django.http import Http404, StreamingHttpResponse
+from django.views import View
 
-# Create your views here.
+from coldfront.core.utils import export
+
+
+class ExportView(LoginRequiredMixin, UserPassesTestMixin, View):
+    """Streams a dataset as CSV or JSON Lines, see coldfront.core.utils.export"""
+
+    def get_dataset(self):
+        dataset = export.DATASETS.get(self.kwargs.get('dataset'))
+        if dataset is None or self.kwargs.get('format') not in export.FORMATS:
+            raise Http404
+        return dataset
+
+    def test_func(self):
+        """ UserPassesTestMixin Tests"""
+        dataset = self.get_dataset()
+        if self.request.user.is_superuser:
+            return True
+
+        return self.request.user.has_perm(dataset.permission)
+
+    def get(self, request, dataset, format):
+        response = StreamingHttpResponse(export.export(dataset, format),
+                                         content_type=export.FORMATS[format])
+        response['Content-Disposition'] = 'attachment; filename="{}.{}"'.format(
+            dataset, format)
+        return response
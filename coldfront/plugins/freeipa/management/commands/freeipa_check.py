@@ -1,20 +1,23 @@
 import logging
 import os
 import sys
+from collections import defaultdict
+
 import dbus
 
 from django.contrib.auth.models import User
 from django.core.management.base import BaseCommand, CommandError
-from ipalib import api
 from ipalib.errors import NotFound
 
 from coldfront.plugins.freeipa.search import LDAPUserSearch
-from coldfront.core.allocation.models import Allocation, AllocationUser
+from coldfront.core.allocation.models import (Allocation, AllocationAttribute,
+                                              AllocationUser)
 from coldfront.plugins.freeipa.utils import (CLIENT_KTNAME, FREEIPA_NOOP,
                                              UNIX_GROUP_ATTRIBUTE_NAME,
                                              AlreadyMemberError,
                                              NotMemberError,
-                                             check_ipa_group_error)
+                                             check_ipa_group_error, ipa,
+                                             update_group_members)
 
 logger = logging.getLogger(__name__)
 
@@ -31,6 +34,8 @@ class Command(BaseCommand):
             "-n", "--noop", help="Print commands only. Do not run any commands.", action="store_true")
         parser.add_argument(
             "-x", "--header", help="Include header in output", action="store_true")
+        parser.add_argument(
+            "-b", "--by-group", help="Check each group's members at once instead of each user's groups", action="store_true")
 
     def write(self, data):
         try:
@@ -47,7 +52,7 @@ class Command(BaseCommand):
     def add_group(self, user, group, status):
         if self.sync and not self.noop:
             try:
-                res = api.Command.group_add_member(group, user=[user.username])
+                res = ipa.Command.group_add_member(group, user=[user.username])
                 check_ipa_group_error(res)
             except AlreadyMemberError as e:
                 logger.warn("User %s is already a member of group %s",
@@ -72,7 +77,7 @@ class Command(BaseCommand):
     def remove_group(self, user, group, status):
         if self.sync and not self.noop:
             try:
-                res = api.Command.group_remove_member(
+                res = ipa.Command.group_remove_member(
                     group, user=[user.username])
                 check_ipa_group_error(res)
             except NotMemberError as e:
@@ -214,6 +219,130 @@ class Command(BaseCommand):
 
         self.check_user_freeipa(user, active_groups, removed_groups)
 
+    def group_memberships(self):
+        """Returns (active, removed), dicts of group to the usernames that
+        should and should not be members of the group.
+
+        Computed for all active users with three queries, following the
+        same rules as process_user.
+        """
+        group_attributes = AllocationAttribute.objects.filter(
+            allocation_attribute_type__name=UNIX_GROUP_ATTRIBUTE_NAME)
+        groups_by_allocation = defaultdict(set)
+        for allocation_id, group in group_attributes.values_list('allocation_id', 'value'):
+            groups_by_allocation[allocation_id].add(group)
+
+        allocations_with_available_resources = set(
+            Allocation.resources.through.objects.filter(
+                allocation_id__in=groups_by_allocation.keys(),
+                resource__is_available=True,
+            ).values_list('allocation_id', flat=True))
+
+        allocation_users = AllocationUser.objects.filter(
+            user__is_active=True,
+            allocation_id__in=groups_by_allocation.keys(),
+        )
+        if self.filter_user:
+            allocation_users = allocation_users.filter(user__username=self.filter_user)
+
+        active = defaultdict(set)
+        removed = defaultdict(set)
+        for username, status, allocation_id, allocation_status in allocation_users.values_list(
+                'user__username', 'status__name', 'allocation_id', 'allocation__status__name'):
+            if status == 'Active' and allocation_status == 'Active':
+                if allocation_id in allocations_with_available_resources:
+                    for g in groups_by_allocation[allocation_id]:
+                        active[g].add(username)
+                continue
+
+            # XXX Skip new or renewal allocations??
+            if allocation_status == 'New' or allocation_status == 'Renewal Requested':
+                continue
+
+            for g in groups_by_allocation[allocation_id]:
+                removed[g].add(username)
+
+        for g, usernames in removed.items():
+            usernames -= active.get(g, set())
+
+        if self.filter_group:
+            active = {g: u for g, u in active.items() if g == self.filter_group}
+            removed = {g: u for g, u in removed.items() if g == self.filter_group}
+
+        return active, removed
+
+    def update_group_members(self, group, usernames, add):
+        if self.sync and not self.noop:
+            update_group_members(group, usernames, add=add)
+
+    def check_groups(self):
+        """Checks the members of each group in FreeIPA at once and writes
+        the same report as the per user check"""
+        active, removed = self.group_memberships()
+        groups = sorted(set(active) | set(removed))
+        usernames = sorted(set().union(*active.values(), *removed.values()))
+        logger.info("Checking %s FreeIPA groups of %s users", len(groups), len(usernames))
+
+        account_status = self.ipa_ldap.account_status(usernames)
+        freeipa_status = {
+            username: 'Enabled' if enabled else 'Disabled' for username, enabled in account_status.items()}
+
+        # Users missing from FreeIPA are skipped, as in the per user check
+        missing = set(usernames) - set(account_status)
+        for username in sorted(missing):
+            logger.info("User %s not found in FreeIPA", username)
+        if missing:
+            active = {g: u - missing for g, u in active.items()}
+            removed = {g: u - missing for g, u in removed.items()}
+            usernames = [username for username in usernames if username not in missing]
+
+        disabled = [username for username in usernames if freeipa_status[username] == 'Disabled']
+        for user in User.objects.filter(username__in=disabled):
+            logger.warn(
+                'User is active in coldfront but disabled in FreeIPA: %s', user.username)
+            self.sync_user_status(user, active=False)
+        coldfront_status = {username: 'Active' for username in usernames}
+        if self.sync and not self.noop:
+            coldfront_status.update({username: 'Inactive' for username in disabled})
+
+        rows = []
+        for g in groups:
+            try:
+                res = ipa.Command.group_show(g)
+            except NotFound:
+                logger.error("FreeIPA group %s not found", g)
+                continue
+            except Exception as e:
+                logger.error("Failed to fetch FreeIPA group %s: %s", g, e)
+                continue
+
+            # Nested group members count as members, as they do for SSSD
+            members = set(res['result'].get('member_user', []))
+            indirect_members = set(res['result'].get('memberindirect_user', []))
+
+            to_add = sorted(active.get(g, set()) - members - indirect_members)
+            for username in to_add:
+                logger.warn('User %s should be added to freeipa group: %s', username, g)
+                rows.append((username, g, ''))
+            self.update_group_members(g, to_add, add=True)
+
+            to_remove = sorted(removed.get(g, set()) & members)
+            for username in to_remove:
+                logger.warn('User %s should be removed from freeipa group: %s', username, g)
+                rows.append((username, '', g))
+            self.update_group_members(g, to_remove, add=False)
+
+        # Order rows by user like the per user check, additions first
+        rows.sort(key=lambda row: (row[0], row[1] == ''))
+        for username, add_group, remove_group in rows:
+            self.write('\t'.join([
+                username,
+                add_group,
+                remove_group,
+                freeipa_status[username],
+                coldfront_status[username],
+            ]))
+
     def handle(self, *args, **options):
         os.environ["KRB5_CLIENT_KTNAME"] = CLIENT_KTNAME
 
@@ -250,12 +379,6 @@ class Command(BaseCommand):
             self.write('\t'.join(header))
 
         self.ipa_ldap = LDAPUserSearch("", "")
-        bus = dbus.SystemBus()
-        infopipe_obj = bus.get_object("org.freedesktop.sssd.infopipe", "/org/freedesktop/sssd/infopipe")
-        self.ifp = dbus.Interface(infopipe_obj, dbus_interface='org.freedesktop.sssd.infopipe')
-
-        users = User.objects.filter(is_active=True)
-        logger.info("Processing %s active users", len(users))
 
         self.filter_user = ''
         self.filter_group = ''
@@ -267,5 +390,19 @@ class Command(BaseCommand):
             logger.info("Filtering output by group: %s", options['group'])
             self.filter_group = options['group']
 
+        if options['by_group']:
+            self.check_groups()
+            ipa.log_stats()
+            return
+
+        bus = dbus.SystemBus()
+        infopipe_obj = bus.get_object("org.freedesktop.sssd.infopipe", "/org/freedesktop/sssd/infopipe")
+        self.ifp = dbus.Interface(infopipe_obj, dbus_interface='org.freedesktop.sssd.infopipe')
+
+        users = User.objects.filter(is_active=True)
+        logger.info("Processing %s active users", len(users))
+
         for user in users:
             self.process_user(user)
+
+        ipa.log_stats()
@@ -2,11 +2,16 @@ import logging
 import os
 import sys
 import datetime
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 import dbus
 
 from django.core.management.base import BaseCommand
+from django.db.models import F, Max, OuterRef, Subquery
 
-from coldfront.core.allocation.models import Allocation, AllocationUser
+from coldfront.core.allocation.models import AllocationUser
 
 logger = logging.getLogger(__name__)
 
@@ -16,15 +21,77 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument(
             "-x", "--header", help="Include header in output", action="store_true")
+        parser.add_argument(
+            "-w", "--workers", help="Number of users looked up in SSSD at once (default 8)", type=int, default=8)
 
     def write(self, data):
         try:
             self.stdout.write(data)
+            self.stdout.flush()
         except BrokenPipeError:
             devnull = os.open(os.devnull, os.O_WRONLY)
             os.dup2(devnull, sys.stdout.fileno())
             sys.exit(1)
 
+    def expired_users(self, expired_before):
+        """Returns the username, latest expired allocation and its end date of
+        each user whose allocations all expired before expired_before and who is
+        not an active user on an active allocation"""
+        active_users = AllocationUser.objects.filter(
+            allocation__project__status__name__in=['Active', 'New'],
+            allocation__status__name='Active',
+            status__name='Active',
+        ).values('user')
+
+        expired = AllocationUser.objects.filter(allocation__status__name='Expired')
+        # Allocations without an end date sort first descending in PostgreSQL
+        latest_allocation = expired.filter(user=OuterRef('user')).order_by(
+            F('allocation__end_date').desc(nulls_last=True), 'allocation_id').values('allocation_id')[:1]
+
+        return expired.exclude(user__in=active_users).values('user', 'user__username').annotate(
+            expire_date=Max('allocation__end_date'),
+            allocation_id=Subquery(latest_allocation),
+        ).filter(expire_date__lt=expired_before).order_by('user__username')
+
+    def infopipe(self):
+        """Returns this thread's SSSD infopipe interface"""
+        ifp = getattr(self._local, 'ifp', None)
+        if ifp is None:
+            # Each worker uses its own bus connection
+            bus = dbus.SystemBus(private=True)
+            infopipe_obj = bus.get_object("org.freedesktop.sssd.infopipe", "/org/freedesktop/sssd/infopipe")
+            ifp = dbus.Interface(infopipe_obj, dbus_interface='org.freedesktop.sssd.infopipe')
+            self._local.ifp = ifp
+        return ifp
+
+    def is_enabled(self, username):
+        """Returns whether the user is active in FreeIPA, or None if the user
+        was not found"""
+        try:
+            result = self.infopipe().GetUserAttr(username, ["nsaccountlock"])
+        except dbus.exceptions.DBusException as e:
+            if 'No such user' in str(e):
+                logger.info("User %s not found in FreeIPA", username)
+            else:
+                logger.error("dbus error failed to find user %s in FreeIPA: %s", username, e)
+            return None
+
+        return not ('nsAccountLock' in result and str(result['nsAccountLock'][0]) == 'TRUE')
+
+    def lookup(self, users, workers):
+        """Yields (user, enabled) in the order of users, looking up at most
+        workers users in SSSD at once"""
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            for user in users:
+                pending.append((user, executor.submit(self.is_enabled, user['user__username'])))
+                if len(pending) >= workers * 2:
+                    user, future = pending.popleft()
+                    yield user, future.result()
+            while pending:
+                user, future = pending.popleft()
+                yield user, future.result()
+
     def handle(self, *args, **options):
         verbosity = int(options['verbosity'])
         root_logger = logging.getLogger('')
@@ -46,54 +113,18 @@ class Command(BaseCommand):
         if options['header']:
             self.write('\t'.join(header))
 
-        bus = dbus.SystemBus()
-        infopipe_obj = bus.get_object("org.freedesktop.sssd.infopipe", "/org/freedesktop/sssd/infopipe")
-        ifp = dbus.Interface(infopipe_obj, dbus_interface='org.freedesktop.sssd.infopipe')
-
+        self._local = threading.local()
 
         expired_365_days_ago = datetime.datetime.today() - datetime.timedelta(days=365)
-
         expired_365_days_ago = expired_365_days_ago.date()
-        # Find all active users on active allocations
-        active_users = sorted(list(set(AllocationUser.objects.filter(allocation__project__status__name__in=[
-            'Active', 'New'], allocation__status__name='Active', status__name='Active').values_list('user__username', flat=True))))
-
-        # Find all user in expired allocations
-        expired_allocation_users = {}
-        for allocation in Allocation.objects.filter(status__name='Expired'):
-            for allocationuser in allocation.allocationuser_set.all():
-                if allocationuser.user.username in active_users:
-                    continue
-
-                if allocationuser.user.username not in expired_allocation_users:
-                    expired_allocation_users[allocationuser.user.username] = {
-                        'expire_date': allocation.end_date,
-                        'allocation_id': allocation.id
-                    }
-                else:
-                    if allocation.end_date > expired_allocation_users[allocationuser.user.username]['expire_date']:
-                        expired_allocation_users[allocationuser.user.username] = {
-                            'expire_date': allocation.end_date,
-                            'allocation_id': allocation.id
-                        }
-
-        # Print users whose latest allocation expiration date GTE 365 days and active in FreeIPA
-        for key in expired_allocation_users.keys():
-            if expired_allocation_users[key]['expire_date'] < expired_365_days_ago:
-                try:
-                    result = ifp.GetUserAttr(key, ["nsaccountlock"])
-                    if 'nsAccountLock' in result and str(result['nsAccountLock'][0]) == 'TRUE':
-                        # User is already disabled in FreeIPA so do nothing
-                        pass
-                    else:
-                        # User is active in FreeIPA but not on any active allocations
-                        self.write('\t'.join([
-                            key,
-                            str(expired_allocation_users[key]['allocation_id']),
-                            expired_allocation_users[key]['expire_date'].strftime("%Y-%m-%d")
-                        ]))
-                except dbus.exceptions.DBusException as e:
-                    if 'No such user' in str(e):
-                        logger.info("User %s not found in FreeIPA", key)
-                    else:
-                        logger.error("dbus error failed to find user %s in FreeIPA: %s", key, e)
+
+        # Print users whose latest allocation expiration date is over 365 days
+        # ago, who are not on any active allocations and are active in FreeIPA
+        users = self.expired_users(expired_365_days_ago).iterator()
+        for user, enabled in self.lookup(users, max(1, options['workers'])):
+            if enabled:
+                self.write('\t'.join([
+                    user['user__username'],
+                    str(user['allocation_id']),
+                    user['expire_date'].strftime("%Y-%m-%d")
+                ]))
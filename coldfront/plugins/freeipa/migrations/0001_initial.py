@@ -0,0 +1,31 @@
+# Generated by Django 4.2.11 on 2026-10-18 21:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import model_utils.fields
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('allocation', '0006_attributeexpansiondependency'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MembershipChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', model_utils.fields.AutoCreatedField(default=django.utils.timezone.now, editable=False, verbose_name='created')),
+                ('modified', model_utils.fields.AutoLastModifiedField(default=django.utils.timezone.now, editable=False, verbose_name='modified')),
+                ('action', models.CharField(choices=[('add', 'Add'), ('remove', 'Remove')], max_length=6)),
+                ('allocation_user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='allocation.allocationuser')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
@@ -0,0 +1,26 @@
+from django.db import models
+from model_utils.models import TimeStampedModel
+
+from coldfront.core.allocation.models import AllocationUser
+
+
+class MembershipChange(TimeStampedModel):
+    """ A membership change is a pending update of the FreeIPA groups of an allocation user, queued by the allocation user signals and applied in batches by coldfront.plugins.freeipa.tasks.flush_membership_changes.
+
+    Attributes:
+        allocation_user (AllocationUser): allocation user whose groups changed
+        action (str): whether the user was added to or removed from the allocation
+    """
+
+    ADD = 'add'
+    REMOVE = 'remove'
+    ACTION_CHOICES = (
+        (ADD, 'Add'),
+        (REMOVE, 'Remove'),
+    )
+
+    allocation_user = models.ForeignKey(AllocationUser, on_delete=models.CASCADE)
+    action = models.CharField(max_length=6, choices=ACTION_CHOICES)
+
+    def __str__(self):
+        return '{} {}'.format(self.action, self.allocation_user)
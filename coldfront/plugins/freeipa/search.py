@@ -71,3 +71,47 @@ class LDAPUserSearch(UserSearch):
 
         logger.info("LDAP user search for %s found %s results", user_search_string, len(users))
         return users
+
+    def search_many(self, usernames):
+        """Returns the enabled users with the given usernames, searching for
+        up to 100 usernames with one OR filter"""
+        os.environ["KRB5_CLIENT_KTNAME"] = self.FREEIPA_KTNAME
+
+        users = []
+        for i in range(0, len(usernames), 100):
+            batch = usernames[i:i + 100]
+            filter = "(&(|{})(|(nsaccountlock=FALSE)(!(nsaccountlock=*))))".format(''.join(
+                ldap.filter.filter_format("(uid=%s)", [username]) for username in batch))
+            self.conn.search(search_base=self.FREEIPA_USER_SEARCH_BASE,
+                             search_filter=filter,
+                             attributes=['uid', 'sn', 'givenName', 'mail'],
+                             size_limit=len(batch))
+            users.extend(self.parse_ldap_entry(entry) for entry in self.conn.entries)
+
+        logger.info("LDAP user search for %s usernames found %s results", len(usernames), len(users))
+        return users
+
+    def account_status(self, usernames):
+        """Returns a dict of username to whether the account is enabled, for
+        the usernames found in FreeIPA, searching for up to 100 usernames with
+        one OR filter"""
+        os.environ["KRB5_CLIENT_KTNAME"] = self.FREEIPA_KTNAME
+
+        statuses = {}
+        for i in range(0, len(usernames), 100):
+            batch = usernames[i:i + 100]
+            filter = "(|{})".format(''.join(
+                ldap.filter.filter_format("(uid=%s)", [username]) for username in batch))
+            self.conn.search(search_base=self.FREEIPA_USER_SEARCH_BASE,
+                             search_filter=filter,
+                             attributes=['uid', 'nsAccountLock'],
+                             size_limit=len(batch))
+            for entry in self.conn.entries:
+                entry_dict = json.loads(entry.entry_to_json()).get('attributes')
+                if not entry_dict.get('uid'):
+                    continue
+                locked = entry_dict.get('nsAccountLock') or []
+                statuses[entry_dict['uid'][0]] = not (locked and str(locked[0]).upper() == 'TRUE')
+
+        logger.info("LDAP account status for %s usernames found %s users", len(usernames), len(statuses))
+        return statuses
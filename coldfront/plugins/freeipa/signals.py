@@ -1,5 +1,4 @@
 from django.dispatch import receiver
-from django_q.tasks import async_task
 
 from coldfront.core.allocation.signals import (allocation_activate_user,
                                                allocation_remove_user)
@@ -9,14 +8,15 @@ from coldfront.core.allocation.views import (AllocationAddUsersView,
 from coldfront.core.project.views import (ProjectAddUsersView,
                                           ProjectRemoveUsersView)
 from coldfront.core.utils.common import import_from_settings
+from coldfront.plugins.freeipa.models import MembershipChange
+from coldfront.plugins.freeipa.tasks import queue_membership_change
 
 
 @receiver(allocation_activate_user, sender=ProjectAddUsersView)
 @receiver(allocation_activate_user, sender=AllocationAddUsersView)
 def activate_user(sender, **kwargs):
     allocation_user_pk = kwargs.get('allocation_user_pk')
-    async_task('coldfront.plugins.freeipa.tasks.add_user_group',
-               allocation_user_pk)
+    queue_membership_change(allocation_user_pk, MembershipChange.ADD)
 
 
 @receiver(allocation_remove_user, sender=ProjectRemoveUsersView)
@@ -24,5 +24,4 @@ def activate_user(sender, **kwargs):
 @receiver(allocation_remove_user, sender=AllocationRenewView)
 def remove_user(sender, **kwargs):
     allocation_user_pk = kwargs.get('allocation_user_pk')
-    async_task('coldfront.plugins.freeipa.tasks.remove_user_group',
-               allocation_user_pk)
+    queue_membership_change(allocation_user_pk, MembershipChange.REMOVE)
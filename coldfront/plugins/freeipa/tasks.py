@@ -1,16 +1,25 @@
+import datetime
 import logging
 import os
+from collections import defaultdict
 
 from django.contrib.auth.models import User
-from ipalib import api
+from django.db import transaction
+from django.utils import timezone
+from django_q.models import Schedule
+from django_q.tasks import async_task, schedule
 
-from coldfront.core.allocation.models import Allocation, AllocationUser
+from coldfront.core.allocation.models import (Allocation, AllocationAttribute,
+                                              AllocationUser)
 from coldfront.core.allocation.utils import set_allocation_user_status_to_error
+from coldfront.plugins.freeipa.models import MembershipChange
 from coldfront.plugins.freeipa.utils import (CLIENT_KTNAME, FREEIPA_NOOP,
+                                             FREEIPA_MEMBERSHIP_QUEUE_DELAY,
                                              UNIX_GROUP_ATTRIBUTE_NAME,
                                              AlreadyMemberError, ApiError,
                                              NotMemberError,
-                                             check_ipa_group_error)
+                                             check_ipa_group_error, ipa,
+                                             update_group_members)
 
 logger = logging.getLogger(__name__)
 
@@ -40,7 +49,7 @@ def add_user_group(allocation_user_pk):
             continue
 
         try:
-            res = api.Command.group_add_member(
+            res = ipa.Command.group_add_member(
                 g, user=[allocation_user.user.username])
             check_ipa_group_error(res)
         except AlreadyMemberError as e:
@@ -104,7 +113,7 @@ def remove_user_group(allocation_user_pk):
             continue
 
         try:
-            res = api.Command.group_remove_member(
+            res = ipa.Command.group_remove_member(
                 g, user=[allocation_user.user.username])
             check_ipa_group_error(res)
         except NotMemberError as e:
@@ -117,3 +126,134 @@ def remove_user_group(allocation_user_pk):
         else:
             logger.info("Removed user %s from group %s successfully",
                         allocation_user.user.username, g)
+
+
+FLUSH_SCHEDULE_NAME = 'freeipa-flush-membership-changes'
+
+
+def queue_membership_change(allocation_user_pk, action):
+    """Queues a FreeIPA group membership change for the allocation user.
+
+    Changes are applied by flush_membership_changes, scheduled to run
+    FREEIPA_MEMBERSHIP_QUEUE_DELAY seconds after the first queued change, so
+    that users added or removed meanwhile are sent together.
+    """
+    MembershipChange.objects.create(allocation_user_id=allocation_user_pk, action=action)
+
+    if FREEIPA_MEMBERSHIP_QUEUE_DELAY <= 0:
+        async_task('coldfront.plugins.freeipa.tasks.flush_membership_changes')
+        return
+
+    if not Schedule.objects.filter(name=FLUSH_SCHEDULE_NAME).exists():
+        schedule('coldfront.plugins.freeipa.tasks.flush_membership_changes',
+                 name=FLUSH_SCHEDULE_NAME,
+                 schedule_type=Schedule.ONCE,
+                 next_run=timezone.now() + datetime.timedelta(seconds=FREEIPA_MEMBERSHIP_QUEUE_DELAY))
+
+
+def membership_updates(actions):
+    """Returns the group membership updates for the allocation users in
+    actions, a dict of allocation user pk to MembershipChange action.
+
+    Follows the rules of add_user_group and remove_user_group.  Returns
+    (add, remove, sources) where add and remove map groups to sets of
+    usernames and sources maps (group, username, action) to the allocation
+    user pks the update came from.  A user both added to and removed from
+    a group is only added.
+    """
+    groups_by_allocation = defaultdict(set)
+    allocation_users = list(AllocationUser.objects.filter(pk__in=actions).values_list(
+        'pk', 'user_id', 'user__username', 'status__name', 'allocation_id', 'allocation__status__name'))
+    for allocation_id, group in AllocationAttribute.objects.filter(
+            allocation_attribute_type__name=UNIX_GROUP_ATTRIBUTE_NAME,
+            allocation_id__in={row[4] for row in allocation_users}).values_list('allocation_id', 'value'):
+        groups_by_allocation[allocation_id].add(group)
+
+    add = defaultdict(set)
+    remove = defaultdict(set)
+    sources = defaultdict(set)
+    removals = []
+    for pk, user_id, username, status, allocation_id, allocation_status in allocation_users:
+        if actions[pk] == MembershipChange.ADD:
+            if allocation_status != 'Active':
+                logger.warn("Allocation is not active. Will not add groups for %s", username)
+                continue
+            if status != 'Active':
+                logger.warn("Allocation user status is not 'Active'. Will not add groups for %s", username)
+                continue
+            for g in groups_by_allocation[allocation_id]:
+                add[g].add(username)
+                sources[(g, username, MembershipChange.ADD)].add(pk)
+        else:
+            if allocation_status not in ['Active', 'Pending', 'Inactive (Renewed)', ]:
+                logger.warn("Allocation is not active or pending. Will not remove groups for %s", username)
+                continue
+            if status != 'Removed':
+                logger.warn("Allocation user status is not 'Removed'. Will not remove groups for %s", username)
+                continue
+            removals.append((pk, user_id, username, allocation_id))
+
+    # Groups users keep through other active allocations they are active on
+    kept = defaultdict(set)
+    if removals:
+        for user_id, allocation_id, group in AllocationAttribute.objects.filter(
+                allocation_attribute_type__name=UNIX_GROUP_ATTRIBUTE_NAME,
+                allocation__status__name='Active',
+                allocation__allocationuser__status__name='Active',
+                allocation__allocationuser__user_id__in={row[1] for row in removals},
+        ).values_list('allocation__allocationuser__user_id', 'allocation_id', 'value'):
+            kept[user_id].add((allocation_id, group))
+
+    for pk, user_id, username, allocation_id in removals:
+        keep = {g for a, g in kept[user_id] if a != allocation_id}
+        for g in groups_by_allocation[allocation_id] - keep:
+            remove[g].add(username)
+            sources[(g, username, MembershipChange.REMOVE)].add(pk)
+
+    remove = {g: usernames - add.get(g, set()) for g, usernames in remove.items()}
+    remove = {g: usernames for g, usernames in remove.items() if usernames}
+
+    return add, remove, sources
+
+
+def flush_membership_changes():
+    """Applies the queued membership changes with one FreeIPA call per group
+    and action (per FREEIPA_GROUP_MEMBER_BATCH_SIZE users).
+
+    Only the latest change of each allocation user is applied.  Allocation
+    users that could not be updated are set to the Error status.
+    """
+    with transaction.atomic():
+        changes = list(MembershipChange.objects.order_by('pk').values_list(
+            'pk', 'allocation_user_id', 'action'))
+        MembershipChange.objects.filter(pk__in=[pk for pk, _, _ in changes]).delete()
+
+    if not changes:
+        return
+
+    actions = {}
+    for _, allocation_user_pk, action in changes:
+        actions[allocation_user_pk] = action
+
+    add, remove, sources = membership_updates(actions)
+    logger.info("Flushing %s FreeIPA membership changes to %s groups",
+                len(changes), len(set(add) | set(remove)))
+
+    if FREEIPA_NOOP:
+        for g, usernames in sorted(add.items()):
+            logger.warn("NOOP - FreeIPA adding users %s to group %s", sorted(usernames), g)
+        for g, usernames in sorted(remove.items()):
+            logger.warn("NOOP - FreeIPA removing users %s from group %s", sorted(usernames), g)
+        return
+
+    os.environ["KRB5_CLIENT_KTNAME"] = CLIENT_KTNAME
+    failed = set()
+    for action, updates in [(MembershipChange.ADD, add), (MembershipChange.REMOVE, remove)]:
+        for g, usernames in sorted(updates.items()):
+            for username in update_group_members(g, sorted(usernames), add=action == MembershipChange.ADD):
+                failed.update(sources[(g, username, action)])
+
+    for allocation_user_pk in sorted(failed):
+        set_allocation_user_status_to_error(allocation_user_pk)
+
+    ipa.log_stats()
@@ -0,0 +1,112 @@
+from io import StringIO
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import TestCase
+
+from coldfront.core.allocation.models import Allocation
+from coldfront.core.test_helpers.factories import (
+    AllocationAttributeFactory,
+    AllocationAttributeTypeFactory,
+    AllocationStatusChoiceFactory,
+    AllocationUserFactory,
+    AllocationUserStatusChoiceFactory,
+    ProjectFactory,
+    ResourceFactory,
+    UserFactory,
+)
+
+from coldfront.plugins.freeipa import utils
+from coldfront.plugins.freeipa.management.commands import freeipa_check
+
+GROUP_MEMBERS = {
+    'grp1': {'member_user': ['bob', 'carol'], 'memberindirect_user': ['erin']},
+    'grp2': {'member_user': ['alice']},
+}
+
+DONE = {'completed': 1, 'failed': {'member': {'user': []}}}
+
+
+class FreeIPACheckByGroupTest(TestCase):
+    """tests for the group-centric mode of freeipa_check"""
+
+    @classmethod
+    def setUpTestData(cls):
+        """Set up allocations with freeipa groups"""
+        project = ProjectFactory()
+        cluster = ResourceFactory(name='cluster', is_available=True)
+        freeipa_group = AllocationAttributeTypeFactory(name='freeipa_group')
+        active_user = AllocationUserStatusChoiceFactory(name='Active')
+        removed_user = AllocationUserStatusChoiceFactory(name='Removed')
+
+        def allocation(status, groups, users):
+            allocation = Allocation.objects.create(
+                project=project, justification='test',
+                status=AllocationStatusChoiceFactory(name=status))
+            allocation.resources.add(cluster)
+            for group in groups:
+                AllocationAttributeFactory(
+                    allocation=allocation, allocation_attribute_type=freeipa_group, value=group)
+            for username, status in users:
+                AllocationUserFactory(allocation=allocation, user=UserFactory(username=username),
+                                      status=status)
+
+        allocation('Active', ['grp1'], [('alice', active_user), ('bob', removed_user),
+                                        ('carol', active_user), ('erin', active_user),
+                                        ('frank', active_user)])
+        allocation('Expired', ['grp2'], [('alice', active_user)])
+        allocation('New', ['grp3'], [('dave', removed_user)])
+
+    def run_check(self, *args):
+        ipa = mock.MagicMock()
+        ipa.Command.group_show.side_effect = lambda group: {'result': GROUP_MEMBERS[group]}
+        ipa.Command.group_add_member.return_value = DONE
+        ipa.Command.group_remove_member.return_value = DONE
+        ldap = mock.MagicMock()
+        ldap.return_value.account_status.side_effect = lambda usernames: {
+            username: username != 'carol' for username in usernames if username != 'frank'}
+
+        out = StringIO()
+        with mock.patch.object(utils, 'api', ipa), \
+                mock.patch.object(freeipa_check, 'LDAPUserSearch', ldap):
+            call_command(freeipa_check.Command(), '--by-group', *args, stdout=out)
+        return ipa, [line.split('\t') for line in out.getvalue().splitlines()]
+
+    def test_report(self):
+        """test that the report lists the missing and extra memberships"""
+        ipa, rows = self.run_check()
+        self.assertEqual(rows, [
+            ['alice', 'grp1', '', 'Enabled', 'Active'],
+            ['alice', '', 'grp2', 'Enabled', 'Active'],
+            ['bob', '', 'grp1', 'Enabled', 'Active'],
+        ])
+        self.assertEqual(sorted(c.args[0] for c in ipa.Command.group_show.call_args_list),
+                         ['grp1', 'grp2'])
+        ipa.Command.group_add_member.assert_not_called()
+        ipa.Command.group_remove_member.assert_not_called()
+        self.assertTrue(User.objects.get(username='carol').is_active)
+
+    def test_sync(self):
+        """test that changes are applied with one call per group"""
+        ipa, rows = self.run_check('--sync')
+        ipa.Command.group_add_member.assert_called_once_with('grp1', user=['alice'])
+        self.assertEqual(sorted(ipa.Command.group_remove_member.call_args_list), sorted([
+            mock.call('grp1', user=['bob']),
+            mock.call('grp2', user=['alice']),
+        ]))
+        self.assertFalse(User.objects.get(username='carol').is_active)
+
+    def test_filter_group(self):
+        """test that --group limits the check to one group"""
+        ipa, rows = self.run_check('--group', 'grp2')
+        self.assertEqual(rows, [['alice', '', 'grp2', 'Enabled', 'Active']])
+        ipa.Command.group_show.assert_called_once_with('grp2')
+
+    def test_user_missing_from_freeipa(self):
+        """test that users not in FreeIPA are skipped, not deactivated"""
+        ipa, rows = self.run_check('--sync')
+        self.assertNotIn('frank', [row[0] for row in rows])
+        for c in ipa.Command.group_add_member.call_args_list:
+            self.assertNotIn('frank', c.kwargs['user'])
+        self.assertTrue(User.objects.get(username='frank').is_active)
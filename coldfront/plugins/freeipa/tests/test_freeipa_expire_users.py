@@ -0,0 +1,90 @@
+import datetime
+from io import StringIO
+from unittest import mock
+
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from coldfront.core.allocation.models import Allocation
+from coldfront.core.test_helpers.factories import (
+    AllocationStatusChoiceFactory,
+    AllocationUserFactory,
+    AllocationUserStatusChoiceFactory,
+    ProjectFactory,
+    ProjectStatusChoiceFactory,
+    UserFactory,
+)
+from coldfront.plugins.freeipa.management.commands import freeipa_expire_users
+
+LOCKED = {'alice'}
+MISSING = {'dave'}
+
+
+class DBusException(Exception):
+    pass
+
+
+class FakeInfopipe:
+    def GetUserAttr(self, username, attrs):
+        if username in MISSING:
+            raise DBusException('No such user')
+        return {'nsAccountLock': ['TRUE' if username in LOCKED else 'FALSE']}
+
+
+class FreeIPAExpireUsersTest(TestCase):
+    """tests for the report of users to expire in FreeIPA"""
+
+    @classmethod
+    def setUpTestData(cls):
+        """Set up expired and active allocations"""
+        project = ProjectFactory(status=ProjectStatusChoiceFactory(name='Active'))
+        active_user = AllocationUserStatusChoiceFactory(name='Active')
+        today = datetime.date.today()
+        users = {}
+
+        def allocation(status, days_ago, usernames):
+            allocation = Allocation.objects.create(
+                project=project, justification='test',
+                status=AllocationStatusChoiceFactory(name=status),
+                end_date=today - datetime.timedelta(days=days_ago) if days_ago is not None else None)
+            for username in usernames:
+                if username not in users:
+                    users[username] = UserFactory(username=username)
+                AllocationUserFactory(allocation=allocation, user=users[username], status=active_user)
+            return allocation
+
+        cls.old = allocation('Expired', 800, ['alice', 'bob', 'carol', 'dave', 'erin'])
+        cls.older = allocation('Expired', 900, ['bob', 'frank'])
+        # No end date, never the latest expired allocation
+        allocation('Expired', None, ['frank'])
+        allocation('Expired', 100, ['carol'])
+        allocation('Active', -100, ['erin'])
+
+    def run_command(self, *args):
+        dbus = mock.MagicMock()
+        dbus.exceptions.DBusException = DBusException
+        dbus.Interface.return_value = FakeInfopipe()
+        out = StringIO()
+        with mock.patch.object(freeipa_expire_users, 'dbus', dbus):
+            call_command(freeipa_expire_users.Command(), *args, stdout=out)
+        return [line.split('\t') for line in out.getvalue().splitlines()]
+
+    def test_report(self):
+        """test that users whose allocations all expired over a year ago are reported"""
+        old_date = self.old.end_date.strftime('%Y-%m-%d')
+        self.assertEqual(self.run_command('--header', '--workers', '2'), [
+            ['username', 'allocation_id', 'expire_date'],
+            ['bob', str(self.old.pk), old_date],
+            ['frank', str(self.older.pk), self.older.end_date.strftime('%Y-%m-%d')],
+        ])
+
+    def test_candidates_in_one_query(self):
+        """test that the candidate users are found with a single query"""
+        command = freeipa_expire_users.Command()
+        expired_before = datetime.date.today() - datetime.timedelta(days=365)
+        with CaptureQueriesContext(connection) as queries:
+            users = list(command.expired_users(expired_before))
+        self.assertEqual(len(queries), 1)
+        self.assertEqual([u['user__username'] for u in users], ['alice', 'bob', 'dave', 'frank'])
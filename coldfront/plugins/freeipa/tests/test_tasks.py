@@ -0,0 +1,105 @@
+from unittest import mock
+
+from django.test import TestCase
+from django_q.models import Schedule
+
+from coldfront.core.allocation.models import Allocation, AllocationUser
+from coldfront.core.test_helpers.factories import (
+    AllocationAttributeFactory,
+    AllocationAttributeTypeFactory,
+    AllocationStatusChoiceFactory,
+    AllocationUserFactory,
+    AllocationUserStatusChoiceFactory,
+    ProjectFactory,
+    UserFactory,
+)
+
+from coldfront.plugins.freeipa import tasks, utils
+from coldfront.plugins.freeipa.models import MembershipChange
+
+
+def result(failed=()):
+    return {'completed': 1, 'failed': {'member': {'user': list(failed)}}}
+
+
+class MembershipQueueTest(TestCase):
+    """tests for the coalescing FreeIPA membership queue"""
+
+    @classmethod
+    def setUpTestData(cls):
+        """Set up allocations with freeipa groups"""
+        project = ProjectFactory()
+        freeipa_group = AllocationAttributeTypeFactory(name='freeipa_group')
+        active = AllocationUserStatusChoiceFactory(name='Active')
+        removed = AllocationUserStatusChoiceFactory(name='Removed')
+        AllocationUserStatusChoiceFactory(name='Error')
+
+        cls.allocation_users = {}
+
+        def allocation(name, status, groups, users):
+            allocation = Allocation.objects.create(
+                project=project, justification=name,
+                status=AllocationStatusChoiceFactory(name=status))
+            for group in groups:
+                AllocationAttributeFactory(
+                    allocation=allocation, allocation_attribute_type=freeipa_group, value=group)
+            for username, status in users:
+                cls.allocation_users[(name, username)] = AllocationUserFactory(
+                    allocation=allocation, user=UserFactory(username=username), status=status).pk
+
+        allocation('a', 'Active', ['g1', 'g2'], [('u1', active), ('u2', active),
+                                                 ('u3', removed), ('u4', removed)])
+        allocation('b', 'Active', ['g1'], [('u4', active)])
+        allocation('c', 'Expired', ['g3'], [('u1', active)])
+
+    def queue(self, allocation, username, action):
+        MembershipChange.objects.create(
+            allocation_user_id=self.allocation_users[(allocation, username)], action=action)
+
+    def test_queue_schedules_one_flush(self):
+        """test that queued changes share one scheduled flush"""
+        with mock.patch.object(tasks, 'FREEIPA_MEMBERSHIP_QUEUE_DELAY', 30):
+            tasks.queue_membership_change(self.allocation_users[('a', 'u1')], MembershipChange.ADD)
+            tasks.queue_membership_change(self.allocation_users[('a', 'u2')], MembershipChange.ADD)
+        self.assertEqual(MembershipChange.objects.count(), 2)
+        self.assertEqual(Schedule.objects.filter(name=tasks.FLUSH_SCHEDULE_NAME).count(), 1)
+
+    def test_flush(self):
+        """test that changes are merged per group and conflicts resolved"""
+        for allocation, username, action in [
+                ('a', 'u1', 'add'), ('a', 'u2', 'add'), ('a', 'u3', 'add'), ('a', 'u3', 'remove'),
+                ('a', 'u4', 'remove'), ('c', 'u1', 'add')]:
+            self.queue(allocation, username, action)
+
+        ipa = mock.MagicMock()
+        ipa.Command.group_add_member.side_effect = lambda group, user: result(
+            [('u2', 'boom')] if group == 'g2' else [])
+        ipa.Command.group_remove_member.return_value = result()
+        with mock.patch.object(utils, 'api', ipa), mock.patch.object(tasks, 'FREEIPA_NOOP', False):
+            tasks.flush_membership_changes()
+
+        self.assertEqual(ipa.Command.group_add_member.call_args_list, [
+            mock.call('g1', user=['u1', 'u2']),
+            mock.call('g2', user=['u1', 'u2']),
+        ])
+        # u4 keeps g1 through allocation b
+        self.assertEqual(ipa.Command.group_remove_member.call_args_list, [
+            mock.call('g1', user=['u3']),
+            mock.call('g2', user=['u3', 'u4']),
+        ])
+        self.assertFalse(MembershipChange.objects.exists())
+        statuses = {username: AllocationUser.objects.get(pk=pk).status.name
+                    for (allocation, username), pk in self.allocation_users.items() if allocation == 'a'}
+        self.assertEqual(statuses, {'u1': 'Active', 'u2': 'Error', 'u3': 'Removed', 'u4': 'Removed'})
+
+    def test_membership_updates_conflict(self):
+        """test that a user added to and removed from a group is only added"""
+        removed = AllocationUser.objects.get(pk=self.allocation_users[('b', 'u4')])
+        removed.status = AllocationUserStatusChoiceFactory(name='Removed')
+        removed.save()
+        add, remove, sources = tasks.membership_updates({
+            self.allocation_users[('a', 'u1')]: MembershipChange.ADD,
+            self.allocation_users[('b', 'u4')]: MembershipChange.REMOVE,
+        })
+        self.assertEqual(dict(add), {'g1': {'u1'}, 'g2': {'u1'}})
+        self.assertEqual(remove, {'g1': {'u4'}})
@@ -0,0 +1,78 @@
+from unittest import mock
+
+from django.test import SimpleTestCase
+from ipalib import errors
+
+from coldfront.plugins.freeipa import utils
+
+
+class IPAClientTest(SimpleTestCase):
+    """tests for the lazily connecting FreeIPA client"""
+
+    def setUp(self):
+        self.api = mock.MagicMock()
+        self.api.isdone.return_value = False
+        self.connected = False
+
+        def finalize():
+            self.api.isdone.return_value = True
+
+        def connect():
+            self.connected = True
+
+        def disconnect():
+            self.connected = False
+
+        self.api.finalize.side_effect = finalize
+        self.api.Backend.rpcclient.isconnected.side_effect = lambda: self.connected
+        self.api.Backend.rpcclient.connect.side_effect = connect
+        self.api.Backend.rpcclient.disconnect.side_effect = disconnect
+        patcher = mock.patch.object(utils, 'api', self.api)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_connects_on_first_call(self):
+        """test that the client connects once, on its first call"""
+        ipa = utils.IPAClient()
+        self.api.bootstrap.assert_not_called()
+        self.api.Backend.rpcclient.connect.assert_not_called()
+
+        self.api.Command.group_show.return_value = {'result': {}}
+        self.assertEqual(ipa.Command.group_show('grp1'), {'result': {}})
+        ipa.Command.group_show('grp2')
+        self.api.bootstrap.assert_called_once()
+        self.api.finalize.assert_called_once()
+        self.api.Backend.rpcclient.connect.assert_called_once()
+        self.assertEqual(ipa.stats['group_show']['calls'], 2)
+        self.assertEqual(ipa.stats['group_show']['errors'], 0)
+
+    def test_reconnects_on_network_error(self):
+        """test that a call failing with a network error is retried once"""
+        ipa = utils.IPAClient()
+        self.api.Command.group_show.side_effect = [errors.NetworkError(), {'result': {}}]
+        self.assertEqual(ipa.Command.group_show('grp1'), {'result': {}})
+        self.assertEqual(self.api.Backend.rpcclient.connect.call_count, 2)
+        self.api.Backend.rpcclient.disconnect.assert_called_once()
+        self.assertEqual(ipa.stats['group_show']['calls'], 2)
+        self.assertEqual(ipa.stats['group_show']['errors'], 1)
+
+        self.api.Command.group_show.side_effect = errors.KerberosError()
+        with self.assertRaises(errors.KerberosError):
+            ipa.Command.group_show('grp1')
+
+    def test_reconnects_when_idle(self):
+        """test that a connection idle for too long is replaced"""
+        ipa = utils.IPAClient()
+        ipa.Command.group_show('grp1')
+        with mock.patch.object(utils, 'FREEIPA_CONNECTION_MAX_IDLE', -1):
+            ipa.Command.group_show('grp1')
+        self.assertEqual(self.api.Backend.rpcclient.connect.call_count, 2)
+
+    def test_other_errors_not_retried(self):
+        """test that errors from FreeIPA itself are raised at once"""
+        ipa = utils.IPAClient()
+        self.api.Command.group_show.side_effect = errors.NotFound()
+        with self.assertRaises(errors.NotFound):
+            ipa.Command.group_show('grp1')
+        self.api.Command.group_show.assert_called_once()
+        self.assertEqual(ipa.stats['group_show']['errors'], 1)
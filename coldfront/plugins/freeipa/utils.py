@@ -1,14 +1,21 @@
+import http.client
 import logging
 import os
+import threading
+import time
+from collections import defaultdict
 
 from django.core.exceptions import ImproperlyConfigured
 from coldfront.core.utils.common import import_from_settings
 
-from ipalib import api
+from ipalib import api, errors
 
 CLIENT_KTNAME = import_from_settings('FREEIPA_KTNAME')
 UNIX_GROUP_ATTRIBUTE_NAME = import_from_settings('FREEIPA_GROUP_ATTRIBUTE_NAME', 'freeipa_group')
 FREEIPA_NOOP = import_from_settings('FREEIPA_NOOP', False)
+FREEIPA_GROUP_MEMBER_BATCH_SIZE = import_from_settings('FREEIPA_GROUP_MEMBER_BATCH_SIZE', 100)
+FREEIPA_MEMBERSHIP_QUEUE_DELAY = import_from_settings('FREEIPA_MEMBERSHIP_QUEUE_DELAY', 30)
+FREEIPA_CONNECTION_MAX_IDLE = import_from_settings('FREEIPA_CONNECTION_MAX_IDLE', 300)
 
 logger = logging.getLogger(__name__)
 
@@ -21,14 +28,113 @@ class AlreadyMemberError(ApiError):
 class NotMemberError(ApiError):
     pass
 
-try:
-    os.environ["KRB5_CLIENT_KTNAME"] = CLIENT_KTNAME
-    api.bootstrap()
-    api.finalize()
-    api.Backend.rpcclient.connect()
-except Exception as e:
-    logger.error("Failed to initialze FreeIPA lib: %s", e)
-    raise ImproperlyConfigured('Failed to initialze FreeIPA: {0}'.format(e))
+
+class IPAClient:
+    """FreeIPA API client that connects on first use.
+
+    ipalib's api is bootstrapped and finalized by the first call in the
+    process.  ipalib keeps one rpcclient connection per thread, so each
+    thread connects on its first call and reuses the connection afterwards,
+    e.g. across the tasks run by a django-q worker.  A connection idle for
+    longer than FREEIPA_CONNECTION_MAX_IDLE seconds is replaced, and a call
+    failing with a network or Kerberos error is retried once on a new
+    connection.  Call counts, errors and latency are kept per command in
+    stats.
+
+    Commands are called like ipalib's api: ipa.Command.group_show(group).
+    """
+    RECONNECT_ERRORS = (errors.NetworkError, errors.KerberosError,
+                        ConnectionError, http.client.HTTPException)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.stats = defaultdict(lambda: {'calls': 0, 'errors': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+        self.Command = _Commands(self)
+
+    def _finalize(self):
+        with self._lock:
+            if api.isdone('finalize'):
+                return
+            os.environ["KRB5_CLIENT_KTNAME"] = CLIENT_KTNAME
+            try:
+                api.bootstrap()
+                api.finalize()
+            except Exception as e:
+                logger.error("Failed to initialze FreeIPA lib: %s", e)
+                raise ImproperlyConfigured('Failed to initialze FreeIPA: {0}'.format(e))
+
+    def connect(self, reconnect=False):
+        """Connects this thread to FreeIPA unless it has a usable connection"""
+        self._finalize()
+        rpcclient = api.Backend.rpcclient
+        last_used = getattr(self._local, 'last_used', None)
+        idle = last_used is not None and time.monotonic() - last_used > FREEIPA_CONNECTION_MAX_IDLE
+        if rpcclient.isconnected():
+            if not reconnect and not idle:
+                return
+            try:
+                rpcclient.disconnect()
+            except Exception as e:
+                logger.debug("Failed to disconnect from FreeIPA: %s", e)
+
+        os.environ["KRB5_CLIENT_KTNAME"] = CLIENT_KTNAME
+        rpcclient.connect()
+        logger.info("Connected to FreeIPA")
+
+    def _record(self, command, seconds, failed):
+        with self._lock:
+            stats = self.stats[command]
+            stats['calls'] += 1
+            stats['errors'] += int(failed)
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+        logger.debug("FreeIPA %s took %.3fs", command, seconds)
+
+    def call(self, command, *args, **kwargs):
+        """Runs the FreeIPA command and returns its result"""
+        for attempt in range(2):
+            start = time.monotonic()
+            try:
+                self.connect(reconnect=attempt > 0)
+                result = getattr(api.Command, command)(*args, **kwargs)
+            except self.RECONNECT_ERRORS as e:
+                self._record(command, time.monotonic() - start, True)
+                if attempt:
+                    raise
+                logger.warn("FreeIPA %s failed, reconnecting: %s", command, e)
+                continue
+            except Exception:
+                self._record(command, time.monotonic() - start, True)
+                raise
+            finally:
+                self._local.last_used = time.monotonic()
+
+            self._record(command, time.monotonic() - start, False)
+            return result
+
+    def log_stats(self):
+        """Logs the number of calls, errors and latency of each command"""
+        with self._lock:
+            stats = {command: dict(s) for command, s in self.stats.items()}
+        for command, s in sorted(stats.items()):
+            logger.info("FreeIPA %s: %s calls, %s errors, %.1fms average, %.1fms max",
+                        command, s['calls'], s['errors'],
+                        1000 * s['seconds'] / s['calls'], 1000 * s['max_seconds'])
+
+
+class _Commands:
+    def __init__(self, client):
+        self._client = client
+
+    def __getattr__(self, command):
+        def call(*args, **kwargs):
+            return self._client.call(command, *args, **kwargs)
+        return call
+
+
+ipa = IPAClient()
+
 
 def check_ipa_group_error(res):
     if not res:
@@ -50,3 +156,49 @@ def check_ipa_group_error(res):
         raise NotMemberError(err_msg)
 
     raise ApiError(err_msg)
+
+def group_member_failures(res):
+    """Returns the (username, error message) pairs that failed in the result
+    of a group_add_member or group_remove_member call for many users"""
+    if not res:
+        raise ValueError('Missing FreeIPA response')
+
+    return [(str(user), str(err_msg)) for user, err_msg in res['failed']['member']['user']]
+
+
+def update_group_members(group, usernames, add=True):
+    """Adds (or removes) usernames to group with one FreeIPA call per
+    FREEIPA_GROUP_MEMBER_BATCH_SIZE users.
+
+    Users that already are (or are not) members are not failures. Returns
+    the set of usernames that could not be added (or removed).
+    """
+    command = ipa.Command.group_add_member if add else ipa.Command.group_remove_member
+    action = 'adding users to' if add else 'removing users from'
+    expected_error = 'This entry is already a member' if add else 'This entry is not a member'
+
+    failed = set()
+    for i in range(0, len(usernames), FREEIPA_GROUP_MEMBER_BATCH_SIZE):
+        batch = usernames[i:i + FREEIPA_GROUP_MEMBER_BATCH_SIZE]
+        try:
+            failures = group_member_failures(command(group, user=batch))
+        except Exception as e:
+            logger.error("Failed %s group %s: %s - %s", action, group, batch, e)
+            failed.update(batch)
+            continue
+
+        failed_in_batch = set()
+        for username, err_msg in failures:
+            failed_in_batch.add(username)
+            if err_msg == expected_error:
+                logger.warn("User %s: %s of group %s", username, err_msg, group)
+            else:
+                logger.error("Failed %s group %s: %s - %s", action, group, username, err_msg)
+                failed.add(username)
+
+        for username in batch:
+            if username not in failed_in_batch:
+                logger.info("%s user %s %s group %s successfully",
+                            'Added' if add else 'Removed', username, 'to' if add else 'from', group)
+
+    return failed
@@ -0,0 +1,97 @@
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import SimpleTestCase, override_settings
+from ldap3 import MOCK_SYNC, OFFLINE_SLAPD_2_4, Connection, Server
+
+from coldfront.plugins.ldap_user_search import utils
+from coldfront.plugins.ldap_user_search.utils import LDAPUserSearch
+
+BIND_DN = 'cn=admin,dc=example,dc=org'
+BASE = 'ou=people,dc=example,dc=org'
+
+
+@override_settings(LDAP_USER_SEARCH_SERVER_URI='ldap://mock',
+                   LDAP_USER_SEARCH_BASE=BASE,
+                   LDAP_USER_SEARCH_BIND_DN=BIND_DN,
+                   LDAP_USER_SEARCH_BIND_PASSWORD='secret')
+class LDAPUserSearchTest(SimpleTestCase):
+    """tests for the pooled and cached LDAP user search"""
+
+    def setUp(self):
+        cache.clear()
+        utils.clear_connection_pools()
+        self.addCleanup(utils.clear_connection_pools)
+
+        self.server = Server('mock', get_info=OFFLINE_SLAPD_2_4)
+        self.connections = []
+        conn = self.connect()
+        conn.strategy.add_entry(BIND_DN, {'userPassword': 'secret', 'sn': 'admin'})
+        for username in ['alice', 'bob', 'carol', 'a*b']:
+            conn.strategy.add_entry('uid={},{}'.format(username.replace('*', ''), BASE), {
+                'objectClass': ['person', 'inetOrgPerson'],
+                'uid': username,
+                'sn': username.title(),
+                'givenName': 'Test',
+                'mail': '{}@example.org'.format(username),
+            })
+        self.connections = []
+
+        patcher = mock.patch.object(LDAPUserSearch, 'connect', lambda _: self.connect())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.searches = []
+        search = Connection.search
+
+        def counting_search(conn, *args, **kwargs):
+            self.searches.append(kwargs.get('search_filter'))
+            return search(conn, *args, **kwargs)
+
+        patcher = mock.patch.object(Connection, 'search', counting_search)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def connect(self):
+        # auto_bind has no effect with the mock strategy
+        conn = Connection(self.server, user=BIND_DN, password='secret',
+                          client_strategy=MOCK_SYNC)
+        conn.bind()
+        self.connections.append(conn)
+        return conn
+
+    def test_connection_reused_and_results_cached(self):
+        """test that searches share one connection and repeats are cached"""
+        users = LDAPUserSearch('bob', 'username_only').search()
+        self.assertEqual(users, [{'username': 'bob', 'last_name': 'Bob', 'first_name': 'Test',
+                                  'email': 'bob@example.org', 'source': 'LDAP'}])
+        LDAPUserSearch('bob', 'username_only').search()
+        LDAPUserSearch('carol', 'all_fields').search()
+        self.assertEqual(len(self.connections), 1)
+        self.assertEqual(len(self.searches), 2)
+
+        users = LDAPUserSearch('a*b', 'username_only').search()
+        self.assertEqual([user['username'] for user in users], ['a*b'])
+
+    def test_closed_connection_rebound(self):
+        """test that a closed idle connection is rebound before reuse"""
+        LDAPUserSearch('alice', 'username_only').search()
+        self.connections[0].unbind()
+        self.assertFalse(self.connections[0].bound)
+
+        users = LDAPUserSearch('bob', 'username_only').search()
+        self.assertEqual(len(users), 1)
+        self.assertEqual(len(self.connections), 1)
+        self.assertTrue(self.connections[0].bound)
+
+    def test_search_many_single_query(self):
+        """test that a list of usernames is looked up with one query"""
+        users = LDAPUserSearch('carol alice bob nobody', 'all_fields').search()
+        self.assertEqual([user['username'] for user in users], ['alice', 'bob', 'carol'])
+        self.assertEqual(self.searches, ['(|(uid=alice)(uid=bob)(uid=carol)(uid=nobody))'])
+
+    def test_attributes_excluded_once(self):
+        """test that the schema check exclusions do not grow per search"""
+        LDAPUserSearch('alice', 'username_only').search()
+        excluded = utils.get_config_parameter('ATTRIBUTES_EXCLUDED_FROM_CHECK')
+        LDAPUserSearch('alice', 'username_only').search()
+        self.assertEqual(utils.get_config_parameter('ATTRIBUTES_EXCLUDED_FROM_CHECK'), excluded)
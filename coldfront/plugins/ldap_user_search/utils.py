@@ -1,13 +1,137 @@
+#Connections are shared by all searches in a process through a
+#LDAPConnectionPool per server and bind DN, so a search does not pay for a
+#new (TLS) connection and bind.  Idle connections that were closed are
+#rebound, and those idle for longer than LDAP_USER_SEARCH_POOL_CHECK_INTERVAL
+#seconds are checked with a Who Am I request first.  Search results are
+#cached for LDAP_USER_SEARCH_CACHE_TIMEOUT seconds, and a list of usernames
+#is looked up with one OR filter query.
+
+import hashlib
 import json
 import logging
+import threading
+import time
+
+from django.core.cache import cache
+from ldap3 import (SASL, Connection, Server, Tls, get_config_parameter,
+                   set_config_parameter)
+from ldap3.core.exceptions import LDAPCommunicationError, LDAPException
+from ldap3.utils.conv import escape_filter_chars
 
-import ldap.filter
 from coldfront.core.user.utils import UserSearch
 from coldfront.core.utils.common import import_from_settings
-from ldap3 import Connection, Server, Tls, get_config_parameter, set_config_parameter, SASL
 
 logger = logging.getLogger(__name__)
 
+LDAP_USER_SEARCH_POOL_SIZE = import_from_settings('LDAP_USER_SEARCH_POOL_SIZE', 4)
+LDAP_USER_SEARCH_POOL_CHECK_INTERVAL = import_from_settings('LDAP_USER_SEARCH_POOL_CHECK_INTERVAL', 60)
+LDAP_USER_SEARCH_CACHE_TIMEOUT = import_from_settings('LDAP_USER_SEARCH_CACHE_TIMEOUT', 300)
+
+# Usernames per OR filter query
+USERNAME_BATCH_SIZE = 100
+
+
+class LDAPConnectionPool:
+    """Keeps up to size idle connections made by connect.
+
+    connections are lent out by search(), so each thread uses its own
+    connection.  If the connection fails during a search it is discarded
+    and the search is retried once on a new connection.
+    """
+
+    def __init__(self, connect, size=LDAP_USER_SEARCH_POOL_SIZE,
+                 check_interval=LDAP_USER_SEARCH_POOL_CHECK_INTERVAL):
+        self.connect = connect
+        self.size = size
+        self.check_interval = check_interval
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _discard(self, conn):
+        try:
+            conn.unbind()
+        except LDAPException:
+            pass
+
+    def _is_healthy(self, conn, idle_since):
+        try:
+            if conn.closed or not conn.bound:
+                logger.debug('Rebinding idle LDAP connection')
+                return conn.rebind()
+            if time.monotonic() - idle_since > self.check_interval:
+                return conn.extend.standard.who_am_i() is not None
+        except LDAPException as e:
+            logger.info('Discarding idle LDAP connection: %s', e)
+            return False
+        return True
+
+    def checkout(self):
+        """Returns an idle connection that passes the health check, or a new one"""
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                conn, idle_since = self._idle.pop()
+            if self._is_healthy(conn, idle_since):
+                return conn
+            self._discard(conn)
+        return self.connect()
+
+    def checkin(self, conn):
+        """Returns conn to the pool, or unbinds it if the pool is full"""
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append((conn, time.monotonic()))
+                return
+        self._discard(conn)
+
+    def search(self, **params):
+        """Runs an ldap3 search and returns the attributes of the entries"""
+        for attempt in range(2):
+            conn = self.checkout()
+            try:
+                conn.search(**params)
+                entries = [json.loads(entry.entry_to_json()).get('attributes')
+                           for entry in conn.entries]
+            except LDAPCommunicationError as e:
+                self._discard(conn)
+                if attempt:
+                    raise
+                logger.info('Retrying LDAP search on a new connection: %s', e)
+                continue
+            except Exception:
+                self._discard(conn)
+                raise
+            self.checkin(conn)
+            return entries
+
+    def clear(self):
+        """Unbinds all idle connections"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._discard(conn)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_connection_pool(key, connect):
+    """Returns the process-wide pool for key, created with connect"""
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = LDAPConnectionPool(connect)
+        return _pools[key]
+
+
+def clear_connection_pools():
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.clear()
+
 
 class LDAPUserSearch(UserSearch):
     search_source = 'LDAP'
@@ -35,6 +159,18 @@ class LDAPUserSearch(UserSearch):
                                                   })
         self.MAPPING_CALLBACK = import_from_settings('LDAP_USER_SEARCH_MAPPING_CALLBACK', self.parse_ldap_entry)
 
+        self.pool = get_connection_pool(
+            (self.LDAP_SERVER_URI, self.LDAP_BIND_DN, self.LDAP_SASL_MECHANISM), self.connect)
+
+        # Requested attributes are checked against the server schema unless
+        # excluded.  Only add missing ones, the parameter is process-wide.
+        excluded = get_config_parameter('ATTRIBUTES_EXCLUDED_FROM_CHECK')
+        missing = [attr for attr in self.ATTRIBUTE_MAP.values() if attr not in excluded]
+        if missing:
+            set_config_parameter('ATTRIBUTES_EXCLUDED_FROM_CHECK', excluded + missing)
+
+    def connect(self):
+        """Returns a new bound connection to the LDAP server"""
         tls = None
         if self.LDAP_USE_TLS:
             tls = Tls(
@@ -43,13 +179,13 @@ class LDAPUserSearch(UserSearch):
                 ca_certs_file=self.LDAP_CACERT_FILE,
             )
 
-        self.server = Server(self.LDAP_SERVER_URI, use_ssl=self.LDAP_USE_SSL, connect_timeout=self.LDAP_CONNECT_TIMEOUT, tls=tls)
+        server = Server(self.LDAP_SERVER_URI, use_ssl=self.LDAP_USE_SSL, connect_timeout=self.LDAP_CONNECT_TIMEOUT, tls=tls)
         conn_params = {"auto_bind": True}
         if self.LDAP_SASL_MECHANISM:
             conn_params["sasl_mechanism"] = self.LDAP_SASL_MECHANISM
             conn_params["sasl_credentials"] = self.LDAP_SASL_CREDENTIALS
             conn_params["authentication"] = SASL
-        self.conn = Connection(self.server, self.LDAP_BIND_DN, self.LDAP_BIND_PASSWORD, **conn_params)
+        return Connection(server, self.LDAP_BIND_DN, self.LDAP_BIND_PASSWORD, **conn_params)
 
     @staticmethod
     def parse_ldap_entry(attribute_map, entry_dict):
@@ -58,42 +194,66 @@ class LDAPUserSearch(UserSearch):
             user_dict[user_attr] = entry_dict.get(ldap_attr)[0] if entry_dict.get(ldap_attr) else ''
         return user_dict
 
+    def cached_search(self, filter, size_limit):
+        """Returns the attributes of the entries matching filter.
+
+        Results are cached for LDAP_USER_SEARCH_CACHE_TIMEOUT seconds.
+        """
+        searchParameters = {'search_base': self.LDAP_USER_SEARCH_BASE,
+                            'search_filter': filter,
+                            'attributes': list(self.ATTRIBUTE_MAP.values()),
+                            'size_limit': size_limit}
+        logger.debug(f"search params: {searchParameters}")
+        if not LDAP_USER_SEARCH_CACHE_TIMEOUT:
+            return self.pool.search(**searchParameters)
+
+        key = 'coldfront-ldap-user-search-' + hashlib.sha256(repr(
+            (self.LDAP_SERVER_URI, sorted(searchParameters.items()))).encode()).hexdigest()
+        entries = cache.get(key)
+        if entries is None:
+            entries = self.pool.search(**searchParameters)
+            cache.set(key, entries, LDAP_USER_SEARCH_CACHE_TIMEOUT)
+        return entries
+
+    def to_users(self, entries):
+        users = []
+        for entry_dict in entries:
+            logger.debug(f"Entry dict: {entry_dict}")
+            user_dict = self.MAPPING_CALLBACK(self.ATTRIBUTE_MAP, entry_dict)
+            user_dict["source"] = self.search_source
+            users.append(user_dict)
+        return users
+
     def search_a_user(self, user_search_string=None, search_by='all_fields'):
         size_limit = 50
         ldap_attrs = list(self.ATTRIBUTE_MAP.values())
-        attrs = get_config_parameter("ATTRIBUTES_EXCLUDED_FROM_CHECK")
-        attrs.extend(ldap_attrs)
-        set_config_parameter("ATTRIBUTES_EXCLUDED_FROM_CHECK", attrs)
         if user_search_string and search_by == 'all_fields':
-            filter = ldap.filter.filter_format(
-                f"(|({ldap_attrs[0]}=*%s*)({ldap_attrs[1]}=*%s*)({ldap_attrs[2]}=*%s*)({ldap_attrs[3]}=*%s*))",
-                [user_search_string] * 4)
+            value = escape_filter_chars(user_search_string)
+            filter = f"(|({ldap_attrs[0]}=*{value}*)({ldap_attrs[1]}=*{value}*)({ldap_attrs[2]}=*{value}*)({ldap_attrs[3]}=*{value}*))"
         elif user_search_string and search_by == 'username_only':
             attr = self.USERNAME_ONLY_ATTR
-            filter = ldap.filter.filter_format(
-                f"({self.ATTRIBUTE_MAP[attr]}=%s)", [user_search_string]
-            )
+            filter = f"({self.ATTRIBUTE_MAP[attr]}={escape_filter_chars(user_search_string)})"
             size_limit = 1
         elif user_search_string and search_by in self.ATTRIBUTE_MAP.keys():
-            filter = ldap.filter.filter_format(
-                f"({self.ATTRIBUTE_MAP[search_by]}=%s)", [user_search_string]
-            )
+            filter = f"({self.ATTRIBUTE_MAP[search_by]}={escape_filter_chars(user_search_string)})"
             size_limit = 1
         else:
             filter = '(objectclass=person)'
 
-        searchParameters = {'search_base': self.LDAP_USER_SEARCH_BASE,
-                            'search_filter': filter,
-                            'attributes': ldap_attrs,
-                            'size_limit': size_limit}
-        logger.debug(f"search params: {searchParameters}")
-        self.conn.search(**searchParameters)
-        users = []
-        for idx, entry in enumerate(self.conn.entries, 1):
-            entry_dict = json.loads(entry.entry_to_json()).get('attributes')
-            logger.debug(f"Entry dict: {entry_dict}")
-            user_dict = self.MAPPING_CALLBACK(self.ATTRIBUTE_MAP, entry_dict)
-            user_dict["source"] = self.search_source
-            users.append(user_dict)
+        users = self.to_users(self.cached_search(filter, size_limit))
         logger.info("LDAP user search for %s found %s results", user_search_string, len(users))
         return users
+
+    def search_many(self, usernames):
+        """Returns the users with the given usernames, searching for up to
+        USERNAME_BATCH_SIZE usernames with one OR filter"""
+        attr = self.ATTRIBUTE_MAP[self.USERNAME_ONLY_ATTR]
+        users = []
+        for i in range(0, len(usernames), USERNAME_BATCH_SIZE):
+            batch = usernames[i:i + USERNAME_BATCH_SIZE]
+            filter = '(|{})'.format(''.join(
+                f"({attr}={escape_filter_chars(username)})" for username in batch))
+            users.extend(self.to_users(self.cached_search(filter, len(batch))))
+        users.sort(key=lambda user: user.get(self.USERNAME_ONLY_ATTR) or '')
+        logger.info("LDAP user search for %s usernames found %s results", len(usernames), len(users))
+        return users
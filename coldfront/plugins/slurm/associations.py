@@ -4,7 +4,12 @@ import os
 import re
 import sys
 
+from django.db.models import Prefetch, prefetch_related_objects
+
+from coldfront.core.allocation.models import Allocation, AllocationUser
+from coldfront.core.attribute_expansion import AttributeExpansionBatch
 from coldfront.core.resource.models import Resource
+import coldfront.core.attribute_cache as attribute_cache
 from coldfront.plugins.slurm.utils import (SLURM_ACCOUNT_ATTRIBUTE_NAME,
                                            SLURM_CLUSTER_ATTRIBUTE_NAME,
                                            SLURM_SPECS_ATTRIBUTE_NAME,
@@ -17,31 +22,160 @@ class SlurmParserError(SlurmError):
     pass
 
 
+def _load_allocations(resources):
+    """Returns dict mapping resource id to its active allocations and an
+    AttributeExpansionBatch with their Slurm attributes.
+
+    Allocations are ordered as Resource.allocation_set orders them and are
+    loaded with their resources, Slurm attributes (expanded in memory) and
+    active users (with usernames) in a constant number of queries.
+    """
+    allocations = {r.id: [] for r in resources}
+    links = Allocation.resources.through.objects.filter(
+        resource__in=resources,
+        allocation__status__name__in=['Active', 'Renewal Requested'],
+    ).select_related('allocation').order_by('allocation__end_date', 'allocation_id')
+    for link in links:
+        allocations[link.resource_id].append(link.allocation)
+
+    instances = [a for lst in allocations.values() for a in lst]
+    prefetch_related_objects(
+        instances,
+        Prefetch('allocationuser_set',
+                 queryset=AllocationUser.objects.filter(
+                     status__name='Active').select_related('user'),
+                 to_attr='active_allocation_users'),
+    )
+    attributes = AttributeExpansionBatch(instances, [
+        SLURM_ACCOUNT_ATTRIBUTE_NAME,
+        SLURM_SPECS_ATTRIBUTE_NAME,
+        SLURM_USER_SPECS_ATTRIBUTE_NAME,
+    ])
+
+    return allocations, attributes
+
+
+def _get_attribute(allocation, name, attributes=None):
+    """Returns attribute of allocation from the AttributeExpansionBatch
+    attributes if given, else from the allocation"""
+    if attributes is not None:
+        return attributes.get_attribute(allocation, name)
+    return allocation.get_attribute(name)
+
+
+def _get_attribute_list(allocation, name, attributes=None):
+    if attributes is not None:
+        return attributes.get_attribute_list(allocation, name)
+    return allocation.get_attribute_list(name)
+
+
+# Matches record lines of sacctmgr dump, e.g.
+# User - 'jane':DefaultAccount='physics':Fairshare=Parent
+_DUMP_RECORD = re.compile(r"^(Cluster|Account|Parent|User) - '([^']+)'(?::(.*))?$")
+
+
+def _split_specs(specs):
+    """Return set of Slurm specs, splitting any colon separated strings"""
+    items = set()
+    for s in specs:
+        items.update(s.split(':'))
+
+    return items
+
+
+class SlurmDumpReader:
+    """Streaming parser for the output of sacctmgr dump.
+
+    Iterating yields one (account, user, specs) tuple per association:
+    (account, None, specs) for Account lines and (account, user, specs) for
+    User lines, where account is the current Parent. A "Parent - 'root'"
+    line yields the root account. Specs is a frozenset. The cluster name
+    and specs are available as name and specs once read_header() has
+    returned or iteration has started. Only one line is held in memory at
+    a time.
+    """
+
+    __slots__ = ('stream', 'name', 'specs', '_pending')
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.name = None
+        self.specs = frozenset()
+        self._pending = None
+
+    def _records(self):
+        for line in self.stream:
+            line = line.strip()
+            if not line or line[0] == '#':
+                continue
+
+            match = _DUMP_RECORD.match(line)
+            if match is None:
+                continue
+
+            kind, name, rest = match.groups()
+            specs = frozenset(rest.split(':')) if rest is not None else frozenset()
+            yield kind, name, specs, line
+
+    def read_header(self):
+        """Read up to and including the Cluster line and return the cluster name"""
+        if self.name is not None:
+            return self.name
+
+        records = self._records()
+        for kind, name, specs, line in records:
+            if kind == 'Cluster':
+                self.name = name
+                self.specs = specs
+                self._pending = records
+                return self.name
+
+            raise(SlurmParserError(
+                'Found {} record before Cluster for line: {}'.format(kind, line)))
+
+        raise(SlurmParserError(
+            'Failed to parse Slurm cluster name. Is this in sacctmgr dump file format?'))
+
+    def __iter__(self):
+        self.read_header()
+        parent = None
+        for kind, name, specs, line in self._pending:
+            if kind == 'User':
+                if not parent:
+                    raise(SlurmParserError(
+                        'Found user record without Parent for line: {}'.format(line)))
+                yield parent, name, specs
+            elif kind == 'Account':
+                yield name, None, specs
+            elif kind == 'Parent':
+                parent = name
+                if parent == 'root':
+                    yield 'root', None, frozenset()
+            else:
+                raise(SlurmParserError(
+                    'Found second Cluster record for line: {}'.format(line)))
+
+
 class SlurmBase:
-    def __init__(self, name, specs=None):
-        if specs is None:
-            specs = []
+    __slots__ = ('name', 'specs')
 
+    def __init__(self, name, specs=None):
         self.name = name
-        self.specs = specs
+        self.specs = set()
+        if specs:
+            self.add_specs(specs)
+
+    def add_specs(self, specs):
+        """Add Slurm Specs, splitting any colon separated strings"""
+        self.specs.update(_split_specs(specs))
 
     def spec_list(self):
         """Return unique list of Slurm Specs"""
-        items = []
-        for s in self.specs:
-            for i in s.split(':'):
-                items.append(i)
-
-        return list(set(items))
+        return list(self.specs)
 
     def format_specs(self):
         """Format unique list of Slurm Specs"""
-        items = []
-        for s in self.specs:
-            for i in s.split(':'):
-                items.append(i)
-
-        return ':'.join([x for x in self.spec_list()])
+        return ':'.join(self.specs)
 
     def _write(self, out, data):
         try:
@@ -53,6 +187,8 @@ class SlurmBase:
 
 
 class SlurmCluster(SlurmBase):
+    __slots__ = ('accounts',)
+
     def __init__(self, name, specs=None):
         super().__init__(name, specs=specs)
         self.accounts = {}
@@ -60,83 +196,76 @@ class SlurmCluster(SlurmBase):
     @staticmethod
     def new_from_stream(stream):
         """Create a new SlurmCluster by parsing the output from sacctmgr dump."""
-        cluster = None
-        parent = None
-        for line in stream:
-            line = line.strip()
-            if re.match("^#", line):
+        reader = SlurmDumpReader(stream)
+        cluster = SlurmCluster(reader.read_header(), reader.specs)
+        for account, user, specs in reader:
+            if user is None:
+                cluster.accounts[account] = SlurmAccount(account, specs=specs)
                 continue
-            elif re.match("^Cluster - '[^']+'", line):
-                parts = line.split(':')
-                name = re.sub(r"^Cluster - ", '', parts[0]).strip("\n'")
-                if len(name) == 0:
-                    raise(SlurmParserError(
-                        'Cluster name not found for line: {}'.format(line)))
-                cluster = SlurmCluster(name)
-                cluster.specs += parts[1:]
-            elif re.match("^Account - '[^']+'", line):
-                account = SlurmAccount.new_from_sacctmgr(line)
-                cluster.accounts[account.name] = account
-            elif re.match("^Parent - '[^']+'", line):
-                parent = re.sub(r"^Parent - ", '', line).strip("\n'")
-                if parent == 'root':
-                    cluster.accounts['root'] = SlurmAccount('root')
-                if not parent:
-                    raise(SlurmParserError(
-                        'Parent name not found for line: {}'.format(line)))
-            elif re.match("^User - '[^']+'", line):
-                user = SlurmUser.new_from_sacctmgr(line)
-                if not parent:
-                    raise(SlurmParserError(
-                        'Found user record without Parent for line: {}'.format(line)))
-                account = cluster.accounts[parent]
-                account.add_user(user)
-                cluster.accounts[parent] = account
 
-        if not cluster or not cluster.name:
-            raise(SlurmParserError(
-                'Failed to parse Slurm cluster name. Is this in sacctmgr dump file format?'))
+            if account not in cluster.accounts:
+                raise(SlurmParserError(
+                    'Found user {} for unknown account {}'.format(user, account)))
+            cluster.accounts[account].add_user(SlurmUser(user, specs=specs))
 
         return cluster
 
+    def associations(self):
+        """Yield (account, user, specs) tuples like SlurmDumpReader"""
+        for name, account in self.accounts.items():
+            yield name, None, frozenset(account.specs)
+        for name, account in self.accounts.items():
+            for uid, user in account.users.items():
+                yield name, uid, frozenset(user.specs)
+
     @staticmethod
     def new_from_resource(resource):
-        """Create a new SlurmCluster from a ColdFront Resource model."""
-        name = resource.get_attribute(SLURM_CLUSTER_ATTRIBUTE_NAME)
-        specs = resource.get_attribute_list(SLURM_SPECS_ATTRIBUTE_NAME)
-        user_specs = resource.get_attribute_list(SLURM_USER_SPECS_ATTRIBUTE_NAME)
-        if not name:
-            raise(SlurmError('Resource {} missing slurm_cluster'.format(resource)))
-
-        cluster = SlurmCluster(name, specs)
-
-        # Process allocations
-        for allocation in resource.allocation_set.filter(status__name__in=['Active', 'Renewal Requested']):
-            cluster.add_allocation(allocation, user_specs=user_specs)
-
-        # Process child resources
-        children = Resource.objects.filter(parent_resource_id=resource.id, resource_type__name='Cluster Partition')
-        for r in children:
-            partition_specs = r.get_attribute_list(SLURM_SPECS_ATTRIBUTE_NAME)
-            partition_user_specs = r.get_attribute_list(SLURM_USER_SPECS_ATTRIBUTE_NAME)
-            for allocation in r.allocation_set.filter(status__name__in=['Active', 'Renewal Requested']):
-                cluster.add_allocation(allocation, specs=partition_specs, user_specs=partition_user_specs)
+        """Create a new SlurmCluster from a ColdFront Resource model.
+
+        Active allocations of the cluster and its partitions are loaded in
+        bulk together with their attributes and active users, so the number
+        of queries does not grow with the number of allocations.
+        """
+        with attribute_cache.attribute_cache():
+            name = resource.get_attribute(SLURM_CLUSTER_ATTRIBUTE_NAME)
+            specs = resource.get_attribute_list(SLURM_SPECS_ATTRIBUTE_NAME)
+            user_specs = resource.get_attribute_list(SLURM_USER_SPECS_ATTRIBUTE_NAME)
+            if not name:
+                raise(SlurmError('Resource {} missing slurm_cluster'.format(resource)))
+
+            cluster = SlurmCluster(name, specs)
+
+            children = list(Resource.objects.filter(parent_resource_id=resource.id, resource_type__name='Cluster Partition'))
+            allocations, attributes = _load_allocations([resource] + children)
+
+            # Process allocations
+            for allocation in allocations[resource.id]:
+                cluster.add_allocation(allocation, user_specs=user_specs,
+                                       attributes=attributes)
+
+            # Process child resources
+            for r in children:
+                partition_specs = r.get_attribute_list(SLURM_SPECS_ATTRIBUTE_NAME)
+                partition_user_specs = r.get_attribute_list(SLURM_USER_SPECS_ATTRIBUTE_NAME)
+                for allocation in allocations[r.id]:
+                    cluster.add_allocation(allocation, specs=partition_specs, user_specs=partition_user_specs,
+                                           attributes=attributes)
 
         return cluster
 
-    def add_allocation(self, allocation, specs=None, user_specs=None):
+    def add_allocation(self, allocation, specs=None, user_specs=None, attributes=None):
         if specs is None:
             specs = []
 
         """Add accounts from a ColdFront Allocation model to SlurmCluster"""
-        name = allocation.get_attribute(SLURM_ACCOUNT_ATTRIBUTE_NAME)
+        name = _get_attribute(allocation, SLURM_ACCOUNT_ATTRIBUTE_NAME, attributes)
         if not name:
             name = 'root'
 
         logger.debug("Adding allocation name=%s specs=%s user_specs=%s", name, specs, user_specs)
         account = self.accounts.get(name, SlurmAccount(name))
-        account.add_allocation(allocation, user_specs=user_specs)
-        account.specs += specs
+        account.add_allocation(allocation, user_specs=user_specs, attributes=attributes)
+        account.add_specs(specs)
         self.accounts[name] = account
 
     def write(self, out):
@@ -163,6 +292,8 @@ class SlurmCluster(SlurmBase):
 
 
 class SlurmAccount(SlurmBase):
+    __slots__ = ('users',)
+
     def __init__(self, name, specs=None):
         super().__init__(name, specs=specs)
         self.users = {}
@@ -171,24 +302,20 @@ class SlurmAccount(SlurmBase):
     def new_from_sacctmgr(line):
         """Create a new SlurmAccount by parsing a line from sacctmgr dump. For
         example: Account - 'physics':Description='physics group':Organization='cas':Fairshare=100"""
-        if not re.match("^Account - '[^']+'", line):
+        match = _DUMP_RECORD.match(line.strip())
+        if not match or match.group(1) != 'Account':
             raise(SlurmParserError(
                 'Invalid format. Must start with "Account" for line: {}'.format(line)))
 
-        parts = line.split(':')
-        name = re.sub(r"^Account - ", '', parts[0]).strip("\n'")
-        if len(name) == 0:
-            raise(SlurmParserError(
-                'Cluster name not found for line: {}'.format(line)))
-
-        return SlurmAccount(name, specs=parts[1:])
+        name, rest = match.group(2, 3)
+        return SlurmAccount(name, specs=rest.split(':') if rest else None)
 
-    def add_allocation(self, allocation, user_specs=None):
+    def add_allocation(self, allocation, user_specs=None, attributes=None):
         """Add users from a ColdFront Allocation model to SlurmAccount"""
         if user_specs is None:
             user_specs = []
 
-        name = allocation.get_attribute(SLURM_ACCOUNT_ATTRIBUTE_NAME)
+        name = _get_attribute(allocation, SLURM_ACCOUNT_ATTRIBUTE_NAME, attributes)
         if not name:
             name = 'root'
 
@@ -196,13 +323,18 @@ class SlurmAccount(SlurmBase):
             raise(SlurmError('Allocation {} slurm_account_name does not match {}'.format(
                 allocation, self.name)))
 
-        self.specs += allocation.get_attribute_list(SLURM_SPECS_ATTRIBUTE_NAME)
+        self.add_specs(_get_attribute_list(allocation, SLURM_SPECS_ATTRIBUTE_NAME, attributes))
+
+        allocation_user_specs = _get_attribute_list(
+            allocation, SLURM_USER_SPECS_ATTRIBUTE_NAME, attributes)
+        allocation_users = getattr(allocation, 'active_allocation_users', None)
+        if allocation_users is None:
+            allocation_users = allocation.allocationuser_set.filter(status__name='Active')
 
-        allocation_user_specs = allocation.get_attribute_list(SLURM_USER_SPECS_ATTRIBUTE_NAME)
-        for u in allocation.allocationuser_set.filter(status__name='Active'):
+        for u in allocation_users:
             user = SlurmUser(u.user.username)
-            user.specs += allocation_user_specs
-            user.specs += user_specs
+            user.add_specs(allocation_user_specs)
+            user.add_specs(user_specs)
             self.add_user(user)
 
     def add_user(self, user):
@@ -210,8 +342,7 @@ class SlurmAccount(SlurmBase):
             self.users[user.name] = user
 
         rec = self.users[user.name]
-        rec.specs += user.specs
-        self.users[user.name] = rec
+        rec.specs.update(user.specs)
 
     def write(self, out):
         if self.name != 'root':
@@ -227,21 +358,19 @@ class SlurmAccount(SlurmBase):
 
 
 class SlurmUser(SlurmBase):
+    __slots__ = ()
 
     @staticmethod
     def new_from_sacctmgr(line):
         """Create a new SlurmUser by parsing a line from sacctmgr dump. For
         example: User - 'jane':DefaultAccount='physics':Fairshare=Parent:QOS='general-compute'"""
-        if not re.match("^User - '[^']+'", line):
+        match = _DUMP_RECORD.match(line.strip())
+        if not match or match.group(1) != 'User':
             raise(SlurmParserError(
                 'Invalid format. Must start with "User" for line: {}'.format(line)))
 
-        parts = line.split(':')
-        name = re.sub(r"^User - ", '', parts[0]).strip("\n'")
-        if len(name) == 0:
-            raise(SlurmParserError('User name not found for line: {}'.format(line)))
-
-        return SlurmUser(name, specs=parts[1:])
+        name, rest = match.group(2, 3)
+        return SlurmUser(name, specs=rest.split(':') if rest else None)
 
     def write(self, out):
         self._write(out, "User - '{}':{}\n".format(
@@ -1,3 +1,6 @@
+import contextlib
+import datetime
+import json
 import logging
 import os
 import sys
@@ -5,21 +8,26 @@ import tempfile
 
 from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+from django.utils import timezone
 
+from coldfront.core.allocation.models import (Allocation,
+                                              AllocationAttribute,
+                                              AllocationUser)
 from coldfront.core.resource.models import ResourceAttribute
 from coldfront.core.utils.common import import_from_settings
-from coldfront.plugins.slurm.associations import SlurmCluster
+from coldfront.plugins.slurm.associations import SlurmCluster, SlurmDumpReader
 from coldfront.plugins.slurm.utils import (SLURM_ACCOUNT_ATTRIBUTE_NAME,
                                            SLURM_CLUSTER_ATTRIBUTE_NAME,
                                            SLURM_USER_SPECS_ATTRIBUTE_NAME,
-                                           SlurmError, slurm_remove_qos,
-                                           slurm_dump_cluster, slurm_remove_account,
-                                           slurm_remove_assoc)
+                                           SlurmBatch, SlurmError,
+                                           slurm_dump_cluster)
 
 SLURM_IGNORE_USERS = import_from_settings('SLURM_IGNORE_USERS', [])
 SLURM_IGNORE_ACCOUNTS = import_from_settings('SLURM_IGNORE_ACCOUNTS', [])
 SLURM_IGNORE_CLUSTERS = import_from_settings('SLURM_IGNORE_CLUSTERS', [])
 SLURM_NOOP = import_from_settings('SLURM_NOOP', False)
+SLURM_CHECK_STATE_DIR = import_from_settings('SLURM_CHECK_STATE_DIR', '')
 
 logger = logging.getLogger(__name__)
 
@@ -40,6 +48,10 @@ class Command(BaseCommand):
         parser.add_argument("-a", "--account", help="Check specific account")
         parser.add_argument(
             "-x", "--header", help="Include header in output", action="store_true")
+        parser.add_argument(
+            "--incremental", help="Only check accounts of allocations changed since the last run, using the saved snapshot instead of sacctmgr dump. Requires --cluster", action="store_true")
+        parser.add_argument(
+            "--state-dir", help="Directory holding snapshots for incremental checks. Defaults to SLURM_CHECK_STATE_DIR")
 
     def write(self, data):
         try:
@@ -84,14 +96,7 @@ class Command(BaseCommand):
             return
 
         if self.sync:
-            try:
-                slurm_remove_assoc(user, cluster, account, noop=self.noop)
-            except SlurmError as e:
-                logger.error(
-                    "Failed removing Slurm association user %s account %s cluster %s: %s", user, account, cluster, e)
-            else:
-                logger.error(
-                    "Removed Slurm association user %s account %s cluster %s successfully", user, account, cluster)
+            self.batch.remove_assoc(user, cluster, account)
 
         row = [
             user,
@@ -107,14 +112,7 @@ class Command(BaseCommand):
             return
 
         if self.sync:
-            try:
-                slurm_remove_account(cluster, account, noop=self.noop)
-            except SlurmError as e:
-                logger.error(
-                    "Failed removing Slurm account %s cluster %s: %s", account, cluster, e)
-            else:
-                logger.error(
-                    "Removed Slurm account %s cluster %s successfully", account, cluster)
+            self.batch.remove_account(cluster, account)
 
         row = [
             '',
@@ -130,15 +128,7 @@ class Command(BaseCommand):
             return
 
         if self.sync:
-            try:
-                slurm_remove_qos(user, cluster, account, qos, noop=self.noop)
-                pass
-            except SlurmError as e:
-                logger.error(
-                    "Failed removing Slurm qos %s for user %s account %s cluster %s: %s", qos, user, account, cluster, e)
-            else:
-                logger.error(
-                    "Removed Slurm qos %s for user %s account %s cluster %s successfully", qos, user, account, cluster)
+            self.batch.remove_qos(user, cluster, account, qos)
 
         row = [
             user,
@@ -166,11 +156,11 @@ class Command(BaseCommand):
 
         return []
                     
-    def _diff_qos(self, account_name, cluster_name, user_a, user_b):
-        logger.debug("diff qos: cluster=%s account=%s uid=%s a=%s b=%s", cluster_name, account_name, user_a.name, user_a.spec_list(), user_b.spec_list())
+    def _diff_qos(self, account_name, cluster_name, uid, specs, user_b):
+        logger.debug("diff qos: cluster=%s account=%s uid=%s a=%s b=%s", cluster_name, account_name, uid, specs, user_b.spec_list())
 
         specs_a = []
-        for s in user_a.spec_list():
+        for s in specs:
             if s.startswith('QOS'):
                 specs_a += self._parse_qos(s)
 
@@ -183,51 +173,260 @@ class Command(BaseCommand):
         specs_set_b = set(specs_b)
 
         diff = specs_set_a.difference(specs_set_b)
-        logger.debug("diff qos: cluster=%s account=%s uid=%s a=%s b=%s diff=%s", cluster_name, account_name, user_a.name, specs_set_a, specs_set_b, diff)
+        logger.debug("diff qos: cluster=%s account=%s uid=%s a=%s b=%s diff=%s", cluster_name, account_name, uid, specs_set_a, specs_set_b, diff)
             
         if len(diff) > 0:
-            self.remove_qos(user_a.name, account_name, cluster_name, 'QOS-='+','.join([x for x in list(diff)]))
-
-    def _diff(self, cluster_a, cluster_b):
-        for name, account in cluster_a.accounts.items():
+            self.remove_qos(uid, account_name, cluster_name, 'QOS-='+','.join([x for x in list(diff)]))
+
+    def _diff(self, cluster_name, associations, cluster_b):
+        """Report associations in Slurm that are not in ColdFront
+
+        Associations is an iterable of (account, user, specs) tuples as
+        yielded by SlurmDumpReader or SlurmCluster.associations(). Users are
+        checked as they are read, so a Slurm dump can be checked while it is
+        parsed. Only per account counts and the users of the current account
+        are kept, so memory is bounded by the largest account. sacctmgr dump
+        lists the users of an account in a single Parent block, so a user
+        listed twice under an account is checked once.
+        """
+        # account -> [number of users, number of users removed]
+        counts = {}
+        block = None
+        block_users = set()
+        for name, uid, specs in associations:
             if name == 'root':
                 continue
 
-            if name in cluster_b.accounts:
-                total = 0
-                for uid, user in account.users.items():
-                    if uid == 'root':
-                        continue
-                    if uid not in cluster_b.accounts[name].users:
-                        self.remove_user(uid, name, cluster_a.name)
-                        total += 1
-                    else:
-                        self._diff_qos(name, cluster_a.name, user, cluster_b.accounts[name].users[uid])
-
-                if total == len(account.users):
-                    self.remove_account(name, cluster_a.name)
+            count = counts.setdefault(name, [0, 0])
+            if uid is None:
+                continue
+
+            if name != block:
+                block = name
+                block_users = set()
+            if uid in block_users:
+                continue
+            block_users.add(uid)
+            count[0] += 1
+
+            if name not in cluster_b.accounts:
+                self.remove_user(uid, name, cluster_name)
+            elif uid == 'root':
+                continue
+            elif uid not in cluster_b.accounts[name].users:
+                self.remove_user(uid, name, cluster_name)
+                count[1] += 1
             else:
-                for uid, user in account.users.items():
-                    self.remove_user(uid, name, cluster_a.name)
+                self._diff_qos(name, cluster_name, uid, specs, cluster_b.accounts[name].users[uid])
 
-                self.remove_account(name, cluster_a.name)
+        for name, (total, removed) in counts.items():
+            if name not in cluster_b.accounts or removed == total:
+                self.remove_account(name, cluster_name)
 
-    def check_consistency(self, slurm_cluster, coldfront_cluster):
+    def check_consistency(self, cluster_name, associations, coldfront_cluster):
         # Check for accounts in Slurm NOT in ColdFront
-        self._diff(slurm_cluster, coldfront_cluster)
+        self._diff(cluster_name, associations, coldfront_cluster)
+
+        if self.sync:
+            self.apply_changes()
+
+    def apply_changes(self):
+        """Apply the removals collected by _diff in batched sacctmgr calls"""
+        for op in self.batch.execute():
+            if op.action == 'remove_assoc':
+                desc = "association user {} account {} cluster {}".format(op.user, op.account, op.cluster)
+            elif op.action == 'remove_qos':
+                desc = "qos {} for user {} account {} cluster {}".format(op.qos, op.user, op.account, op.cluster)
+            else:
+                desc = "account {} cluster {}".format(op.account, op.cluster)
+
+            if op.error:
+                logger.error("Failed removing Slurm %s: %s", desc, op.error)
+            else:
+                logger.error("Removed Slurm %s successfully", desc)
+
+    def _snapshot_paths(self, cluster):
+        return (os.path.join(self.state_dir, '{}.cfg'.format(cluster)),
+                os.path.join(self.state_dir, '{}.json'.format(cluster)))
+
+    def _cluster_allocations(self, resource):
+        """Return the ids of the allocations on the cluster resource"""
+        on_cluster = Q(resources=resource) | Q(resources__parent_resource=resource)
+        return set(Allocation.objects.filter(on_cluster).values_list('pk', flat=True))
+
+    def _snapshot_state(self, resource):
+        """Return the time and allocations on the cluster to save with a new snapshot"""
+        return {
+            'generated': timezone.now(),
+            'allocations': self._cluster_allocations(resource),
+        }
+
+    def _load_snapshot_state(self, cluster):
+        """Return the state saved with the snapshot or None if there is none"""
+        cfg, meta = self._snapshot_paths(cluster)
+        if not os.path.exists(cfg) or not os.path.exists(meta):
+            return None
+
+        with open(meta) as fh:
+            state = json.load(fh)
+        if 'allocations' not in state:
+            # Saved by an older version
+            return None
+
+        return {
+            'generated': datetime.datetime.fromisoformat(state['generated']),
+            'allocations': set(state['allocations']),
+        }
+
+    def _save_snapshot_state(self, cluster, state):
+        _, meta = self._snapshot_paths(cluster)
+        with open(meta + '.tmp', 'w') as fh:
+            json.dump({
+                'generated': state['generated'].isoformat(),
+                'allocations': sorted(state['allocations']),
+            }, fh)
+        os.replace(meta + '.tmp', meta)
+
+    def _save_snapshot(self, coldfront_cluster, state):
+        if not os.path.isdir(self.state_dir):
+            os.makedirs(self.state_dir, 0o0700)
+
+        cfg, _ = self._snapshot_paths(coldfront_cluster.name)
+        with open(cfg + '.tmp', 'w') as fh:
+            coldfront_cluster.write(fh)
+        os.replace(cfg + '.tmp', cfg)
+        self._save_snapshot_state(coldfront_cluster.name, state)
+
+    def _save_dump(self, cluster, dump, state):
+        """Save the copy of the sacctmgr dump made by _copy_dump as the snapshot"""
+        cfg, _ = self._snapshot_paths(cluster)
+        dump.flush()
+        os.replace(dump.name, cfg)
+        self._save_snapshot_state(cluster, state)
+
+    @contextlib.contextmanager
+    def _copy_dump(self, stream):
+        """Yield the lines of stream and a temporary file they are copied to as they are read
+
+        Without a state directory nothing is copied and None is yielded for
+        the file. The copy is removed on exit unless _save_dump moved it.
+        """
+        if not self.state_dir:
+            yield stream, None
+            return
+
+        if not os.path.isdir(self.state_dir):
+            os.makedirs(self.state_dir, 0o0700)
 
-    def _cluster_from_dump(self, cluster):
-        slurm_cluster = None
-        with tempfile.TemporaryDirectory() as tmpdir:
-            fname = os.path.join(tmpdir, 'cluster.cfg')
+        def lines(dump):
+            for line in stream:
+                dump.write(line)
+                yield line
+
+        with tempfile.NamedTemporaryFile('w', dir=self.state_dir, suffix='.tmp', delete=False) as dump:
             try:
-                slurm_dump_cluster(cluster, fname)
-                with open(fname) as fh:
-                    slurm_cluster = SlurmCluster.new_from_stream(fh)
+                yield lines(dump), dump
+            finally:
+                if os.path.exists(dump.name):
+                    os.unlink(dump.name)
+
+    def _changed_accounts(self, resource, state):
+        """Return names of Slurm accounts whose allocations changed since the snapshot
+
+        Uses the history of Allocation, AllocationUser and AllocationAttribute
+        for the allocations on the cluster now or when the snapshot was saved.
+        Changes to the resources of an allocation leave no history, so
+        allocations moved onto or off the cluster, or deleted, are found by
+        comparing with the allocations saved with the snapshot. Every account
+        name an affected allocation has ever used is returned so renamed
+        accounts are checked too. Allocations without an account name map to
+        'root'.
+        """
+        since = state['generated']
+        cluster_allocations = self._cluster_allocations(resource)
+
+        changed = set(Allocation.history.filter(
+            history_date__gte=since).values_list('id', flat=True))
+        changed.update(AllocationUser.history.filter(
+            history_date__gte=since).values_list('allocation_id', flat=True))
+        changed.update(AllocationAttribute.history.filter(
+            history_date__gte=since).values_list('allocation_id', flat=True))
+        changed &= cluster_allocations | state['allocations']
+        changed |= cluster_allocations ^ state['allocations']
+
+        if not changed:
+            return set()
+
+        accounts = set(AllocationAttribute.history.filter(
+            allocation_id__in=changed,
+            allocation_attribute_type__name=SLURM_ACCOUNT_ATTRIBUTE_NAME,
+        ).values_list('value', flat=True))
+
+        with_name = set(AllocationAttribute.objects.filter(
+            allocation_id__in=changed,
+            allocation_attribute_type__name=SLURM_ACCOUNT_ATTRIBUTE_NAME,
+        ).values_list('allocation_id', flat=True))
+        if changed - with_name:
+            accounts.add('root')
+
+        return accounts
+
+    def check_incremental(self, resource, cluster_name):
+        """Check only accounts changed since the last snapshot
+
+        The snapshot of the ColdFront cluster saved by the previous run stands
+        in for the Slurm state, so no sacctmgr dump is needed. Without a
+        snapshot a full check is run against sacctmgr dump instead, and unless
+        the run syncs the whole cluster the dump is saved as the snapshot.
+        """
+        previous_state = self._load_snapshot_state(cluster_name)
+        state = self._snapshot_state(resource)
+
+        if previous_state is None:
+            logger.warn("No snapshot found for cluster %s. Running full check", cluster_name)
+            try:
+                with self._open_input(cluster=cluster_name) as fh, self._copy_dump(fh) as (lines, dump):
+                    reader = SlurmDumpReader(lines)
+                    reader.read_header()
+                    coldfront_cluster = SlurmCluster.new_from_resource(resource)
+                    self.check_consistency(cluster_name, reader, coldfront_cluster)
+                    if not self._synced_all():
+                        self._save_dump(cluster_name, dump, state)
             except SlurmError as e:
-                logger.error("Failed to dump Slurm cluster %s: %s", cluster, e)
+                logger.error("Failed to import existing Slurm associations: %s", e)
+                sys.exit(1)
 
-        return slurm_cluster
+            return coldfront_cluster, state
+
+        accounts = self._changed_accounts(resource, previous_state)
+        logger.info("Accounts changed since %s: %s", previous_state['generated'], ', '.join(sorted(accounts)))
+
+        if not accounts:
+            return None, state
+
+        coldfront_cluster = SlurmCluster.new_from_resource(resource)
+
+        cfg, _ = self._snapshot_paths(cluster_name)
+        with open(cfg) as fh:
+            previous = (r for r in SlurmDumpReader(fh) if r[0] in accounts)
+            self.check_consistency(cluster_name, previous, coldfront_cluster)
+
+        return coldfront_cluster, state
+
+    @contextlib.contextmanager
+    def _open_input(self, cluster=None, path=None):
+        """Yield a file with sacctmgr dump output of cluster, read from path or stdin"""
+        if cluster:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                fname = os.path.join(tmpdir, 'cluster.cfg')
+                slurm_dump_cluster(cluster, fname)
+                with open(fname) as fh:
+                    yield fh
+        elif path:
+            with open(path) as fh:
+                yield fh
+        else:
+            yield sys.stdin
 
     def handle(self, *args, **options):
         verbosity = int(options['verbosity'])
@@ -251,31 +450,64 @@ class Command(BaseCommand):
             self.noop = True
             logger.warn("NOOP enabled")
 
-        if options['cluster']:
-            slurm_cluster = self._cluster_from_dump(options['cluster'])
-        elif options['input']:
-            with open(options['input']) as fh:
-                slurm_cluster = SlurmCluster.new_from_stream(fh)
-        else:
-            slurm_cluster = SlurmCluster.new_from_stream(sys.stdin)
+        self.batch = SlurmBatch(noop=self.noop)
+
+        self.state_dir = options['state_dir'] or SLURM_CHECK_STATE_DIR
+        if options['incremental']:
+            if not options['cluster']:
+                raise CommandError("--incremental requires --cluster")
+            if not self.state_dir:
+                raise CommandError("--incremental requires --state-dir or SLURM_CHECK_STATE_DIR")
 
-        if not slurm_cluster:
-            logger.error("Failed to import existing Slurm associations")
+            self.run_incremental(options)
+            return
+
+        try:
+            with self._open_input(cluster=options['cluster'], path=options['input']) as fh:
+                with self._copy_dump(fh) as (lines, dump):
+                    self.check_dump(SlurmDumpReader(lines), options, dump=dump)
+        except SlurmError as e:
+            logger.error("Failed to import existing Slurm associations: %s", e)
             sys.exit(1)
 
-        if slurm_cluster.name in SLURM_IGNORE_CLUSTERS:
+    def check_dump(self, reader, options, dump=None):
+        """Check the associations of a sacctmgr dump while it is read
+
+        If the run synced the whole cluster the associations generated from
+        ColdFront are saved as the snapshot for incremental checks, otherwise
+        dump, the copy of the sacctmgr dump, is saved.
+        """
+        cluster_name = reader.read_header()
+        if cluster_name in SLURM_IGNORE_CLUSTERS:
             logger.warn("Ignoring cluster %s. Nothing to do.",
-                        slurm_cluster.name)
+                        cluster_name)
             sys.exit(0)
 
         try:
             resource = ResourceAttribute.objects.get(
-                resource_attribute_type__name=SLURM_CLUSTER_ATTRIBUTE_NAME, value=slurm_cluster.name).resource
+                resource_attribute_type__name=SLURM_CLUSTER_ATTRIBUTE_NAME, value=cluster_name).resource
         except ResourceAttribute.DoesNotExist:
             logger.error("No Slurm '%s' cluster resource found in ColdFront using '%s' attribute",
-                         slurm_cluster.name, SLURM_CLUSTER_ATTRIBUTE_NAME)
+                         cluster_name, SLURM_CLUSTER_ATTRIBUTE_NAME)
             sys.exit(1)
 
+        self._write_header(options)
+
+        state = self._snapshot_state(resource) if self.state_dir else None
+        coldfront_cluster = SlurmCluster.new_from_resource(resource)
+
+        self.check_consistency(cluster_name, reader, coldfront_cluster)
+
+        if self.state_dir and self._synced_all():
+            self._save_snapshot(coldfront_cluster, state)
+        elif dump is not None:
+            self._save_dump(cluster_name, dump, state)
+
+    def _synced_all(self):
+        """Return True if this run removed every stale association from Slurm"""
+        return self.sync and not self.noop and not self.filter_user and not self.filter_account
+
+    def _write_header(self, options):
         header = [
             'username',
             'account',
@@ -290,6 +522,29 @@ class Command(BaseCommand):
         self.filter_user = options['username']
         self.filter_account = options['account']
 
-        coldfront_cluster = SlurmCluster.new_from_resource(resource)
+    def run_incremental(self, options):
+        cluster_name = options['cluster']
+        if cluster_name in SLURM_IGNORE_CLUSTERS:
+            logger.warn("Ignoring cluster %s. Nothing to do.", cluster_name)
+            sys.exit(0)
+
+        try:
+            resource = ResourceAttribute.objects.get(
+                resource_attribute_type__name=SLURM_CLUSTER_ATTRIBUTE_NAME, value=cluster_name).resource
+        except ResourceAttribute.DoesNotExist:
+            logger.error("No Slurm '%s' cluster resource found in ColdFront using '%s' attribute",
+                         cluster_name, SLURM_CLUSTER_ATTRIBUTE_NAME)
+            sys.exit(1)
+
+        self._write_header(options)
+
+        coldfront_cluster, state = self.check_incremental(resource, cluster_name)
+        if not self._synced_all():
+            return
+
+        if coldfront_cluster is None:
+            # Nothing changed, only move the snapshot time forward
+            self._save_snapshot_state(cluster_name, state)
+            return
 
-        self.check_consistency(slurm_cluster, coldfront_cluster)
+        self._save_snapshot(coldfront_cluster, state)
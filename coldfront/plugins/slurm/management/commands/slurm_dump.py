@@ -3,6 +3,7 @@ import os
 
 from django.core.management.base import BaseCommand, CommandError
 
+from coldfront.core.attribute_cache import attribute_cache
 from coldfront.core.resource.models import ResourceAttribute
 from coldfront.plugins.slurm.utils import SLURM_CLUSTER_ATTRIBUTE_NAME
 from coldfront.plugins.slurm.associations import SlurmCluster
@@ -43,7 +44,8 @@ class Command(BaseCommand):
             if not attr.resource.is_available:
                 continue
 
-            cluster = SlurmCluster.new_from_resource(attr.resource)
+            with attribute_cache():
+                cluster = SlurmCluster.new_from_resource(attr.resource)
             if not out_dir:
                 cluster.write(self.stdout)
                 continue
@@ -0,0 +1,65 @@
+"""Benchmark parsing of large sacctmgr dump files.
+
+Compares building a full SlurmCluster with new_from_stream() against
+iterating the dump with SlurmDumpReader, reporting wall time and peak
+memory. Not collected by the test runner; run it directly:
+
+    DJANGO_SETTINGS_MODULE=coldfront.config.settings \\
+        python coldfront/plugins/slurm/tests/bench_parser.py [associations]
+"""
+import io
+import sys
+import time
+import tracemalloc
+
+import django
+
+django.setup()
+
+from coldfront.plugins.slurm.associations import SlurmCluster, SlurmDumpReader  # noqa: E402
+
+USERS_PER_ACCOUNT = 50
+
+
+def synthetic_dump(associations):
+    """Returns a dump with the given number of user associations"""
+    out = io.StringIO()
+    out.write("Cluster - 'bench':Fairshare=1:QOS='normal'\n")
+    out.write("Parent - 'root'\n")
+    out.write("User - 'root':DefaultAccount='root':AdminLevel='Administrator':Fairshare=1\n")
+    accounts = max(1, associations // USERS_PER_ACCOUNT)
+    for a in range(accounts):
+        out.write("Account - 'acct{0}':Description='Lab {0}':Organization='org':Fairshare=100\n".format(a))
+    for a in range(accounts):
+        out.write("Parent - 'acct{}'\n".format(a))
+        for u in range(USERS_PER_ACCOUNT):
+            out.write("User - 'user{}':DefaultAccount='acct{}':Fairshare=parent:QOS='normal'\n".format(u, a))
+    return out.getvalue()
+
+
+def measure(label, func, text):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(io.StringIO(text))
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print('{:<28} {:>8.2f}s {:>10.1f} MiB  ({} records)'.format(
+        label, elapsed, peak / 2**20, result))
+
+
+def build_cluster(stream):
+    cluster = SlurmCluster.new_from_stream(stream)
+    return sum(len(a.users) + 1 for a in cluster.accounts.values())
+
+
+def stream_records(stream):
+    return sum(1 for _ in SlurmDumpReader(stream))
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    text = synthetic_dump(count)
+    print('dump: {:.1f} MiB, {} associations'.format(len(text) / 2**20, count))
+    measure('SlurmCluster.new_from_stream', build_cluster, text)
+    measure('SlurmDumpReader', stream_records, text)
@@ -1,11 +1,36 @@
+import json
+import os
+import tempfile
 from io import StringIO
 
 from django.core.management import call_command
-from django.test import TestCase
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 
-from coldfront.core.resource.models import Resource
-from coldfront.plugins.slurm.associations import SlurmCluster
-from coldfront.plugins.slurm.utils import SLURM_CLUSTER_ATTRIBUTE_NAME
+from coldfront.core.resource.models import (AttributeType, Resource,
+                                            ResourceAttribute,
+                                            ResourceAttributeType)
+from coldfront.core.test_helpers.factories import (
+    AAttributeTypeFactory,
+    AllocationAttributeFactory,
+    AllocationAttributeTypeFactory,
+    AllocationFactory,
+    AllocationUserFactory,
+    ProjectFactory,
+    ResourceFactory,
+    ResourceTypeFactory,
+    UserFactory,
+)
+from coldfront.plugins.slurm.associations import (SlurmCluster,
+                                                  SlurmDumpReader,
+                                                  SlurmParserError,
+                                                  SlurmUser)
+from coldfront.plugins.slurm.management.commands import slurm_check
+from coldfront.plugins.slurm.utils import (SLURM_ACCOUNT_ATTRIBUTE_NAME,
+                                           SLURM_CLUSTER_ATTRIBUTE_NAME,
+                                           SLURM_USER_SPECS_ATTRIBUTE_NAME)
 
 
 class AssociationTest(TestCase):
@@ -75,3 +100,214 @@ User - 'larry':DefaultAccount='physics':Fairshare=parent
         self.assertEqual(len(cluster2.accounts['physics'].users), 3)
         for u in ['jane', 'john', 'larry']:
             self.assertIn(u, cluster2.accounts['physics'].users)
+
+
+class BulkAssociationTest(TestCase):
+    """tests for bulk loading of allocations in SlurmCluster.new_from_resource"""
+
+    @classmethod
+    def setUpTestData(cls):
+        text = AttributeType.objects.create(name='Text')
+        cls.cluster_attr = ResourceAttributeType.objects.create(
+            attribute_type=text, name=SLURM_CLUSTER_ATTRIBUTE_NAME)
+        cls.account_attr = AllocationAttributeTypeFactory(
+            name=SLURM_ACCOUNT_ATTRIBUTE_NAME,
+            attribute_type=AAttributeTypeFactory(name='Text'))
+        cls.specs_attr = AllocationAttributeTypeFactory(
+            name=SLURM_USER_SPECS_ATTRIBUTE_NAME,
+            attribute_type=AAttributeTypeFactory(name='Text'))
+        cls.resource = ResourceFactory(
+            name='bulk-hpc', resource_type=ResourceTypeFactory(name='Cluster'))
+        ResourceAttribute.objects.create(
+            resource_attribute_type=cls.cluster_attr, resource=cls.resource,
+            value='bulk')
+
+    def _add_allocations(self, count):
+        start = self.resource.allocation_set.count()
+        for i in range(start, start + count):
+            allocation = AllocationFactory(
+                project=ProjectFactory(title='bulk_lab{}'.format(i)))
+            allocation.resources.add(self.resource)
+            AllocationAttributeFactory(
+                allocation=allocation, allocation_attribute_type=self.account_attr,
+                value='acct{}'.format(allocation.pk))
+            AllocationAttributeFactory(
+                allocation=allocation, allocation_attribute_type=self.specs_attr,
+                value='Fairshare=parent')
+            for j in range(3):
+                AllocationUserFactory(
+                    allocation=allocation,
+                    user=UserFactory(username='u{}-{}'.format(allocation.pk, j)))
+
+    def _count_queries(self):
+        with CaptureQueriesContext(connection) as ctx:
+            SlurmCluster.new_from_resource(self.resource)
+        return len(ctx.captured_queries)
+
+    def test_query_count_is_constant(self):
+        self._add_allocations(2)
+        small = self._count_queries()
+        self._add_allocations(5)
+        self.assertEqual(self._count_queries(), small)
+
+    def test_matches_per_allocation_build(self):
+        self._add_allocations(3)
+        bulk = SlurmCluster.new_from_resource(self.resource)
+
+        expected = SlurmCluster('bulk')
+        for allocation in self.resource.allocation_set.filter(
+                status__name__in=['Active', 'Renewal Requested']):
+            expected.add_allocation(allocation, user_specs=[])
+
+        out_bulk = StringIO()
+        bulk.write(out_bulk)
+        out_expected = StringIO()
+        expected.write(out_expected)
+        self.assertEqual(out_bulk.getvalue(), out_expected.getvalue())
+        self.assertEqual(len(bulk.accounts), 3)
+
+    def test_incremental_check_only_changed_accounts(self):
+        self._add_allocations(2)
+        first, second = self.resource.allocation_set.order_by('pk')
+
+        snapshot = SlurmCluster.new_from_resource(self.resource)
+        # Stale user in an account with no ColdFront changes is not checked
+        snapshot.accounts['acct{}'.format(second.pk)].add_user(SlurmUser('stale'))
+
+        with tempfile.TemporaryDirectory() as state_dir:
+            with open(os.path.join(state_dir, 'bulk.cfg'), 'w') as fh:
+                snapshot.write(fh)
+            with open(os.path.join(state_dir, 'bulk.json'), 'w') as fh:
+                json.dump({'generated': timezone.now().isoformat(),
+                           'allocations': [first.pk, second.pk]}, fh)
+
+            first.allocationuser_set.get(user__username='u{}-0'.format(first.pk)).delete()
+
+            out = StringIO()
+            call_command(slurm_check.Command(), '--incremental', '-c', 'bulk',
+                         '--state-dir', state_dir, stdout=out)
+
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines, ['\t'.join(
+            ['u{}-0'.format(first.pk), 'acct{}'.format(first.pk), 'bulk', 'Remove'])])
+
+    def test_incremental_check_removed_resource(self):
+        self._add_allocations(2)
+        first, second = self.resource.allocation_set.order_by('pk')
+
+        with tempfile.TemporaryDirectory() as state_dir:
+            with open(os.path.join(state_dir, 'bulk.cfg'), 'w') as fh:
+                SlurmCluster.new_from_resource(self.resource).write(fh)
+            with open(os.path.join(state_dir, 'bulk.json'), 'w') as fh:
+                json.dump({'generated': timezone.now().isoformat(),
+                           'allocations': [first.pk, second.pk]}, fh)
+
+            # Removing a resource leaves no allocation history
+            second.resources.remove(self.resource)
+
+            out = StringIO()
+            call_command(slurm_check.Command(), '--incremental', '-c', 'bulk',
+                         '--state-dir', state_dir, stdout=out)
+
+        account = 'acct{}'.format(second.pk)
+        self.assertEqual(sorted(out.getvalue().splitlines()), sorted(
+            ['\t'.join(['u{}-{}'.format(second.pk, i), account, 'bulk', 'Remove']) for i in range(3)] +
+            ['\t'.join(['', account, 'bulk', 'Remove'])]))
+
+    def test_check_without_sync_saves_dump(self):
+        self._add_allocations(2)
+        first, second = self.resource.allocation_set.order_by('pk')
+
+        slurm = SlurmCluster.new_from_resource(self.resource)
+        slurm.accounts['acct{}'.format(second.pk)].add_user(SlurmUser('stale'))
+        dump = StringIO()
+        slurm.write(dump)
+
+        with tempfile.TemporaryDirectory() as state_dir:
+            dump_file = os.path.join(state_dir, 'dump.cfg')
+            with open(dump_file, 'w') as fh:
+                fh.write(dump.getvalue())
+
+            call_command(slurm_check.Command(), '-i', dump_file,
+                         '--state-dir', state_dir, stdout=StringIO())
+
+            with open(os.path.join(state_dir, 'bulk.cfg')) as fh:
+                self.assertEqual(fh.read(), dump.getvalue())
+            self.assertTrue(os.path.exists(os.path.join(state_dir, 'bulk.json')))
+            self.assertEqual(sorted(os.listdir(state_dir)), ['bulk.cfg', 'bulk.json', 'dump.cfg'])
+
+            second.allocationuser_set.get(user__username='u{}-0'.format(second.pk)).delete()
+
+            out = StringIO()
+            call_command(slurm_check.Command(), '--incremental', '-c', 'bulk',
+                         '--state-dir', state_dir, stdout=out)
+
+        # The stale user was not removed, so the snapshot still has it
+        self.assertEqual(sorted(out.getvalue().splitlines()), sorted([
+            '\t'.join(['u{}-0'.format(second.pk), 'acct{}'.format(second.pk), 'bulk', 'Remove']),
+            '\t'.join(['stale', 'acct{}'.format(second.pk), 'bulk', 'Remove']),
+        ]))
+
+    def test_duplicate_users_in_block(self):
+        self._add_allocations(2)
+        first, second = self.resource.allocation_set.order_by('pk')
+
+        slurm = SlurmCluster.new_from_resource(self.resource)
+        dump = StringIO()
+        slurm.write(dump)
+        # A stale user listed twice in the last Parent block of the dump
+        dump.write("User - 'stale'\n")
+        dump.write("User - 'stale'\n")
+        dump.write("User - 'u{}-0':Fairshare=parent\n".format(second.pk))
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dump_file = os.path.join(tmpdir, 'dump.cfg')
+            with open(dump_file, 'w') as fh:
+                fh.write(dump.getvalue())
+
+            out = StringIO()
+            call_command(slurm_check.Command(), '-i', dump_file, stdout=out)
+
+        self.assertEqual(out.getvalue().splitlines(), ['\t'.join(
+            ['stale', 'acct{}'.format(second.pk), 'bulk', 'Remove'])])
+
+
+class DumpReaderTest(SimpleTestCase):
+    """tests for streaming parsing of sacctmgr dump output"""
+
+    DUMP = """# comment
+Cluster - 'alpha':DefaultQOS='general-compute':Fairshare=1
+Parent - 'root'
+User - 'root':DefaultAccount='root':AdminLevel='Administrator':Fairshare=1
+Account - 'physics':Description='physics':Fairshare=100
+Parent - 'physics'
+User - 'jane':DefaultAccount='physics':Fairshare=parent:QOS='debug'
+User - 'john'
+"""
+
+    def test_records(self):
+        reader = SlurmDumpReader(StringIO(self.DUMP))
+        self.assertEqual(reader.read_header(), 'alpha')
+        self.assertEqual(reader.specs, {"DefaultQOS='general-compute'", 'Fairshare=1'})
+        self.assertEqual(list(reader), [
+            ('root', None, frozenset()),
+            ('root', 'root', frozenset(["DefaultAccount='root'", "AdminLevel='Administrator'", 'Fairshare=1'])),
+            ('physics', None, frozenset(["Description='physics'", 'Fairshare=100'])),
+            ('physics', 'jane', frozenset(["DefaultAccount='physics'", 'Fairshare=parent', "QOS='debug'"])),
+            ('physics', 'john', frozenset()),
+        ])
+
+    def test_cluster_records_match_reader(self):
+        cluster = SlurmCluster.new_from_stream(StringIO(self.DUMP))
+        self.assertEqual(sorted(cluster.associations(), key=repr),
+                         sorted(SlurmDumpReader(StringIO(self.DUMP)), key=repr))
+        self.assertEqual(cluster.accounts['physics'].users['jane'].spec_list().count('Fairshare=parent'), 1)
+
+    def test_user_without_parent(self):
+        dump = StringIO("Cluster - 'alpha'\nUser - 'jane'\n")
+        with self.assertRaises(SlurmParserError):
+            list(SlurmDumpReader(dump))
+
+    def test_missing_cluster(self):
+        with self.assertRaises(SlurmParserError):
+            SlurmCluster.new_from_stream(StringIO("# nothing here\n"))
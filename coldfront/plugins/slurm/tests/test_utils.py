@@ -0,0 +1,149 @@
+import os
+import stat
+import sys
+import tempfile
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from coldfront.plugins.slurm import utils
+from coldfront.plugins.slurm.utils import SlurmBatch
+
+# Fake sacctmgr: logs every call and answers the default account and
+# association queries issued by SlurmBatch
+FAKE_SACCTMGR = """#!{python}
+import sys
+
+log = {log!r}
+args = sys.argv[1:]
+stdin = sys.stdin.read() if args == ['-Q', '-i'] else ''
+with open(log, 'a') as fh:
+    fh.write(' '.join(args) + '\\n')
+    fh.write(stdin)
+
+if args[:1] == ['show']:
+    print('jane|physics')
+    print('john|chemistry')
+elif args[:1] == ['list']:
+    print('jane|physics')
+    print('jane|chemistry')
+    print('john|chemistry')
+elif 'unchanged' in stdin or 'unchanged' in ' '.join(args):
+    print(' Nothing modified')
+    sys.exit(1)
+elif 'fail' in stdin or 'fail' in ' '.join(args):
+    sys.exit(1)
+"""
+
+
+class SlurmBatchTest(SimpleTestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.log = os.path.join(self.tmpdir.name, 'calls.log')
+        sacctmgr = os.path.join(self.tmpdir.name, 'sacctmgr')
+        with open(sacctmgr, 'w') as fh:
+            fh.write(FAKE_SACCTMGR.format(python=sys.executable, log=self.log))
+        os.chmod(sacctmgr, stat.S_IRWXU)
+        patcher = mock.patch.object(utils, 'SLURM_SACCTMGR_PATH', sacctmgr)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def _calls(self):
+        with open(self.log) as fh:
+            return fh.read().splitlines()
+
+    def test_coalesced_batch(self):
+        batch = SlurmBatch()
+        batch.remove_assoc('jane', 'alpha', 'physics')
+        batch.remove_assoc('john', 'alpha', 'physics')
+        batch.remove_assoc('jack', 'alpha', 'biology')
+        batch.remove_account('alpha', 'biology')
+        batch.remove_qos('john', 'alpha', 'chemistry', 'QOS-=debug')
+
+        ops = batch.execute()
+
+        self.assertTrue(all(op.error is None for op in ops))
+        self.assertEqual(self._calls(), [
+            'show user where name=jack,jane,john cluster=alpha format=User,DefaultAccount -Pn',
+            'list associations where users=jack,jane,john cluster=alpha format=User,Account -Pn',
+            '-Q -i',
+            'modify user where name=jane cluster=alpha set DefaultAccount=chemistry',
+            'modify user where name=john cluster=alpha account=chemistry set QOS-=debug',
+            'delete user where name=jane,john cluster=alpha account=physics',
+            'delete account where name=biology cluster=alpha',
+        ])
+
+    def test_failed_batch_reports_per_operation(self):
+        batch = SlurmBatch()
+        ok = batch.remove_account('alpha', 'physics')
+        failed = batch.remove_account('beta', 'fail')
+
+        batch.execute()
+
+        self.assertIsNone(ok.error)
+        self.assertIsNotNone(failed.error)
+        self.assertIn('-Q -i delete account where name=physics cluster=alpha', self._calls())
+
+    def test_noop(self):
+        batch = SlurmBatch(noop=True)
+        batch.remove_assoc('jane', 'alpha', 'physics')
+        batch.remove_account('alpha', 'physics')
+
+        with self.assertLogs(utils.logger, 'WARNING') as logs:
+            batch.execute()
+
+        self.assertFalse(os.path.exists(self.log))
+        self.assertIn('NOOP - Slurm cmd: delete account where name=physics cluster=alpha',
+                      logs.output[-1])
+
+    def test_invalid_name(self):
+        batch = SlurmBatch()
+        op = batch.remove_account('alpha', 'bad name')
+
+        batch.execute()
+
+        self.assertIsNotNone(op.error)
+        self.assertFalse(os.path.exists(self.log))
+
+    def test_comma_in_name(self):
+        batch = SlurmBatch()
+        op = batch.remove_assoc('jane,john', 'alpha', 'physics')
+
+        batch.execute()
+
+        self.assertIsNotNone(op.error)
+        self.assertFalse(os.path.exists(self.log))
+
+    def test_multiple_qos(self):
+        batch = SlurmBatch()
+        op = batch.remove_qos('john', 'alpha', 'chemistry', 'QOS-=debug,long')
+
+        self.assertIsNone(op.error)
+        self.assertEqual([cmd for cmd, ops in batch.plan()], [
+            'modify user where name=john cluster=alpha account=chemistry set QOS-=debug,long',
+        ])
+
+        batch.execute()
+
+        self.assertIsNone(op.error)
+        self.assertIn('modify user where name=john cluster=alpha account=chemistry set QOS-=debug,long',
+                      self._calls())
+
+    def test_invalid_qos_name(self):
+        batch = SlurmBatch()
+        op = batch.remove_qos('john', 'alpha', 'chemistry', "QOS-=debug,bad qos")
+
+        batch.execute()
+
+        self.assertIsNotNone(op.error)
+        self.assertFalse(os.path.exists(self.log))
+
+    def test_already_applied(self):
+        batch = SlurmBatch()
+        op = batch.remove_qos('john', 'alpha', 'unchanged', 'QOS-=debug')
+
+        batch.execute()
+
+        self.assertIsNone(op.error)
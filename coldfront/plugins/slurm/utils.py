@@ -1,4 +1,5 @@
 import logging
+import re
 import shlex
 import subprocess
 import csv
@@ -22,6 +23,16 @@ SLURM_CMD_CHECK_DEFAULT_ACCOUNT = SLURM_SACCTMGR_PATH + ' show user User={} Clus
 SLURM_CMD_CHANGE_DEFAULT_ACCOUNT = SLURM_SACCTMGR_PATH + ' -Q -i modify user User={} where Cluster={} set DefaultAccount={}'
 SLURM_CMD_BLOCK_ACCOUNT = SLURM_SACCTMGR_PATH + ' -Q -i modify account {} where Cluster={} set GrpSubmitJobs=0'
 SLURM_CMD_DUMP_CLUSTER = SLURM_SACCTMGR_PATH + ' dump {} file={}'
+SLURM_SACCTMGR_BATCH_SIZE = import_from_settings('SLURM_SACCTMGR_BATCH_SIZE', 500)
+
+# sacctmgr commands used by SlurmBatch. These are fed to a single sacctmgr
+# process on stdin, so they do not include the path to sacctmgr
+SLURM_BATCH_DEFAULT_ACCOUNTS = 'show user where name={} cluster={} format=User,DefaultAccount -Pn'
+SLURM_BATCH_LIST_ACCOUNTS = 'list associations where users={} cluster={} format=User,Account -Pn'
+SLURM_BATCH_CHANGE_DEFAULT_ACCOUNT = 'modify user where name={} cluster={} set DefaultAccount={}'
+SLURM_BATCH_REMOVE_QOS = 'modify user where name={} cluster={} account={} set {}'
+SLURM_BATCH_REMOVE_USERS = 'delete user where name={} cluster={} account={}'
+SLURM_BATCH_REMOVE_ACCOUNTS = 'delete account where name={} cluster={}'
 
 logger = logging.getLogger(__name__)
 
@@ -44,6 +55,10 @@ def _run_slurm_cmd(cmd, noop=True):
             # We tried to add something that already exists. Don't throw error
             logger.warn('Nothing new to add: %s', cmd)
             return e.stdout
+        if 'Nothing modified' in str(e.stdout):
+            # The change was already applied, e.g. by an earlier run. Don't throw error
+            logger.warn('Nothing to modify: %s', cmd)
+            return e.stdout
 
         logger.error('Slurm command failed: %s', cmd)
         err_msg = 'return_value={} stdout={} stderr={}'.format(e.returncode, e.stdout, e.stderr)
@@ -131,3 +146,178 @@ def slurm_check_assoc(user, cluster, account):
 def slurm_dump_cluster(cluster, fname, noop=False):
     cmd = SLURM_CMD_DUMP_CLUSTER.format(shlex.quote(cluster), shlex.quote(fname))
     _run_slurm_cmd(cmd, noop=noop)
+
+
+class SlurmOperation:
+    """A planned change to Slurm associations. Error is set if applying it failed"""
+
+    def __init__(self, action, cluster, account, user=None, qos=None):
+        self.action = action
+        self.cluster = cluster
+        self.account = account
+        self.user = user
+        self.qos = qos
+        self.error = None
+
+    def __str__(self):
+        return '{} user={} account={} cluster={} qos={}'.format(
+            self.action, self.user, self.account, self.cluster, self.qos)
+
+
+class SlurmBatch:
+    """Collects association changes and applies them with a few sacctmgr calls
+
+    Changes are coalesced per cluster and account into sacctmgr commands
+    acting on many users at once. The commands are fed in chunks of
+    batch_size to a single "sacctmgr -Q -i" process on stdin. If a chunk
+    fails, its commands are rerun one at a time to find which operations
+    failed. With noop set, commands are only logged.
+    """
+
+    def __init__(self, noop=False, batch_size=None):
+        self.noop = noop
+        self.batch_size = batch_size or SLURM_SACCTMGR_BATCH_SIZE
+        self.operations = []
+
+    def _add(self, op):
+        names = [op.cluster, op.account, op.user]
+        if op.qos is not None:
+            # QOS changes are a list of QOS names, e.g. QOS-=debug,long
+            names.extend(re.sub(r'^QOS[-+]?=', '', op.qos, flags=re.IGNORECASE).split(','))
+        for value in names:
+            # Names are joined with commas in sacctmgr commands
+            if value is not None and (not value or re.search(r"[\s'\",]", value)):
+                op.error = 'Invalid name: {}'.format(value)
+        self.operations.append(op)
+        return op
+
+    def remove_assoc(self, user, cluster, account):
+        return self._add(SlurmOperation('remove_assoc', cluster, account, user=user))
+
+    def remove_qos(self, user, cluster, account, qos):
+        return self._add(SlurmOperation('remove_qos', cluster, account, user=user, qos=qos))
+
+    def remove_account(self, cluster, account):
+        return self._add(SlurmOperation('remove_account', cluster, account))
+
+    def _query(self, cmd):
+        """Run a read only sacctmgr query and return rows split on '|'"""
+        if self.noop:
+            logger.warn('NOOP - Slurm cmd: %s', cmd)
+            return []
+
+        output = _run_slurm_cmd(SLURM_SACCTMGR_PATH + ' ' + cmd, noop=False)
+        return [line.split('|') for line in output.decode('UTF-8').splitlines() if line]
+
+    def _plan_cluster(self, cluster, operations):
+        """Return list of (cmd, operations) for a single cluster"""
+        removed_accounts = {op.account for op in operations if op.action == 'remove_account'}
+        removed = {(op.user, op.account) for op in operations if op.action == 'remove_assoc'}
+        users = sorted({user for user, account in removed})
+
+        plan = []
+        if users:
+            defaults = {}
+            for row in self._query(SLURM_BATCH_DEFAULT_ACCOUNTS.format(','.join(users), cluster)):
+                if len(row) >= 2:
+                    defaults[row[0]] = row[1]
+
+            user_accounts = {}
+            for row in self._query(SLURM_BATCH_LIST_ACCOUNTS.format(','.join(users), cluster)):
+                if len(row) >= 2:
+                    user_accounts.setdefault(row[0], []).append(row[1])
+
+            # Users losing their default account get one they keep
+            new_defaults = {}
+            for user in users:
+                default = defaults.get(user)
+                if (user, default) not in removed:
+                    continue
+                for account in user_accounts.get(user, []):
+                    if (user, account) not in removed and account not in removed_accounts:
+                        new_defaults.setdefault(account, []).append(user)
+                        break
+
+            for account, names in sorted(new_defaults.items()):
+                ops = [op for op in operations if op.action == 'remove_assoc' and op.user in names]
+                plan.append((SLURM_BATCH_CHANGE_DEFAULT_ACCOUNT.format(','.join(names), cluster, account), ops))
+
+        qos_changes = {}
+        for op in operations:
+            if op.action == 'remove_qos' and op.account not in removed_accounts:
+                qos_changes.setdefault((op.account, op.qos), []).append(op)
+        for (account, qos), ops in sorted(qos_changes.items()):
+            names = sorted({op.user for op in ops})
+            plan.append((SLURM_BATCH_REMOVE_QOS.format(','.join(names), cluster, account, qos), ops))
+
+        # Deleting an account also deletes its user associations
+        user_removals = {}
+        for op in operations:
+            if op.action == 'remove_assoc' and op.account not in removed_accounts:
+                user_removals.setdefault(op.account, []).append(op)
+        for account, ops in sorted(user_removals.items()):
+            names = sorted({op.user for op in ops})
+            plan.append((SLURM_BATCH_REMOVE_USERS.format(','.join(names), cluster, account), ops))
+
+        if removed_accounts:
+            ops = [op for op in operations if op.account in removed_accounts]
+            plan.append((SLURM_BATCH_REMOVE_ACCOUNTS.format(','.join(sorted(removed_accounts)), cluster), ops))
+
+        return plan
+
+    def plan(self):
+        """Return list of (cmd, operations) needed to apply all valid operations"""
+        clusters = {}
+        for op in self.operations:
+            if op.error is None:
+                clusters.setdefault(op.cluster, []).append(op)
+
+        plan = []
+        for cluster, operations in clusters.items():
+            plan += self._plan_cluster(cluster, operations)
+
+        return plan
+
+    def _run_batch(self, cmds):
+        argv = [SLURM_SACCTMGR_PATH, '-Q', '-i']
+        stdin = ''.join(cmd + '\n' for cmd in cmds)
+        try:
+            result = subprocess.run(argv, input=stdin.encode('UTF-8'), stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE, check=True)
+        except subprocess.CalledProcessError as e:
+            err_msg = 'return_value={} stdout={} stderr={}'.format(e.returncode, e.stdout, e.stderr)
+            raise SlurmError(err_msg)
+
+        logger.debug('Slurm batch of %s cmds output: %s', len(cmds), result.stdout)
+
+    def execute(self):
+        """Apply all operations and return them with error set on failures"""
+        try:
+            plan = self.plan()
+        except SlurmError as e:
+            for op in self.operations:
+                if op.error is None:
+                    op.error = str(e)
+            return self.operations
+
+        for i in range(0, len(plan), self.batch_size):
+            chunk = plan[i:i + self.batch_size]
+            if self.noop:
+                for cmd, ops in chunk:
+                    logger.warn('NOOP - Slurm cmd: %s', cmd)
+                continue
+
+            try:
+                self._run_batch([cmd for cmd, ops in chunk])
+                continue
+            except SlurmError as e:
+                logger.warn('Slurm batch failed, running %s cmds one at a time: %s', len(chunk), e)
+
+            for cmd, ops in chunk:
+                try:
+                    _run_slurm_cmd('{} -Q -i {}'.format(SLURM_SACCTMGR_PATH, cmd), noop=False)
+                except SlurmError as e:
+                    for op in ops:
+                        op.error = str(e)
+
+        return self.operations
@@ -0,0 +1,105 @@
+import datetime
+import threading
+import time
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import SimpleTestCase, override_settings
+from django.utils import timezone
+
+from coldfront.plugins.system_monitor import utils
+
+DATA = {
+    'utilization_data': {'columns': [['Processors Utilized: 10 (50.0%)', 10]]},
+    'jobs_data': {'columns': [['Running: 3', 3]]},
+    'last_updated': 'Mon Jan 1 00:00:00 2024',
+}
+
+
+class FakeSystemMonitor:
+    """Returns data, or {} on a failed fetch, after waiting for release"""
+    data = DATA
+    release = None
+    calls = 0
+
+    def get_data(self):
+        FakeSystemMonitor.calls += 1
+        if FakeSystemMonitor.release is not None:
+            FakeSystemMonitor.release.wait(5)
+        return FakeSystemMonitor.data
+
+
+@override_settings(SYSTEM_MONITOR_PANEL_TITLE='HPC Cluster Status')
+class SystemMonitorCacheTest(SimpleTestCase):
+
+    def setUp(self):
+        cache.delete(utils.CACHE_KEY)
+        cache.delete(utils.LOCK_KEY)
+        FakeSystemMonitor.data = DATA
+        FakeSystemMonitor.release = None
+        FakeSystemMonitor.calls = 0
+        patcher = mock.patch.object(utils, 'SystemMonitor', FakeSystemMonitor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def wait_for_refresh(self):
+        for _ in range(100):
+            if cache.get(utils.LOCK_KEY) is None:
+                return
+            time.sleep(0.05)
+        self.fail('refresh did not finish')
+
+    def test_cold_cache_does_not_block(self):
+        """test that a cold cache starts one refresh and returns at once"""
+        FakeSystemMonitor.release = threading.Event()
+        start = time.monotonic()
+        context = utils.get_system_monitor_context()
+        utils.get_system_monitor_context()
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertTrue(context['system_monitor_pending'])
+        self.assertIsNone(context['last_updated'])
+
+        FakeSystemMonitor.release.set()
+        self.wait_for_refresh()
+        self.assertEqual(FakeSystemMonitor.calls, 1)
+        context = utils.get_system_monitor_context()
+        self.assertFalse(context['system_monitor_pending'])
+        self.assertFalse(context['system_monitor_stale'])
+        self.assertEqual(context['jobs_data'], DATA['jobs_data'])
+        self.assertEqual(context['last_updated'], DATA['last_updated'])
+
+    def test_stale_data_served_while_refreshing(self):
+        """test that old data is served and kept when a refresh fails"""
+        utils.refresh_system_monitor_data()
+        entry = cache.get(utils.CACHE_KEY)
+        old = timezone.now() - datetime.timedelta(seconds=utils.SYSTEM_MONITOR_REFRESH_INTERVAL * 3)
+        entry['fetched_at'] = entry['checked_at'] = old
+        cache.set(utils.CACHE_KEY, entry)
+
+        FakeSystemMonitor.data = {}
+        context = utils.get_system_monitor_context()
+        self.assertEqual(context['last_updated'], DATA['last_updated'])
+        self.assertTrue(context['system_monitor_stale'])
+        self.wait_for_refresh()
+
+        entry = cache.get(utils.CACHE_KEY)
+        self.assertEqual(entry['data'], DATA)
+        self.assertEqual(entry['fetched_at'], old)
+        self.assertGreater(entry['checked_at'], old)
+
+        # A recently checked entry is not refreshed again
+        calls = FakeSystemMonitor.calls
+        utils.get_system_monitor_context()
+        self.assertEqual(FakeSystemMonitor.calls, calls)
+        self.assertIsNone(cache.get(utils.LOCK_KEY))
+
+    def test_expired_data_dropped(self):
+        """test that data older than the max age is not kept"""
+        utils.refresh_system_monitor_data()
+        entry = cache.get(utils.CACHE_KEY)
+        entry['fetched_at'] -= datetime.timedelta(seconds=utils.SYSTEM_MONITOR_MAX_AGE + 1)
+        cache.set(utils.CACHE_KEY, entry)
+
+        FakeSystemMonitor.data = {}
+        utils.refresh_system_monitor_data()
+        self.assertIsNone(cache.get(utils.CACHE_KEY))
@@ -1,21 +1,96 @@
+#Fetching and parsing the status page can take up to the request timeout,
+#so it never happens inside a page view.  get_system_monitor_context()
+#serves the last parsed data from the Django cache, however old, and if it
+#is older than SYSTEM_MONITOR_REFRESH_INTERVAL seconds starts one background
+#refresh (stale-while-revalidate).  Data older than SYSTEM_MONITOR_MAX_AGE
+#seconds is dropped.  With a shared cache backend all processes share the
+#data and at most one refresh runs at a time.
+
+import datetime
+import logging
 import re
+import threading
 
 import requests
 from bs4 import BeautifulSoup
+from django.core.cache import cache
+from django.utils import timezone
 
 from coldfront.core.utils.common import import_from_settings
 
+logger = logging.getLogger(__name__)
+
+SYSTEM_MONITOR_REFRESH_INTERVAL = import_from_settings('SYSTEM_MONITOR_REFRESH_INTERVAL', 60)
+SYSTEM_MONITOR_MAX_AGE = import_from_settings('SYSTEM_MONITOR_MAX_AGE', 3600)
+
+CACHE_KEY = 'coldfront-system-monitor'
+LOCK_KEY = CACHE_KEY + '-refresh'
+# Longer than the request timeout so a refresh in progress is not duplicated
+LOCK_TIMEOUT = 30
+
+
+def refresh_system_monitor_data():
+    """Fetches and parses the status page and stores the result in the cache.
+
+    If the fetch fails the previously stored data is kept until it reaches
+    SYSTEM_MONITOR_MAX_AGE.  Returns the stored entry.
+    """
+    now = timezone.now()
+    try:
+        data = SystemMonitor().get_data()
+    except Exception:
+        logger.exception('Error refreshing system monitor data')
+        data = None
+
+    entry = cache.get(CACHE_KEY) or {}
+    if data:
+        entry = {'data': data, 'fetched_at': now}
+    entry['checked_at'] = now
+
+    timeout = SYSTEM_MONITOR_MAX_AGE
+    if 'fetched_at' in entry:
+        timeout -= (now - entry['fetched_at']).total_seconds()
+    if timeout > 0:
+        cache.set(CACHE_KEY, entry, timeout)
+    else:
+        cache.delete(CACHE_KEY)
+    return entry
+
+
+def _refresh_and_unlock():
+    try:
+        refresh_system_monitor_data()
+    finally:
+        cache.delete(LOCK_KEY)
+
+
+def revalidate():
+    """Starts a background refresh unless one is already running"""
+    if cache.add(LOCK_KEY, True, LOCK_TIMEOUT):
+        threading.Thread(target=_refresh_and_unlock, daemon=True,
+                         name='system-monitor-refresh').start()
+
 
 def get_system_monitor_context():
     context = {}
-    system_monitor = SystemMonitor()
-    system_monitor_data = system_monitor.get_data()
-    system_monitor_panel_title = system_monitor.get_panel_title()
+    entry = cache.get(CACHE_KEY)
+    now = timezone.now()
+    refresh_interval = datetime.timedelta(seconds=SYSTEM_MONITOR_REFRESH_INTERVAL)
+    if entry is None or now - entry['checked_at'] >= refresh_interval:
+        revalidate()
+
+    entry = entry or {}
+    system_monitor_data = entry.get('data', {})
+    fetched_at = entry.get('fetched_at')
 
     context['last_updated'] = system_monitor_data.get('last_updated')
     context['utilization_data'] = system_monitor_data.get('utilization_data')
     context['jobs_data'] = system_monitor_data.get('jobs_data')
-    context['system_monitor_panel_title'] = system_monitor_panel_title
+    context['system_monitor_panel_title'] = import_from_settings('SYSTEM_MONITOR_PANEL_TITLE')
+    context['system_monitor_pending'] = not entry
+    context['system_monitor_fetched_at'] = fetched_at
+    # A refresh has failed if the data is older than two refresh intervals
+    context['system_monitor_stale'] = fetched_at is not None and now - fetched_at > 2 * refresh_interval
     context['SYSTEM_MONITOR_DISPLAY_XDMOD_LINK'] = import_from_settings('SYSTEM_MONITOR_DISPLAY_XDMOD_LINK', None)
     context['SYSTEM_MONITOR_DISPLAY_MORE_STATUS_INFO_LINK'] = import_from_settings('SYSTEM_MONITOR_DISPLAY_MORE_STATUS_INFO_LINK', None)
 
@@ -41,6 +116,7 @@ class SystemMonitor:
         try:
             r = requests.get(self.SYSTEM_MONITOR_ENDPOINT, timeout=5)
         except Exception as e:
+            logger.warning('Error fetching %s: %s', self.SYSTEM_MONITOR_ENDPOINT, e)
             r = None
 
         if r and r.status_code == 200:
@@ -50,7 +126,7 @@ class SystemMonitor:
         try:
             soup = BeautifulSoup(self.response.text, 'html.parser')
         except Exception as e:
-            print('Error in parsing HTML response')
+            logger.warning('Error in parsing HTML response')
             return
 
         pattern = re.compile(r"Last updated: (?P<time>[A-Za-z\t :\d.]+)")
@@ -105,7 +181,7 @@ class SystemMonitor:
             running_value = job_numbers[0]
             queued_value = job_numbers[1]
         except Exception as e:
-            print('Error in parsing Table. Maybe data is missing')
+            logger.warning('Error in parsing Table. Maybe data is missing')
             return
 
         utilization_data = {
@@ -5,9 +5,12 @@ import tempfile
 
 from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
 from django.db.models import Q
 
 from coldfront.core.allocation.models import Allocation
+from coldfront.core.attribute_cache import attribute_cache
+from coldfront.core.attribute_expansion import AttributeExpansionBatch
 from coldfront.core.utils.common import import_from_settings
 from coldfront.plugins.xdmod.utils import (XDMOD_ACCOUNT_ATTRIBUTE_NAME,
                                            XDMOD_CLOUD_CORE_TIME_ATTRIBUTE_NAME,
@@ -17,9 +20,16 @@ from coldfront.plugins.xdmod.utils import (XDMOD_ACCOUNT_ATTRIBUTE_NAME,
                                            XDMOD_RESOURCE_ATTRIBUTE_NAME,
                                            XDMOD_STORAGE_ATTRIBUTE_NAME,
                                            XDMOD_STORAGE_GROUP_ATTRIBUTE_NAME,
+                                           XDMOD_MAX_WORKERS,
                                            XdmodError, XdmodNotFoundError,
                                            xdmod_fetch_cloud_core_time,
-                                           xdmod_fetch_total_cpu_hours, xdmod_fetch_total_storage)
+                                           xdmod_fetch_cloud_core_time_grouped,
+                                           xdmod_fetch_many,
+                                           xdmod_fetch_many_grouped,
+                                           xdmod_fetch_total_cpu_hours,
+                                           xdmod_fetch_total_cpu_hours_grouped,
+                                           xdmod_fetch_total_storage,
+                                           xdmod_fetch_total_storage_grouped)
 
 logger = logging.getLogger(__name__)
 
@@ -44,6 +54,12 @@ class Command(BaseCommand):
             "-m", "--statistic", help="XDMoD statistic (default total_cpu_hours)", required=True)
         parser.add_argument(
             "--expired", help="XDMoD statistic for archived projects", action="store_true")
+        parser.add_argument(
+            "-w", "--workers", type=int, default=XDMOD_MAX_WORKERS,
+            help="Number of concurrent requests to XDMoD (default {})".format(XDMOD_MAX_WORKERS))
+        parser.add_argument(
+            "-b", "--bulk", action="store_true",
+            help="Fetch usage with one grouped request per date range and resources")
 
     def write(self, data):
         try:
@@ -53,6 +69,52 @@ class Command(BaseCommand):
             os.dup2(devnull, sys.stdout.fileno())
             sys.exit(1)
 
+    def fetch_usage(self, jobs, fetch, fetch_grouped, attribute_name, kind, message, **kwargs):
+        """Fetches usage for jobs from XDMoD concurrently and reports it
+
+        Each job is an (allocation, name, quota, resources) tuple. In bulk
+        mode fetch_grouped is called once per distinct (start_date,
+        end_date, resources) instead of calling fetch once per job, and
+        fetch is only called for names missing from the grouped rows. Usage
+        is written to the allocations in a single transaction once all
+        requests have completed.
+        """
+        queries = [(s.start_date, s.end_date, name, resources) for s, name, _, resources in jobs]
+        if self.bulk:
+            results = xdmod_fetch_many_grouped(
+                fetch_grouped, queries, max_workers=self.workers, fallback=fetch, **kwargs)
+        else:
+            results = xdmod_fetch_many(fetch, queries, max_workers=self.workers, **kwargs)
+
+        usages = []
+        for (s, name, quota, resources), (usage, error) in zip(jobs, results):
+            if isinstance(error, XdmodNotFoundError):
+                logger.warn(
+                    "No data in XDMoD found for allocation %s %s %s resources %s", s, kind, name, resources)
+                continue
+            if error:
+                logger.error(
+                    "Failed to fetch usage from XDMoD for allocation %s %s %s resources %s: %s",
+                    s, kind, name, resources, error)
+                continue
+
+            logger.warn(message, usage, s, name, quota, resources)
+            usages.append((s, usage))
+
+            self.write('\t'.join([
+                str(s.id),
+                s.project.pi.username,
+                name,
+                ','.join(resources),
+                str(quota),
+                str(usage),
+            ]))
+
+        if self.sync:
+            with transaction.atomic():
+                for s, usage in usages:
+                    s.set_usage(attribute_name, usage)
+
     def process_total_storage(self):
         header = [
             'allocation_id',
@@ -96,14 +158,17 @@ class Command(BaseCommand):
                 Q(allocationattribute__value=self.filter_account)
             )
 
-        for s in allocations.distinct():
-            account_name = s.get_attribute(XDMOD_STORAGE_GROUP_ATTRIBUTE_NAME)
+        attributes = AttributeExpansionBatch(
+            allocations.distinct(), [XDMOD_STORAGE_GROUP_ATTRIBUTE_NAME, XDMOD_STORAGE_ATTRIBUTE_NAME])
+        jobs = []
+        for s in attributes.allocations:
+            account_name = attributes.get_attribute(s, XDMOD_STORAGE_GROUP_ATTRIBUTE_NAME)
             if not account_name:
                 logger.warn("%s attribute not found for allocation: %s",
                             XDMOD_STORAGE_GROUP_ATTRIBUTE_NAME, s)
                 continue
 
-            cpu_hours = s.get_attribute(XDMOD_STORAGE_ATTRIBUTE_NAME)
+            cpu_hours = attributes.get_attribute(s, XDMOD_STORAGE_ATTRIBUTE_NAME)
             if not cpu_hours:
                 logger.warn("%s attribute not found for allocation: %s",
                             XDMOD_STORAGE_ATTRIBUTE_NAME, s)
@@ -111,7 +176,7 @@ class Command(BaseCommand):
 
             resources = []
             for r in s.resources.all():
-                rname = r.get_attribute(XDMOD_RESOURCE_ATTRIBUTE_NAME)
+                rname = attributes.get_resource_attribute(r, XDMOD_RESOURCE_ATTRIBUTE_NAME)
                 if not rname and r.parent_resource:
                     rname = r.parent_resource.get_attribute(
                         XDMOD_RESOURCE_ATTRIBUTE_NAME)
@@ -129,27 +194,12 @@ class Command(BaseCommand):
                             XDMOD_RESOURCE_ATTRIBUTE_NAME, s)
                 continue
 
-            try:
-                usage = xdmod_fetch_total_storage(
-                    s.start_date, s.end_date, account_name, resources=resources, statistics='avg_physical_usage')
-            except XdmodNotFoundError:
-                logger.warn(
-                    "No data in XDMoD found for allocation %s account %s resources %s", s, account_name, resources)
-                continue
-
-            logger.warn("Total GB = %s for allocation %s account %s GB %s resources %s",
-                        usage, s, account_name, cpu_hours, resources)
-            if self.sync:
-                s.set_usage(XDMOD_STORAGE_ATTRIBUTE_NAME, usage)
+            jobs.append((s, account_name, cpu_hours, resources))
 
-            self.write('\t'.join([
-                str(s.id),
-                s.project.pi.username,
-                account_name,
-                ','.join(resources),
-                str(cpu_hours),
-                str(usage),
-            ]))
+        self.fetch_usage(jobs, xdmod_fetch_total_storage, xdmod_fetch_total_storage_grouped,
+                         XDMOD_STORAGE_ATTRIBUTE_NAME, 'account',
+                         "Total GB = %s for allocation %s account %s GB %s resources %s",
+                         statistics='avg_physical_usage')
 
 
 
@@ -196,14 +246,17 @@ class Command(BaseCommand):
                 Q(allocationattribute__value=self.filter_account)
             )
 
-        for s in allocations.distinct():
-            account_name = s.get_attribute(XDMOD_ACCOUNT_ATTRIBUTE_NAME)
+        attributes = AttributeExpansionBatch(
+            allocations.distinct(), [XDMOD_ACCOUNT_ATTRIBUTE_NAME, XDMOD_ACC_HOURS_ATTRIBUTE_NAME])
+        jobs = []
+        for s in attributes.allocations:
+            account_name = attributes.get_attribute(s, XDMOD_ACCOUNT_ATTRIBUTE_NAME)
             if not account_name:
                 logger.warn("%s attribute not found for allocation: %s",
                             XDMOD_ACCOUNT_ATTRIBUTE_NAME, s)
                 continue
 
-            cpu_hours = s.get_attribute(XDMOD_ACC_HOURS_ATTRIBUTE_NAME)
+            cpu_hours = attributes.get_attribute(s, XDMOD_ACC_HOURS_ATTRIBUTE_NAME)
             if not cpu_hours:
                 logger.warn("%s attribute not found for allocation: %s",
                             XDMOD_ACC_HOURS_ATTRIBUTE_NAME, s)
@@ -211,7 +264,7 @@ class Command(BaseCommand):
 
             resources = []
             for r in s.resources.all():
-                rname = r.get_attribute(XDMOD_RESOURCE_ATTRIBUTE_NAME)
+                rname = attributes.get_resource_attribute(r, XDMOD_RESOURCE_ATTRIBUTE_NAME)
                 if not rname and r.parent_resource:
                     rname = r.parent_resource.get_attribute(
                         XDMOD_RESOURCE_ATTRIBUTE_NAME)
@@ -229,27 +282,12 @@ class Command(BaseCommand):
                             XDMOD_RESOURCE_ATTRIBUTE_NAME, s)
                 continue
 
-            try:
-                usage = xdmod_fetch_total_cpu_hours(
-                    s.start_date, s.end_date, account_name, resources=resources, statistics='total_gpu_hours')
-            except XdmodNotFoundError:
-                logger.warn(
-                    "No data in XDMoD found for allocation %s account %s resources %s", s, account_name, resources)
-                continue
+            jobs.append((s, account_name, cpu_hours, resources))
 
-            logger.warn("Total Accelerator hours = %s for allocation %s account %s gpu_hours %s resources %s",
-                        usage, s, account_name, cpu_hours, resources)
-            if self.sync:
-                s.set_usage(XDMOD_ACC_HOURS_ATTRIBUTE_NAME, usage)
-
-            self.write('\t'.join([
-                str(s.id),
-                s.project.pi.username,
-                account_name,
-                ','.join(resources),
-                str(cpu_hours),
-                str(usage),
-            ]))
+        self.fetch_usage(jobs, xdmod_fetch_total_cpu_hours, xdmod_fetch_total_cpu_hours_grouped,
+                         XDMOD_ACC_HOURS_ATTRIBUTE_NAME, 'account',
+                         "Total Accelerator hours = %s for allocation %s account %s gpu_hours %s resources %s",
+                         statistics='total_gpu_hours')
 
     def process_total_cpu_hours(self):
         header = [
@@ -287,14 +325,17 @@ class Command(BaseCommand):
                 Q(allocationattribute__value=self.filter_account)
             )
 
-        for s in allocations.distinct():
-            account_name = s.get_attribute(XDMOD_ACCOUNT_ATTRIBUTE_NAME)
+        attributes = AttributeExpansionBatch(
+            allocations.distinct(), [XDMOD_ACCOUNT_ATTRIBUTE_NAME, XDMOD_CPU_HOURS_ATTRIBUTE_NAME])
+        jobs = []
+        for s in attributes.allocations:
+            account_name = attributes.get_attribute(s, XDMOD_ACCOUNT_ATTRIBUTE_NAME)
             if not account_name:
                 logger.warn("%s attribute not found for allocation: %s",
                             XDMOD_ACCOUNT_ATTRIBUTE_NAME, s)
                 continue
 
-            cpu_hours = s.get_attribute(XDMOD_CPU_HOURS_ATTRIBUTE_NAME)
+            cpu_hours = attributes.get_attribute(s, XDMOD_CPU_HOURS_ATTRIBUTE_NAME)
             if not cpu_hours:
                 logger.warn("%s attribute not found for allocation: %s",
                             XDMOD_CPU_HOURS_ATTRIBUTE_NAME, s)
@@ -302,7 +343,7 @@ class Command(BaseCommand):
 
             resources = []
             for r in s.resources.all():
-                rname = r.get_attribute(XDMOD_RESOURCE_ATTRIBUTE_NAME)
+                rname = attributes.get_resource_attribute(r, XDMOD_RESOURCE_ATTRIBUTE_NAME)
                 if not rname and r.parent_resource:
                     rname = r.parent_resource.get_attribute(
                         XDMOD_RESOURCE_ATTRIBUTE_NAME)
@@ -320,27 +361,11 @@ class Command(BaseCommand):
                             XDMOD_RESOURCE_ATTRIBUTE_NAME, s)
                 continue
 
-            try:
-                usage = xdmod_fetch_total_cpu_hours(
-                    s.start_date, s.end_date, account_name, resources=resources)
-            except XdmodNotFoundError:
-                logger.warn(
-                    "No data in XDMoD found for allocation %s account %s resources %s", s, account_name, resources)
-                continue
+            jobs.append((s, account_name, cpu_hours, resources))
 
-            logger.warn("Total CPU hours = %s for allocation %s account %s cpu_hours %s resources %s",
-                        usage, s, account_name, cpu_hours, resources)
-            if self.sync:
-                s.set_usage(XDMOD_CPU_HOURS_ATTRIBUTE_NAME, usage)
-
-            self.write('\t'.join([
-                str(s.id),
-                s.project.pi.username,
-                account_name,
-                ','.join(resources),
-                str(cpu_hours),
-                str(usage),
-            ]))
+        self.fetch_usage(jobs, xdmod_fetch_total_cpu_hours, xdmod_fetch_total_cpu_hours_grouped,
+                         XDMOD_CPU_HOURS_ATTRIBUTE_NAME, 'account',
+                         "Total CPU hours = %s for allocation %s account %s cpu_hours %s resources %s")
 
     def process_cloud_core_time(self):
         header = [
@@ -378,14 +403,17 @@ class Command(BaseCommand):
                 Q(allocationattribute__value=self.filter_project)
             )
 
-        for s in allocations.distinct():
-            project_name = s.get_attribute(XDMOD_CLOUD_PROJECT_ATTRIBUTE_NAME)
+        attributes = AttributeExpansionBatch(
+            allocations.distinct(), [XDMOD_CLOUD_PROJECT_ATTRIBUTE_NAME, XDMOD_CLOUD_CORE_TIME_ATTRIBUTE_NAME])
+        jobs = []
+        for s in attributes.allocations:
+            project_name = attributes.get_attribute(s, XDMOD_CLOUD_PROJECT_ATTRIBUTE_NAME)
             if not project_name:
                 logger.warn("%s attribute not found for allocation: %s",
                             XDMOD_CLOUD_PROJECT_ATTRIBUTE_NAME, s)
                 continue
 
-            core_time = s.get_attribute(XDMOD_CLOUD_CORE_TIME_ATTRIBUTE_NAME)
+            core_time = attributes.get_attribute(s, XDMOD_CLOUD_CORE_TIME_ATTRIBUTE_NAME)
             if not core_time:
                 logger.warn("%s attribute not found for allocation: %s",
                             XDMOD_CLOUD_CORE_TIME_ATTRIBUTE_NAME, s)
@@ -393,7 +421,7 @@ class Command(BaseCommand):
 
             resources = []
             for r in s.resources.all():
-                rname = r.get_attribute(XDMOD_RESOURCE_ATTRIBUTE_NAME)
+                rname = attributes.get_resource_attribute(r, XDMOD_RESOURCE_ATTRIBUTE_NAME)
                 if not rname and r.parent_resource:
                     rname = r.parent_resource.get_attribute(
                         XDMOD_RESOURCE_ATTRIBUTE_NAME)
@@ -411,27 +439,11 @@ class Command(BaseCommand):
                             XDMOD_RESOURCE_ATTRIBUTE_NAME, s)
                 continue
 
-            try:
-                usage = xdmod_fetch_cloud_core_time(
-                    s.start_date, s.end_date, project_name, resources=resources)
-            except XdmodNotFoundError:
-                logger.warn(
-                    "No data in XDMoD found for allocation %s project %s resources %s", s, project_name, resources)
-                continue
+            jobs.append((s, project_name, core_time, resources))
 
-            logger.warn("Cloud core time = %s for allocation %s project %s core_time %s resources %s",
-                        usage, s, project_name, core_time, resources)
-            if self.sync:
-                s.set_usage(XDMOD_CLOUD_CORE_TIME_ATTRIBUTE_NAME, usage)
-
-            self.write('\t'.join([
-                str(s.id),
-                s.project.pi.username,
-                project_name,
-                ','.join(resources),
-                str(core_time),
-                str(usage),
-            ]))
+        self.fetch_usage(jobs, xdmod_fetch_cloud_core_time, xdmod_fetch_cloud_core_time_grouped,
+                         XDMOD_CLOUD_CORE_TIME_ATTRIBUTE_NAME, 'project',
+                         "Cloud core time = %s for allocation %s project %s core_time %s resources %s")
 
     def handle(self, *args, **options):
         verbosity = int(options['verbosity'])
@@ -457,6 +469,8 @@ class Command(BaseCommand):
         self.filter_account = ''
         self.print_header = False
         self.fetch_expired = False
+        self.workers = options['workers']
+        self.bulk = options['bulk']
         
         if options['username']:
             logger.info("Filtering output by username: %s",
@@ -481,14 +495,15 @@ class Command(BaseCommand):
         if options['statistic']:
             statistic = options['statistic']
 
-        if statistic == 'total_cpu_hours':
-            self.process_total_cpu_hours()
-        elif statistic == 'cloud_core_time':
-            self.process_cloud_core_time()
-        elif statistic == 'total_acc_hours':
-            self.process_total_gpu_hours()
-        elif statistic == 'total_storage':
-            self.process_total_storage()          
-        else:
-            logger.error("Unsupported XDMoD statistic")
-            sys.exit(1)
+        with attribute_cache():
+            if statistic == 'total_cpu_hours':
+                self.process_total_cpu_hours()
+            elif statistic == 'cloud_core_time':
+                self.process_cloud_core_time()
+            elif statistic == 'total_acc_hours':
+                self.process_total_gpu_hours()
+            elif statistic == 'total_storage':
+                self.process_total_storage()
+            else:
+                logger.error("Unsupported XDMoD statistic")
+                sys.exit(1)
@@ -0,0 +1,141 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+
+from django.test import SimpleTestCase
+
+from coldfront.plugins.xdmod import utils
+from coldfront.plugins.xdmod.utils import (XdmodError, XdmodNotFoundError,
+                                           xdmod_fetch_many,
+                                           xdmod_fetch_many_grouped,
+                                           xdmod_fetch_total_cpu_hours,
+                                           xdmod_fetch_total_cpu_hours_grouped)
+
+RESPONSE = """<?xml version="1.0" encoding="UTF-8"?>
+<xdmod-xml-dataset><rows>{rows}</rows></xdmod-xml-dataset>"""
+
+ROW = """<row><cell><value>{}</value></cell><cell><value>{}</value></cell></row>"""
+
+# Accounts returned by queries without a pi_filter
+GROUPED_ACCOUNTS = ['acct1', 'acct22', 'acct333']
+
+
+class StubXdmodHandler(BaseHTTPRequestHandler):
+    """Answers get_data queries with the length of the account name as usage"""
+
+    def do_GET(self):
+        server = self.server
+        params = parse_qs(urlparse(self.path).query)
+        account = params.get('pi_filter', ['*'])[0].strip('"')
+        with server.lock:
+            server.calls.append(account)
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            attempts = server.calls.count(account)
+        try:
+            time.sleep(0.2 if account == 'slow' else 0.05)
+            if account == 'flaky' and attempts == 1:
+                self._send(503, 'text/plain', 'unavailable')
+            elif account == 'missing':
+                self._send(200, 'application/json', '{"success": false}')
+            elif account == '*':
+                self._send(200, 'text/xml', RESPONSE.format(rows=''.join(
+                    ROW.format(a, len(a)) for a in GROUPED_ACCOUNTS)))
+            else:
+                self._send(200, 'text/xml', RESPONSE.format(
+                    rows=ROW.format(account, len(account))))
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def _send(self, status, content_type, body):
+        body = body.encode()
+        try:
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # client gave up on a slow request
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+class XdmodFetchTest(SimpleTestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubXdmodHandler)
+        self.server.lock = threading.Lock()
+        self.server.calls = []
+        self.server.in_flight = 0
+        self.server.max_in_flight = 0
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        for name, value in [('XDMOD_API_URL', url),
+                            ('XDMOD_REQUEST_TIMEOUT', 0.1),
+                            ('XDMOD_MAX_RETRIES', 1),
+                            ('XDMOD_RETRY_BACKOFF', 0),
+                            ('_session', None)]:
+            patcher = mock.patch.object(utils, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_fetch_many_is_concurrent_and_ordered(self):
+        accounts = ['acct{}'.format(i) for i in range(16)]
+        results = xdmod_fetch_many(
+            xdmod_fetch_total_cpu_hours,
+            [('2024-01-01', '2024-12-31', a, ['hpc']) for a in accounts],
+            max_workers=8)
+
+        self.assertEqual(results, [(str(len(a)), None) for a in accounts])
+        self.assertGreater(self.server.max_in_flight, 1)
+        self.assertLessEqual(self.server.max_in_flight, 8)
+
+    def test_retry_and_errors(self):
+        results = xdmod_fetch_many(
+            xdmod_fetch_total_cpu_hours,
+            [('2024-01-01', '2024-12-31', a, ['hpc']) for a in ['flaky', 'missing', 'slow']])
+
+        self.assertEqual(results[0], ('5', None))
+        self.assertEqual(self.server.calls.count('flaky'), 2)
+        self.assertIsInstance(results[1][1], XdmodNotFoundError)
+        self.assertIsInstance(results[2][1], XdmodError)
+        self.assertNotIsInstance(results[2][1], XdmodNotFoundError)
+
+    def test_grouped_queries(self):
+        queries = [
+            ('2024-01-01', '2024-12-31', 'acct1', ['hpc']),
+            ('2024-01-01', '2024-12-31', 'acct22', ['hpc']),
+            ('2024-01-01', '2024-12-31', 'acct4444', ['hpc']),
+            ('2024-06-01', '2024-12-31', 'acct333', ['hpc']),
+            ('2024-01-01', '2024-12-31', 'acct1', ['hpc', 'gpu']),
+        ]
+        results = xdmod_fetch_many_grouped(
+            xdmod_fetch_total_cpu_hours_grouped, queries)
+
+        self.assertEqual(len(self.server.calls), 3)
+        self.assertEqual(results[0], ('5', None))
+        self.assertEqual(results[1], ('6', None))
+        self.assertIsInstance(results[2][1], XdmodNotFoundError)
+        self.assertEqual(results[3], ('7', None))
+        self.assertEqual(results[4], ('5', None))
+
+    def test_grouped_queries_fallback(self):
+        queries = [
+            ('2024-01-01', '2024-12-31', 'acct1', ['hpc']),
+            ('2024-01-01', '2024-12-31', 'acct4444', ['hpc']),
+        ]
+        results = xdmod_fetch_many_grouped(
+            xdmod_fetch_total_cpu_hours_grouped, queries, fallback=xdmod_fetch_total_cpu_hours)
+
+        self.assertEqual(results, [('5', None), ('8', None)])
+        self.assertEqual(sorted(self.server.calls), ['*', 'acct4444'])
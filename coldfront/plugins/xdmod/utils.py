@@ -1,7 +1,11 @@
 import logging
-import requests
-import json
+import threading
 import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from coldfront.core.utils.common import import_from_settings
 
@@ -20,6 +24,11 @@ XDMOD_STORAGE_GROUP_ATTRIBUTE_NAME = import_from_settings('XDMOD_STORAGE_GROUP_A
 
 XDMOD_API_URL = import_from_settings('XDMOD_API_URL')
 
+XDMOD_MAX_WORKERS = import_from_settings('XDMOD_MAX_WORKERS', 8)
+XDMOD_REQUEST_TIMEOUT = import_from_settings('XDMOD_REQUEST_TIMEOUT', 60)
+XDMOD_MAX_RETRIES = import_from_settings('XDMOD_MAX_RETRIES', 3)
+XDMOD_RETRY_BACKOFF = import_from_settings('XDMOD_RETRY_BACKOFF', 1.0)
+
 _ENDPOINT_CORE_HOURS = '/controllers/user_interface.php'
 
 _DEFAULT_PARAMS = {
@@ -39,21 +48,42 @@ class XdmodError(Exception):
 class XdmodNotFoundError(XdmodError):
     pass
 
-def xdmod_fetch_total_cpu_hours(start, end, account, resources=None, statistics='total_cpu_hours'):
-    if resources is None:
-        resources = []
-    
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
+    """Returns the HTTP session shared by all XDMoD requests
+
+    The connection pool is sized for XDMOD_MAX_WORKERS threads and failed
+    requests are retried with exponential backoff.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(
+                total=XDMOD_MAX_RETRIES,
+                backoff_factor=XDMOD_RETRY_BACKOFF,
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=['GET'],
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(pool_connections=XDMOD_MAX_WORKERS,
+                                  pool_maxsize=XDMOD_MAX_WORKERS,
+                                  max_retries=retry)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+
+    return _session
+
+def _fetch_rows(payload, name, resources):
+    """Runs an XDMoD get_data query and returns the rows of its result table"""
     url = '{}{}'.format(XDMOD_API_URL, _ENDPOINT_CORE_HOURS)
-    payload = _DEFAULT_PARAMS
-    payload['pi_filter'] = '"{}"'.format(account)
-    payload['resource_filter'] = '"{}"'.format(','.join(resources))
-    payload['start_date'] = start
-    payload['end_date'] = end
-    payload['group_by'] = 'pi'
-    payload['realm'] = 'Jobs'
-    payload['operation'] = 'get_data'
-    payload['statistic'] = statistics
-    r = requests.get(url, params=payload)
+    try:
+        r = get_session().get(url, params=payload, timeout=XDMOD_REQUEST_TIMEOUT)
+    except requests.exceptions.RequestException as e:
+        raise XdmodError('Failed to query XDMoD API: {}'.format(e))
 
     logger.info(r.url)
     logger.info(r.text)
@@ -63,25 +93,133 @@ def xdmod_fetch_total_cpu_hours(start, end, account, resources=None, statistics=
         # XXX fix me. Here we assume any json response is bad as we're
         # expecting xml but XDMoD should just return json always. 
         raise XdmodNotFoundError('Got json response but expected XML: {}'.format(error))
-    except json.decoder.JSONDecodeError as e:
-        pass
-    except requests.exceptions.JSONDecodeError:
+    except ValueError:
         pass
 
+    if r.status_code != 200:
+        raise XdmodError('XDMoD API returned status {}'.format(r.status_code))
+
     try:
         root = ET.fromstring(r.text)
-    except ET.ParserError as e:
+    except ET.ParseError as e:
         raise XdmodError('Invalid XML data returned from XDMoD API: {}'.format(e))
 
     rows = root.find('rows')
-    if len(rows) != 1:
-        raise XdmodNotFoundError('Rows not found for {} - {}'.format(account, resources))
+    if rows is None:
+        raise XdmodNotFoundError('Rows not found for {} - {}'.format(name, resources))
 
-    cells = rows.find('row').findall('cell')
-    if len(cells) != 2:
+    cells = [row.findall('cell') for row in rows.findall('row')]
+    if any(len(c) != 2 for c in cells):
         raise XdmodError('Invalid XML data returned from XDMoD API: Cells not found')
 
-    core_hours = cells[1].find('value').text
+    return [(c[0].find('value').text, c[1].find('value').text) for c in cells]
+
+def _fetch_value(payload, name, resources):
+    """Runs an XDMoD get_data query and returns the value of its single row"""
+    rows = _fetch_rows(payload, name, resources)
+    if len(rows) != 1:
+        raise XdmodNotFoundError('Rows not found for {} - {}'.format(name, resources))
+
+    return rows[0][1]
+
+def _fetch_table(payload, resources):
+    """Runs a grouped XDMoD get_data query and returns a dict of value by row name"""
+    return dict(_fetch_rows(payload, 'all', resources))
+
+def xdmod_fetch_many(fetch, queries, max_workers=None, **kwargs):
+    """Runs fetch concurrently with the positional arguments of each query
+
+    Extra keyword arguments are passed to every call of fetch. Returns a
+    list of (value, error) tuples in the order of queries, where error is
+    the XdmodError raised for that query or None.
+    """
+    if max_workers is None:
+        max_workers = XDMOD_MAX_WORKERS
+
+    def run(query):
+        try:
+            return (fetch(*query, **kwargs), None)
+        except XdmodError as e:
+            return (None, e)
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        return list(executor.map(run, queries))
+
+def xdmod_fetch_many_grouped(fetch_grouped, queries, max_workers=None, fallback=None, **kwargs):
+    """Answers (start, end, name, resources) queries with grouped requests
+
+    Queries sharing start, end and resources are answered by a single call
+    of fetch_grouped(start, end, resources), which returns a dict of value
+    by the group label XDMoD reports for each account or project. Returns a
+    list of (value, error) tuples in the order of queries, like
+    xdmod_fetch_many.
+
+    A name missing from its grouped table is looked up with fallback, the
+    filtered single name fetch, when given, as the group label XDMoD reports
+    may differ from the name it filters on. Tables none of whose rows match
+    a queried name are logged, as that points to such a label mismatch.
+    """
+    groups = {}
+    for start, end, name, resources in queries:
+        groups.setdefault((start, end, tuple(resources)), set()).add(name)
+
+    keys = list(groups)
+    tables = dict(zip(keys, xdmod_fetch_many(
+        fetch_grouped,
+        [(start, end, list(resources)) for start, end, resources in keys],
+        max_workers=max_workers,
+        **kwargs)))
+
+    for key, (table, error) in tables.items():
+        if error is not None or not table:
+            continue
+        start, end, resources = key
+        matched = groups[key] & set(table)
+        unmatched = sorted(set(table) - groups[key])
+        logger.debug("XDMoD rows for %s to %s resources %s not matching any allocation: %s",
+                     start, end, list(resources), unmatched)
+        if not matched:
+            logger.warning(
+                "None of the %s XDMoD rows for %s to %s resources %s match the %s queried names, "
+                "e.g. %s", len(table), start, end, list(resources), len(groups[key]), unmatched[:5])
+
+    results = []
+    missing = []
+    for i, (start, end, name, resources) in enumerate(queries):
+        table, error = tables[(start, end, tuple(resources))]
+        if error is not None:
+            results.append((None, error))
+        elif name not in table:
+            results.append((None, XdmodNotFoundError(
+                'Rows not found for {} - {}'.format(name, resources))))
+            missing.append(i)
+        else:
+            results.append((table[name], None))
+
+    if fallback is not None and missing:
+        logger.warning("%s names not found in grouped XDMoD results, fetching them one by one",
+                       len(missing))
+        for i, result in zip(missing, xdmod_fetch_many(
+                fallback, [queries[i] for i in missing], max_workers=max_workers, **kwargs)):
+            results[i] = result
+
+    return results
+
+def xdmod_fetch_total_cpu_hours(start, end, account, resources=None, statistics='total_cpu_hours'):
+    if resources is None:
+        resources = []
+
+    payload = dict(_DEFAULT_PARAMS)
+    payload['pi_filter'] = '"{}"'.format(account)
+    payload['resource_filter'] = '"{}"'.format(','.join(resources))
+    payload['start_date'] = start
+    payload['end_date'] = end
+    payload['group_by'] = 'pi'
+    payload['realm'] = 'Jobs'
+    payload['operation'] = 'get_data'
+    payload['statistic'] = statistics
+
+    core_hours = _fetch_value(payload, account, resources)
 
     return core_hours
 
@@ -94,8 +232,7 @@ def xdmod_fetch_total_storage(start, end, account, resources=None, statistics='p
     payload_end = end
     if payload_end is None:
         payload_end = '2099-01-01'
-    url = '{}{}'.format(XDMOD_API_URL, _ENDPOINT_CORE_HOURS)
-    payload = _DEFAULT_PARAMS
+    payload = dict(_DEFAULT_PARAMS)
     payload['pi_filter'] = '"{}"'.format(account)
     payload['resource_filter'] = '{}'.format(','.join(resources))
     payload['start_date'] =  start
@@ -104,39 +241,8 @@ def xdmod_fetch_total_storage(start, end, account, resources=None, statistics='p
     payload['realm'] = 'Storage'
     payload['operation'] = 'get_data'
     payload['statistic'] = statistics
-    r = requests.get(url, params=payload)
-
-    logger.info(r.url)
-    logger.info(r.text)
-    if is_json(r.content):
-        error = r.json()
-        # XXX fix me. Here we assume any json response is bad as we're
-        # expecting xml but XDMoD should just return json always. 
-        
-        # print('XXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXX\n')
-        # print(f'XDMOD synchronization error: ({start}, {end}, {account}, {resources}, response: {r})')
-        # print(r.content)
-        # print(r.url)
-        # print(payload)
-        # print('XXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXX\n\n')
-
-        raise XdmodNotFoundError('Got json response but expected XML: {}'.format(error))
-    
-
-    try:
-        root = ET.fromstring(r.text)
-    except ET.ParserError as e:
-        raise XdmodError('Invalid XML data returned from XDMoD API: {}'.format(e))
-
-    rows = root.find('rows')
-    if len(rows) != 1:
-        raise XdmodNotFoundError('Rows not found for {} - {}'.format(account, resources))
 
-    cells = rows.find('row').findall('cell')
-    if len(cells) != 2:
-        raise XdmodError('Invalid XML data returned from XDMoD API: Cells not found')
-
-    physical_usage = float(cells[1].find('value').text) / 1E9
+    physical_usage = float(_fetch_value(payload, account, resources)) / 1E9
 
     return physical_usage
 
@@ -144,8 +250,7 @@ def xdmod_fetch_cloud_core_time(start, end, project, resources=None):
     if resources is None:
         resources = []
 
-    url = '{}{}'.format(XDMOD_API_URL, _ENDPOINT_CORE_HOURS)
-    payload = _DEFAULT_PARAMS
+    payload = dict(_DEFAULT_PARAMS)
     payload['project_filter'] = project
     payload['resource_filter'] = '"{}"'.format(','.join(resources))
     payload['start_date'] = start
@@ -154,32 +259,57 @@ def xdmod_fetch_cloud_core_time(start, end, project, resources=None):
     payload['realm'] = 'Cloud'
     payload['operation'] = 'get_data'
     payload['statistic'] = 'cloud_core_time'
-    r = requests.get(url, params=payload)
 
-    logger.info(r.url)
-    logger.info(r.text)
+    core_hours = _fetch_value(payload, project, resources)
 
-    try:
-        error = r.json()
-        # XXX fix me. Here we assume any json response is bad as we're
-        # expecting xml but XDMoD should just return json always. 
-        raise XdmodNotFoundError('Got json response but expected XML: {}'.format(error))
-    except json.decoder.JSONDecodeError as e:
-        pass
+    return core_hours
 
-    try:
-        root = ET.fromstring(r.text)
-    except ET.ParserError as e:
-        raise XdmodError('Invalid XML data returned from XDMoD API: {}'.format(e))
+def xdmod_fetch_total_cpu_hours_grouped(start, end, resources=None, statistics='total_cpu_hours'):
+    """Returns total cpu hours of every account, grouped by pi"""
+    if resources is None:
+        resources = []
 
-    rows = root.find('rows')
-    if len(rows) != 1:
-        raise XdmodNotFoundError('Rows not found for {} - {}'.format(project, resources))
+    payload = dict(_DEFAULT_PARAMS)
+    payload['resource_filter'] = '"{}"'.format(','.join(resources))
+    payload['start_date'] = start
+    payload['end_date'] = end
+    payload['group_by'] = 'pi'
+    payload['realm'] = 'Jobs'
+    payload['statistic'] = statistics
 
-    cells = rows.find('row').findall('cell')
-    if len(cells) != 2:
-        raise XdmodError('Invalid XML data returned from XDMoD API: Cells not found')
+    return _fetch_table(payload, resources)
 
-    core_hours = cells[1].find('value').text
+def xdmod_fetch_total_storage_grouped(start, end, resources=None, statistics='physical_usage'):
+    """Returns storage usage in GB of every account, grouped by pi"""
+    if resources is None:
+        resources = []
 
-    return core_hours
+    payload_end = end
+    if payload_end is None:
+        payload_end = '2099-01-01'
+    payload = dict(_DEFAULT_PARAMS)
+    payload['resource_filter'] = '{}'.format(','.join(resources))
+    payload['start_date'] = start
+    payload['end_date'] = payload_end
+    payload['group_by'] = 'pi'
+    payload['realm'] = 'Storage'
+    payload['statistic'] = statistics
+
+    table = _fetch_table(payload, resources)
+
+    return {name: float(value) / 1E9 for name, value in table.items()}
+
+def xdmod_fetch_cloud_core_time_grouped(start, end, resources=None):
+    """Returns cloud core time of every project, grouped by project"""
+    if resources is None:
+        resources = []
+
+    payload = dict(_DEFAULT_PARAMS)
+    payload['resource_filter'] = '"{}"'.format(','.join(resources))
+    payload['start_date'] = start
+    payload['end_date'] = end
+    payload['group_by'] = 'project'
+    payload['realm'] = 'Cloud'
+    payload['statistic'] = 'cloud_core_time'
+
+    return _fetch_table(payload, resources)